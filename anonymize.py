@@ -0,0 +1,628 @@
+import codecs
+import collections
+import contextlib
+import mmap
+import multiprocessing
+import os
+import re
+import shutil
+import threading
+
+from dictionary import Automaton
+from output import OutputFile
+
+# read size of the streaming engine
+CHUNK_SIZE = 1 << 20
+
+# smallest region handed to a worker of the parallel engine
+MIN_REGION = 4 << 20
+
+# engine used by the servers, can be overridden with the ANON_ENGINE environment variable
+DEFAULT_ENGINE = os.environ.get('ANON_ENGINE', 'replace')
+
+# settings of the text engine: encoding of the files ('auto' reads the byte order mark and
+# falls back to UTF-8), case-insensitive and whole-word matching, and 'chars' to mask one 'X'
+# per character or 'bytes' to keep the byte length of the text
+TEXT_ENCODING = os.environ.get('ANON_ENCODING', 'auto')
+TEXT_CASEFOLD = os.environ.get('ANON_CASEFOLD', '').lower() in ('1', 'true', 'yes')
+TEXT_WORDS = os.environ.get('ANON_WORDS', '').lower() in ('1', 'true', 'yes')
+TEXT_MASK = os.environ.get('ANON_MASK', 'chars')
+
+# encoding of the keywords sent by the clients
+KEYWORD_ENCODING = 'utf-8'
+
+# byte order marks and the codec that reads the text after them, longest first
+BOMS = [
+    (codecs.BOM_UTF32_LE, 'utf-32-le'),
+    (codecs.BOM_UTF32_BE, 'utf-32-be'),
+    (codecs.BOM_UTF8, 'utf-8'),
+    (codecs.BOM_UTF16_LE, 'utf-16-le'),
+    (codecs.BOM_UTF16_BE, 'utf-16-be'),
+]
+
+# compiled keyword patterns, cached per process (the parallel workers compile their own) and
+# least recently used first; the keywords come from the clients, so only the last
+# MAX_CACHED_PATTERNS keyword lists are kept in each cache
+MAX_CACHED_PATTERNS = 32
+_patterns = collections.OrderedDict()
+_lookaheads = collections.OrderedDict()
+_text_patterns = collections.OrderedDict()
+_patterns_lock = threading.Lock()
+
+# redaction dictionary mapped by load_dictionary(), None if there is none
+_dictionary = None
+
+
+def mask(keyword):
+
+    """
+    The replacement for a keyword: the same number of 'X's.
+    """
+
+    return b'X' * len(keyword)
+
+
+def cached_pattern(cache, key, compile_pattern):
+
+    """
+    Look a compiled pattern up in one of the pattern caches, compiling it on a miss and
+    dropping the least recently used entry once the cache holds MAX_CACHED_PATTERNS.
+
+    Parameters:
+    - cache (OrderedDict): The cache to use.
+    - key (tuple): The keywords and options the pattern is compiled from.
+    - compile_pattern (function): Compiles the pattern, called without arguments.
+
+    Returns:
+    - The cached or newly compiled value.
+    """
+
+    with _patterns_lock:
+        if key in cache:
+            value = cache.pop(key)
+            cache[key] = value
+            return value
+
+    # compiled outside the lock, a large keyword list can take a while
+    value = compile_pattern()
+    with _patterns_lock:
+        cache[key] = value
+        while len(cache) > MAX_CACHED_PATTERNS:
+            cache.popitem(last=False)
+    return value
+
+
+@contextlib.contextmanager
+def open_output(dstPath):
+
+    """
+    Open the output of an engine for writing without discarding the space preallocated for
+    it by anonymize_file(), and cut it to the length written when the engine is done.
+    """
+
+    fd = os.open(dstPath, os.O_WRONLY | os.O_CREAT, 0o666)
+    with os.fdopen(fd, 'wb') as anon_fp:
+        yield anon_fp
+        anon_fp.truncate()
+
+
+def keyword_pattern(keywords):
+
+    """
+    Compile the keywords into one regular expression.
+
+    Longer keywords come first in the alternation, so at any position the longest keyword
+    wins. Scanning is left to right and matches don't overlap, which is what bytes.replace
+    does for a single keyword.
+
+    Parameters:
+    - keywords (list): The keywords to be anonymized.
+
+    Returns:
+    - tuple: (compiled pattern, length of the longest keyword)
+    """
+
+    def compile_pattern():
+        unique = sorted(set(keyword for keyword in keywords if keyword), key=len, reverse=True)
+        pattern = re.compile(b'|'.join(re.escape(keyword) for keyword in unique)) if unique else None
+        return pattern, max(len(keyword) for keyword in unique) if unique else 0
+
+    return cached_pattern(_patterns, tuple(keywords), compile_pattern)
+
+
+def keyword_lookahead(keywords):
+
+    """
+    Compile the keywords into a zero-width pattern that matches at every position where
+    a keyword starts, overlapping or not, capturing the longest keyword starting there.
+
+    Returns:
+    - tuple: (compiled pattern, length of the longest keyword)
+    """
+
+    def compile_pattern():
+        pattern, longest = keyword_pattern(keywords)
+        return re.compile(b'(?=(' + pattern.pattern + b'))') if pattern else None, longest
+
+    return cached_pattern(_lookaheads, tuple(keywords), compile_pattern)
+
+
+def text_pattern(keywords, fold, words):
+
+    """
+    Compile the keywords, decoded from KEYWORD_ENCODING, into one regular expression
+    over text.
+
+    Case folding uses the regular expression engine's simple (one character to one
+    character) folding, so a match is always as long as the keyword it matches.
+
+    Parameters:
+    - keywords (list): The keywords to be anonymized.
+    - fold (bool): Match regardless of case.
+    - words (bool): Only match whole words, not keywords inside longer words.
+
+    Returns:
+    - tuple: (compiled pattern, length of the longest keyword in characters)
+
+    Raises:
+    - ValueError: If a keyword is not valid KEYWORD_ENCODING.
+    """
+
+    def compile_pattern():
+        decoded = set()
+        for keyword in keywords:
+            if isinstance(keyword, bytes):
+                try:
+                    keyword = keyword.decode(KEYWORD_ENCODING)
+                except UnicodeDecodeError:
+                    raise ValueError('Keyword ' + repr(keyword) + ' is not valid ' + KEYWORD_ENCODING)
+            if keyword:
+                decoded.add(keyword)
+        unique = sorted(decoded, key=len, reverse=True)
+
+        pattern = None
+        if unique:
+            alternation = u'|'.join(re.escape(keyword) for keyword in unique)
+            if words:
+                alternation = u'(?<!\\w)(?:' + alternation + u')(?!\\w)'
+            pattern = re.compile(alternation, re.UNICODE | (re.IGNORECASE if fold else 0))
+        return pattern, max(len(keyword) for keyword in unique) if unique else 0
+
+    return cached_pattern(_text_patterns, (tuple(keywords), fold, words), compile_pattern)
+
+
+def detect_encoding(fp, encoding):
+
+    """
+    Read the byte order mark at the start of a file, if it has one.
+
+    A byte order mark decides the codec whatever encoding is configured; without one,
+    'auto' means UTF-8. The file is left positioned after the mark.
+
+    Returns:
+    - tuple: (codec of the text, byte order mark to copy to the output)
+    """
+
+    head = fp.read(4)
+    for bom, codec in BOMS:
+        if head.startswith(bom):
+            fp.seek(len(bom))
+            return codec, bom
+    fp.seek(0)
+    return ('utf-8' if encoding == 'auto' else encoding), b''
+
+
+def load_dictionary(filePath):
+
+    """
+    Map a redaction dictionary built with dictionary.py.
+
+    From then on anonymize_file() uses the 'dictionary' engine by default, which masks every
+    term of the dictionary along with the keywords it is given. Processes forked afterwards
+    (the parallel engine's workers) share the mapping.
+
+    Raises:
+    - IOError: If the file can't be opened.
+    - ValueError: If it is not a dictionary file.
+    """
+
+    global _dictionary
+    _dictionary = Automaton.open(filePath)
+    return _dictionary
+
+
+def anon_replace(srcPath, dstPath, keywords):
+
+    """
+    Reference engine: read the whole file and call bytes.replace once per keyword.
+
+    With several keywords, each one is replaced in turn, so the result can differ from the
+    single-pass engines when keywords overlap each other.
+    """
+
+    with open(srcPath, 'rb') as og_fp:
+        anon_text = og_fp.read()
+    for keyword in keywords:
+        if keyword:
+            anon_text = anon_text.replace(keyword, mask(keyword))
+    with open_output(dstPath) as anon_fp:
+        anon_fp.write(anon_text)
+
+
+def anon_multi(srcPath, dstPath, keywords):
+
+    """
+    In-memory engine that replaces every keyword in a single regular expression pass.
+    """
+
+    pattern, longest = keyword_pattern(keywords)
+    with open(srcPath, 'rb') as og_fp:
+        anon_text = og_fp.read()
+    if pattern:
+        anon_text = pattern.sub(lambda match: mask(match.group()), anon_text)
+    with open_output(dstPath) as anon_fp:
+        anon_fp.write(anon_text)
+
+
+def anon_stream(srcPath, dstPath, keywords):
+
+    """
+    Streaming engine: constant memory, reads and writes CHUNK_SIZE bytes at a time.
+
+    A match is only accepted if it starts at least (longest keyword - 1) bytes before the end
+    of the buffered data, so a keyword that crosses a chunk boundary is always seen whole.
+    The undecided tail is carried over to the next chunk.
+    """
+
+    pattern, longest = keyword_pattern(keywords)
+    if not pattern:
+        shutil.copyfile(srcPath, dstPath)
+        return
+
+    with open(srcPath, 'rb') as og_fp:
+        with open_output(dstPath) as anon_fp:
+            carry = b''
+            while 1:
+                data = og_fp.read(CHUNK_SIZE)
+                buf = carry + data
+                if not buf:
+                    break
+
+                # at the end of the file every match is final
+                safe = len(buf) if not data else len(buf) - (longest - 1)
+
+                out = []
+                pos = 0
+                for match in pattern.finditer(buf):
+                    if match.start() >= safe:
+                        break
+                    out.append(buf[pos:match.start()])
+                    out.append(mask(match.group()))
+                    pos = match.end()
+
+                # nothing starts in [pos, safe), so scanning can resume at safe
+                keep = max(pos, safe)
+                out.append(buf[pos:keep])
+                anon_fp.write(b''.join(out))
+                carry = buf[keep:]
+
+                if not data:
+                    break
+
+
+def anon_mmap(srcPath, dstPath, keywords):
+
+    """
+    Memory-mapped engine: copies the file, then overwrites the matches in place.
+
+    The input is scanned through a read-only mapping and only the pages that contain
+    a match are written, so no copy of the file is held in the process heap.
+    """
+
+    shutil.copyfile(srcPath, dstPath)
+    pattern, longest = keyword_pattern(keywords)
+    if not pattern or not os.path.getsize(srcPath):
+        return
+
+    with open(srcPath, 'rb') as og_fp:
+        with open(dstPath, 'r+b') as anon_fp:
+            og_map = mmap.mmap(og_fp.fileno(), 0, access=mmap.ACCESS_READ)
+            anon_map = mmap.mmap(anon_fp.fileno(), 0)
+            try:
+                for match in pattern.finditer(og_map):
+                    anon_map[match.start():match.end()] = mask(match.group())
+                anon_map.flush()
+            finally:
+                anon_map.close()
+                og_map.close()
+
+
+def anon_dictionary(srcPath, dstPath, keywords):
+
+    """
+    Streaming engine that masks the keywords and every term of the loaded dictionary.
+
+    The dictionary automaton and a lookahead pattern for the keywords record the longest
+    match starting at each position. Once no longer match can start before a position,
+    the matches before it are taken left to right, skipping any that overlap the previous
+    one. That gives the same result as the other engines for the union of both lists.
+    """
+
+    automaton = _dictionary
+    lookahead, longest = keyword_lookahead(keywords)
+    if automaton is not None:
+        longest = max(longest, automaton.max_len)
+    if not longest:
+        shutil.copyfile(srcPath, dstPath)
+        return
+
+    # start -> end of the longest match starting there, until it is decided
+    found = {}
+    state = 0
+
+    with open(srcPath, 'rb') as og_fp:
+        with open_output(dstPath) as anon_fp:
+            carry = b''
+            # position of carry in the file, and end of the last mask
+            buf_start = 0
+            pos = 0
+            while 1:
+                data = og_fp.read(CHUNK_SIZE)
+                buf = carry + data
+                if not buf:
+                    break
+
+                if automaton is not None:
+                    state = automaton.scan(data, state, buf_start + len(carry), found)
+                if lookahead is not None:
+                    for match in lookahead.finditer(buf):
+                        start = buf_start + match.start()
+                        end = start + len(match.group(1))
+                        if found.get(start, 0) < end:
+                            found[start] = end
+
+                # every match starting before safe has been seen whole
+                buf_end = buf_start + len(buf)
+                safe = buf_end if not data else buf_end - (longest - 1)
+
+                out = []
+                written = buf_start
+                for start in sorted(start for start in found if start < safe):
+                    end = found.pop(start)
+                    if start < pos:
+                        continue
+                    out.append(buf[written - buf_start:start - buf_start])
+                    out.append(b'X' * (end - start))
+                    written = pos = end
+
+                keep = max(written, safe)
+                out.append(buf[written - buf_start:keep - buf_start])
+                anon_fp.write(b''.join(out))
+                carry = buf[keep - buf_start:]
+                buf_start = keep
+
+                if not data:
+                    break
+
+
+def anon_text(srcPath, dstPath, keywords, encoding=None, fold=None, words=None, by=None):
+
+    """
+    Streaming engine that matches characters instead of bytes.
+
+    The file is decoded incrementally, so a chunk boundary never splits a multi-byte
+    sequence, and re-encoded in the same encoding (UTF-16 and UTF-32 files keep their byte
+    order mark). Keywords can match regardless of case and only as whole words, and are
+    masked with one 'X' per character, or with as many as keep the byte length of the text.
+    The other arguments default to the TEXT_* settings.
+
+    Raises:
+    - IOError: If there is an error opening, reading or writing either file.
+    - ValueError: If the file or a keyword can't be decoded, or the encoding is unknown.
+    """
+
+    encoding = encoding or TEXT_ENCODING
+    fold = TEXT_CASEFOLD if fold is None else fold
+    words = TEXT_WORDS if words is None else words
+    by = by or TEXT_MASK
+    if by not in ('chars', 'bytes'):
+        raise ValueError('Unknown mask ' + by + ', expected chars or bytes')
+
+    pattern, longest = text_pattern(keywords, fold, words)
+    if not pattern:
+        shutil.copyfile(srcPath, dstPath)
+        return
+
+    with open(srcPath, 'rb') as og_fp:
+        codec, bom = detect_encoding(og_fp, encoding)
+        try:
+            decoder = codecs.getincrementaldecoder(codec)()
+            encoder = codecs.getincrementalencoder(codec)()
+        except LookupError:
+            raise ValueError('Unknown encoding ' + codec)
+
+        # bytes of one 'X', to mask by byte length (less the byte order mark some codecs add)
+        overhead = len(u''.encode(codec))
+        unit = len(u'X'.encode(codec)) - overhead
+        if by == 'chars':
+            replace = lambda match: u'X' * len(match.group())
+        else:
+            replace = lambda match: u'X' * ((len(match.group().encode(codec)) - overhead) // unit)
+
+        with open_output(dstPath) as anon_fp:
+            anon_fp.write(bom)
+            # carry: undecided text, after lead characters already written that are only
+            # kept so the whole-word check can look behind the first match
+            carry = u''
+            lead = 0
+            while 1:
+                data = og_fp.read(CHUNK_SIZE)
+                try:
+                    buf = carry + decoder.decode(data, not data)
+                except UnicodeDecodeError as e:
+                    raise ValueError(srcPath + ' is not valid ' + codec + ' text: ' + str(e))
+
+                # one more character than the longest keyword, for the whole-word check
+                safe = len(buf) if not data else max(lead, len(buf) - longest)
+
+                out = []
+                pos = lead
+                for match in pattern.finditer(buf, lead):
+                    if match.start() >= safe:
+                        break
+                    out.append(buf[pos:match.start()])
+                    out.append(replace(match))
+                    pos = match.end()
+
+                keep = max(pos, safe)
+                out.append(buf[pos:keep])
+                anon_fp.write(encoder.encode(u''.join(out)))
+
+                if not data:
+                    anon_fp.write(encoder.encode(u'', True))
+                    break
+                lead = min(keep, 1)
+                carry = buf[keep - lead:]
+
+
+def split_regions(num_bytes, workers):
+
+    """
+    Split a file into the contiguous regions handled by the parallel engine.
+
+    Returns:
+    - list: A list of (start, end) tuples.
+    """
+
+    if num_bytes <= 0:
+        return [(0, 0)]
+    count = max(1, min(workers, num_bytes // MIN_REGION))
+    size = -(-num_bytes // count)
+    return [(start, min(start + size, num_bytes)) for start in range(0, num_bytes, size)]
+
+
+def anon_region(args):
+
+    """
+    Anonymize one region of a file for the parallel engine.
+
+    Matches are searched from scan_from and accepted if they start before the end of the
+    region; the bytes between start and scan_from are covered by a match from the
+    previous region and are masked.
+
+    Parameters:
+    - args (tuple): (srcPath, keywords, start, end, scan_from)
+
+    Returns:
+    - tuple: (anonymized bytes of [start, end), end of the last match, which may be past end)
+    """
+
+    srcPath, keywords, start, end, scan_from = args
+    pattern, longest = keyword_pattern(keywords)
+
+    with open(srcPath, 'rb') as og_fp:
+        og_fp.seek(scan_from)
+        buf = og_fp.read(end - scan_from + longest - 1)
+
+    out = [b'X' * (scan_from - start)]
+    pos = 0
+    tail = scan_from
+    for match in pattern.finditer(buf):
+        if scan_from + match.start() >= end:
+            break
+        out.append(buf[pos:match.start()])
+        out.append(mask(match.group()))
+        pos = match.end()
+        tail = scan_from + pos
+
+    # the last match may run past the end of the region, cut it there
+    anon_text = b''.join(out) + buf[pos:end - scan_from]
+    return anon_text[:end - start], tail
+
+
+def anon_parallel(srcPath, dstPath, keywords, workers=None):
+
+    """
+    Parallel engine: each worker process anonymizes one region of the file.
+
+    A keyword crossing into the next region is seen by the worker that owns its start.
+    When such a match extends past the region boundary, the next region is redone in this
+    process, starting after the match, so the result is the same as a left-to-right scan.
+    """
+
+    pattern, longest = keyword_pattern(keywords)
+    num_bytes = os.path.getsize(srcPath)
+    regions = split_regions(num_bytes, workers or multiprocessing.cpu_count())
+    if not pattern or len(regions) == 1:
+        anon_stream(srcPath, dstPath, keywords)
+        return
+
+    pool = multiprocessing.Pool(len(regions))
+    try:
+        results = pool.imap(anon_region, [(srcPath, keywords, start, end, start) for start, end in regions])
+        with open_output(dstPath) as anon_fp:
+            tail = 0
+            for (start, end), (anon_text, region_tail) in zip(regions, results):
+                if tail > start:
+                    anon_text, region_tail = anon_region((srcPath, keywords, start, end, min(tail, end)))
+                anon_fp.write(anon_text)
+                tail = max(tail, region_tail)
+    finally:
+        pool.close()
+        pool.join()
+
+
+ENGINES = {
+    'replace': anon_replace,
+    'multi': anon_multi,
+    'stream': anon_stream,
+    'mmap': anon_mmap,
+    'parallel': anon_parallel,
+    'dictionary': anon_dictionary,
+    'text': anon_text,
+}
+
+
+def default_engine():
+
+    """
+    The engine set by ANON_ENGINE, 'replace' by default.
+
+    Raises:
+    - ValueError: If the engine is unknown.
+    """
+
+    if DEFAULT_ENGINE not in ENGINES:
+        raise ValueError('Unknown engine ' + DEFAULT_ENGINE + ', expected one of ' + ', '.join(sorted(ENGINES)))
+    return DEFAULT_ENGINE
+
+
+def anonymize_file(srcPath, dstPath, keywords, engine=None):
+
+    """
+    Anonymize srcPath into dstPath, replacing each keyword with the same number of 'X's.
+
+    dstPath is replaced atomically, once the engine has written the whole output.
+
+    Parameters:
+    - srcPath (str): The path of the file to be anonymized.
+    - dstPath (str): The path of the anonymized file.
+    - keywords (list): The keywords to be anonymized.
+    - engine (str): One of ENGINES; if not given, 'dictionary' once a dictionary is loaded,
+        DEFAULT_ENGINE otherwise.
+
+    Raises:
+    - IOError: If there is an error opening, reading or writing either file.
+    - KeyError: If the engine does not exist.
+    - ValueError: If the 'text' engine can't decode the file or a keyword.
+    """
+
+    if engine is None:
+        engine = 'dictionary' if _dictionary is not None else DEFAULT_ENGINE
+    engine = ENGINES[engine]
+
+    # the output is written next to dstPath and renamed over it once complete, so readers
+    # never see a partial file; it is usually as long as the input, preallocate that much
+    num_bytes = os.path.getsize(srcPath) if os.path.isfile(srcPath) else None
+    with OutputFile(dstPath, num_bytes) as output:
+        engine(srcPath, output.path, keywords)
@@ -0,0 +1,247 @@
+import argparse
+import hashlib
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+# the project root, where anonymize.py lives
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import anonymize
+from dictionary import Automaton
+from transfer_bench import VOCABULARY, parse_size, percentile
+
+
+def make_keywords(count):
+
+    """
+    Generate count distinct keywords.
+
+    They all have the same length and 'N' only appears as their first letter, so no keyword
+    overlaps another: replacing them one by one (the reference engine) and in a single pass
+    must then give the same bytes.
+    """
+
+    return ['Name%04d' % i for i in range(count)]
+
+
+def boundaries(num_bytes, workers):
+
+    """
+    Offsets where the engines split their input: every CHUNK_SIZE for the streaming engine,
+    and the region starts of the parallel engine.
+    """
+
+    offsets = set(range(anonymize.CHUNK_SIZE, num_bytes, anonymize.CHUNK_SIZE))
+    offsets.update(start for start, end in anonymize.split_regions(num_bytes, workers)[1:])
+    return sorted(offsets)
+
+
+def generate_file(filePath, num_bytes, keywords, density, workers, seed=0):
+
+    """
+    Write a text file of num_bytes with keywords mixed in, then plant one keyword across
+    every chunk and region boundary of the engines.
+    """
+
+    rng = random.Random(seed)
+    words = []
+    length = 0
+    while length < min(num_bytes, 1 << 20):
+        word = rng.choice(keywords) if rng.random() < density else rng.choice(VOCABULARY)
+        words.append(word)
+        length += len(word) + 1
+    block = ' '.join(words) + '\n'
+
+    with open(filePath, 'wb') as fp:
+        remaining = num_bytes
+        while remaining > 0:
+            fp.write(block[:remaining])
+            remaining -= len(block[:remaining])
+
+        for offset in boundaries(num_bytes, workers):
+            keyword = rng.choice(keywords)
+            start = offset - len(keyword) // 2
+            if start >= 0 and start + len(keyword) <= num_bytes:
+                fp.seek(start)
+                fp.write(keyword)
+
+
+def file_digest(filePath):
+
+    """
+    SHA-1 of a file, read in 1 MB blocks.
+    """
+
+    digest = hashlib.sha1()
+    with open(filePath, 'rb') as fp:
+        for block in iter(lambda: fp.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def split_dictionary(keywords):
+
+    """
+    Split the keywords for the dictionary engine: the second half goes into the dictionary
+    file and the first half is passed as keywords, so both paths of the engine (and how
+    their matches are merged) are checked. A single keyword goes into the dictionary.
+
+    Returns:
+    - tuple: (keywords, dictionary terms)
+    """
+
+    half = len(keywords) // 2
+    return keywords[:half], keywords[half:]
+
+
+def run_engine(engine, srcPath, dstPath, keywordPath, workers, dictionaryPath):
+
+    """
+    Run one engine in this process and print its time and peak memory as JSON.
+
+    Each measurement runs in a fresh process, so that peak RSS belongs to one engine. The
+    dictionary engine maps dictionaryPath first, and is only given the keywords that are
+    not in it.
+    """
+
+    with open(keywordPath, 'rb') as fp:
+        keywords = fp.read().split('\n')
+    if engine == 'dictionary':
+        anonymize.load_dictionary(dictionaryPath)
+        keywords = split_dictionary(keywords)[0]
+
+    start = time.time()
+    if engine == 'parallel':
+        anonymize.anon_parallel(srcPath, dstPath, keywords, workers=workers)
+    else:
+        anonymize.anonymize_file(srcPath, dstPath, keywords, engine=engine)
+    elapsed = time.time() - start
+
+    print json.dumps({
+        'seconds': elapsed,
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'children_max_rss_kb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    })
+
+
+def measure(engine, srcPath, dstPath, keywordPath, workers, iterations, dictionaryPath):
+
+    """
+    Run an engine iterations times in subprocesses, removing dstPath before each run.
+
+    Returns:
+    - dict: Median time and the highest peak RSS seen.
+    """
+
+    runs = []
+    for _ in range(iterations):
+        # so that an engine that writes nothing can't leave a previous output to be checked
+        if os.path.exists(dstPath):
+            os.unlink(dstPath)
+        output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--run-engine', engine,
+                                          srcPath, dstPath, keywordPath, str(workers), dictionaryPath])
+        runs.append(json.loads(output.strip().split('\n')[-1]))
+    return {
+        'seconds': percentile([run['seconds'] for run in runs], 0.5),
+        'max_rss_kb': max(run['max_rss_kb'] for run in runs),
+        'children_max_rss_kb': max(run['children_max_rss_kb'] for run in runs),
+    }
+
+
+def main():
+
+    """
+    Compare the anonymization engines across file sizes, keyword counts and match densities.
+    """
+
+    parser = argparse.ArgumentParser(description='Benchmark and cross-check the anonymization engines.')
+    parser.add_argument('--engines', nargs='+', default=sorted(anonymize.ENGINES), choices=sorted(anonymize.ENGINES))
+    parser.add_argument('--sizes', nargs='+', default=['1M', '16M', '64M'], help='file sizes, e.g. 1M 1G')
+    parser.add_argument('--keywords', nargs='+', type=int, default=[1, 16], help='numbers of keywords')
+    parser.add_argument('--densities', nargs='+', type=float, default=[0.001, 0.05],
+                        help='fractions of words that are keywords')
+    parser.add_argument('--workers', type=int, default=4, help='processes of the parallel engine')
+    parser.add_argument('--iterations', type=int, default=3)
+    parser.add_argument('--output', help='write the JSON results to this file instead of stdout')
+    parser.add_argument('--run-engine', nargs=6, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_engine:
+        engine, srcPath, dstPath, keywordPath, workers, dictionaryPath = args.run_engine
+        run_engine(engine, srcPath, dstPath, keywordPath, int(workers), dictionaryPath)
+        return
+
+    workdir = tempfile.mkdtemp(prefix='anon_bench_')
+    results = []
+    try:
+        srcPath = os.path.join(workdir, 'input.txt')
+        dstPath = os.path.join(workdir, 'output.txt')
+        referencePath = os.path.join(workdir, 'reference.txt')
+        keywordPath = os.path.join(workdir, 'keywords.txt')
+        dictionaryPath = os.path.join(workdir, 'dictionary.dat')
+
+        for size in args.sizes:
+            num_bytes = parse_size(size)
+            for count in args.keywords:
+                keywords = make_keywords(count)
+                with open(keywordPath, 'wb') as fp:
+                    fp.write('\n'.join(keywords))
+                Automaton.build(split_dictionary(keywords)[1]).save(dictionaryPath)
+
+                for density in args.densities:
+                    sys.stderr.write('%s, %d keywords, density %g ...\n' % (size, count, density))
+                    generate_file(srcPath, num_bytes, keywords, density, args.workers)
+
+                    # the reference output, in a file of its own
+                    anonymize.anon_replace(srcPath, referencePath, keywords)
+                    expected = file_digest(referencePath)
+
+                    for engine in args.engines:
+                        result = measure(engine, srcPath, dstPath, keywordPath, args.workers, args.iterations,
+                                         dictionaryPath)
+                        result.update({
+                            'engine': engine,
+                            'bytes': num_bytes,
+                            'keywords': count,
+                            'density': density,
+                            'mb_s': num_bytes / 1e6 / result['seconds'] if result['seconds'] > 0 else None,
+                            'correct': os.path.exists(dstPath) and file_digest(dstPath) == expected,
+                        })
+                        results.append(result)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'meta': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'timestamp': time.time(),
+            'iterations': args.iterations,
+            'workers': args.workers,
+            'chunk_size': anonymize.CHUNK_SIZE,
+        },
+        'results': results,
+    }
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(report, fp, indent=2, sort_keys=True)
+    else:
+        print json.dumps(report, indent=2, sort_keys=True)
+
+    if not all(result['correct'] for result in results):
+        sys.stderr.write('Some engines did not match the reference output.\n')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+import argparse
+import heapq
+import random
+import select
+import socket
+import threading
+import time
+
+
+class ImpairmentProxy(object):
+
+    """
+    A local UDP proxy that emulates a bad network between a client and server_udp.py.
+
+    The client sends to the proxy port instead of the server port. Each client address gets
+    its own upstream socket, so the server's replies can be routed back. Every datagram, in
+    both directions, can be dropped, duplicated, delayed and reordered.
+
+    Only traffic sent to the proxy port is impaired: the extra flows of a parallel transfer
+    (put/get with a stream count) talk to the server ports directly.
+    """
+
+    def __init__(self, listen_port, target, delay=0.0, jitter=0.0, loss=0.0, duplicate=0.0, reorder=0.0,
+                 reorder_delay=0.01, seed=None):
+
+        """
+        Parameters:
+        - listen_port (int): The port the client sends to (0 picks a free port).
+        - target (tuple): The (host, port) address of the server.
+        - delay (float): One-way delay added to every datagram, in seconds.
+        - jitter (float): Extra random delay, uniform in [0, jitter] seconds.
+        - loss (float): Probability of dropping a datagram.
+        - duplicate (float): Probability of delivering a datagram twice.
+        - reorder (float): Probability of holding a datagram back by reorder_delay, so
+            the datagrams sent after it overtake it.
+        - reorder_delay (float): How long reordered datagrams are held back, in seconds.
+        - seed (int): Seed for the random number generator, for repeatable runs.
+        """
+
+        self.target = target
+        self.delay = delay
+        self.jitter = jitter
+        self.loss = loss
+        self.duplicate = duplicate
+        self.reorder = reorder
+        self.reorder_delay = reorder_delay
+        self.random = random.Random(seed)
+
+        self.downstream = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.downstream.bind(('127.0.0.1', listen_port))
+        self.port = self.downstream.getsockname()[1]
+
+        # client address -> upstream socket, and back
+        self.upstreams = {}
+        self.clients = {}
+
+        # (due time, sequence number, socket, data, address)
+        self.pending = []
+        self.sequence = 0
+
+        self.stats = {'forwarded': 0, 'dropped': 0, 'duplicated': 0, 'reordered': 0}
+        self.running = False
+        self.thread = None
+
+    def start(self):
+
+        """
+        Start forwarding in a background thread.
+        """
+
+        self.running = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+
+        """
+        Stop forwarding and close all sockets.
+        """
+
+        self.running = False
+        if self.thread:
+            self.thread.join()
+        for sock in [self.downstream] + list(self.upstreams.values()):
+            sock.close()
+
+    def schedule(self, sock, data, address):
+
+        """
+        Apply the impairments to one datagram and queue its copies for delivery.
+        """
+
+        if self.random.random() < self.loss:
+            self.stats['dropped'] += 1
+            return
+
+        copies = 1
+        if self.random.random() < self.duplicate:
+            self.stats['duplicated'] += 1
+            copies = 2
+
+        for _ in range(copies):
+            due = time.time() + self.delay + self.random.uniform(0, self.jitter)
+            if self.random.random() < self.reorder:
+                self.stats['reordered'] += 1
+                due += self.reorder_delay
+            self.sequence += 1
+            heapq.heappush(self.pending, (due, self.sequence, sock, data, address))
+
+    def run(self):
+
+        """
+        Forwarding loop: read from every socket, deliver queued datagrams when they are due.
+        """
+
+        while self.running:
+            now = time.time()
+            while self.pending and self.pending[0][0] <= now:
+                due, sequence, sock, data, address = heapq.heappop(self.pending)
+                try:
+                    sock.sendto(data, address)
+                    self.stats['forwarded'] += 1
+                except socket.error:
+                    self.stats['dropped'] += 1
+
+            timeout = 0.05
+            if self.pending:
+                timeout = max(0.0, min(timeout, self.pending[0][0] - now))
+
+            sockets = [self.downstream] + list(self.upstreams.values())
+            readable, _, _ = select.select(sockets, [], [], timeout)
+
+            for sock in readable:
+                try:
+                    data, address = sock.recvfrom(65535)
+                except socket.error:
+                    continue
+
+                if sock is self.downstream:
+                    # client -> server, through the upstream socket of this client
+                    upstream = self.upstreams.get(address)
+                    if upstream is None:
+                        upstream = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                        upstream.bind(('127.0.0.1', 0))
+                        self.upstreams[address] = upstream
+                        self.clients[upstream] = address
+                    self.schedule(upstream, data, self.target)
+                else:
+                    # server -> client, from the proxy port
+                    self.schedule(self.downstream, data, self.clients[sock])
+
+
+def main():
+
+    """
+    Run the proxy on its own, e.g. in front of a manually started server_udp.py.
+    """
+
+    parser = argparse.ArgumentParser(description='UDP proxy with delay, loss, duplication and reordering.')
+    parser.add_argument('listen_port', type=int)
+    parser.add_argument('server_ip')
+    parser.add_argument('server_port', type=int)
+    parser.add_argument('--delay', type=float, default=0.0, help='one-way delay in ms')
+    parser.add_argument('--jitter', type=float, default=0.0, help='extra random delay in ms')
+    parser.add_argument('--loss', type=float, default=0.0, help='drop probability')
+    parser.add_argument('--duplicate', type=float, default=0.0, help='duplication probability')
+    parser.add_argument('--reorder', type=float, default=0.0, help='reordering probability')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    proxy = ImpairmentProxy(args.listen_port, (args.server_ip, args.server_port), delay=args.delay / 1000.0,
+                            jitter=args.jitter / 1000.0, loss=args.loss, duplicate=args.duplicate,
+                            reorder=args.reorder, seed=args.seed)
+    print 'Proxy listening on port', proxy.port, 'for', args.server_ip, args.server_port
+    try:
+        proxy.running = True
+        proxy.run()
+    except KeyboardInterrupt:
+        print 'Proxy stats:', proxy.stats
+
+
+if __name__ == '__main__':
+    main()
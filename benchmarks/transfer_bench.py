@@ -0,0 +1,437 @@
+import argparse
+import json
+import os
+import platform
+import Queue
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from netem import ImpairmentProxy
+
+
+# the project root, where the client and server scripts live
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# keyword planted in the generated files and anonymized by the keyword operation
+KEYWORD = 'networking'
+
+# words the generated text is made of
+VOCABULARY = ['socket', 'transport', 'reliable', 'datagram', 'packet', 'window', 'stream', 'segment',
+              'checksum', 'handshake', 'timeout', 'latency', 'throughput', 'buffer', 'protocol', 'layer']
+
+# what each client prints when an operation has succeeded
+DONE_MARKERS = {
+    'put': 'File uploaded.',
+    'keyword': 'anonymized. Output file is',
+    'get': 'downloaded.',
+}
+
+# what the clients print when an operation has failed; any server response without the
+# operation's DONE_MARKERS text (an error, or nothing when the server closed the connection)
+# is a failure too, and so is a client that exits (e.g. with a traceback) before succeeding
+FAILURE_MARKERS = ('Server response:', 'Error', 'could not find', 'does not exist', 'Terminating',
+                   'terminated prematurely')
+
+
+def parse_size(text):
+
+    """
+    Parse a size such as 1K, 64K, 16M or 2G into bytes.
+
+    Units are decimal (1K = 1000 bytes). Decimal sizes can still be multiples of 1024 bytes
+    (16M is), see bench_size() for how those are benchmarked.
+    """
+
+    units = {'K': 10 ** 3, 'M': 10 ** 6, 'G': 10 ** 9}
+    text = text.strip().upper().rstrip('B')
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def generate_file(filePath, num_bytes, density, seed=0):
+
+    """
+    Write a text file of exactly num_bytes, made of random words with KEYWORD mixed in.
+
+    A 1 MB block is generated once and repeated, so multi-GB files are cheap to create.
+
+    Parameters:
+    - filePath (str): The path of the file to create.
+    - num_bytes (int): The size of the file.
+    - density (float): The fraction of words that are KEYWORD.
+    - seed (int): Seed for the word generator.
+    """
+
+    rng = random.Random(seed)
+    words = []
+    length = 0
+    while length < min(num_bytes, 1 << 20):
+        word = KEYWORD if rng.random() < density else rng.choice(VOCABULARY)
+        words.append(word)
+        length += len(word) + 1
+    block = ' '.join(words) + '\n'
+
+    with open(filePath, 'wb') as fp:
+        remaining = num_bytes
+        while remaining > 0:
+            fp.write(block[:remaining])
+            remaining -= len(block[:remaining])
+
+
+def percentile(values, fraction):
+
+    """
+    Nearest-rank percentile of a list of numbers.
+    """
+
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(fraction * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def summarize(latencies, num_bytes):
+
+    """
+    Latency percentiles (ms) and median throughput (MB/s) of one operation.
+    """
+
+    if not latencies:
+        return {'latency_ms': None, 'throughput_mb_s': None}
+    median = percentile(latencies, 0.5)
+    return {
+        'latency_ms': {
+            'min': min(latencies) * 1000,
+            'p50': median * 1000,
+            'p90': percentile(latencies, 0.9) * 1000,
+            'p99': percentile(latencies, 0.99) * 1000,
+            'max': max(latencies) * 1000,
+            'mean': sum(latencies) / len(latencies) * 1000,
+        },
+        'throughput_mb_s': num_bytes / 1e6 / median if median > 0 else None,
+    }
+
+
+def free_port(kind):
+
+    """
+    Ask the kernel for a free port of the given socket type.
+    """
+
+    sock = socket.socket(socket.AF_INET, kind)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def wait_for_bind(port, kind, process, timeout=5.0):
+
+    """
+    Wait until the server has bound its port.
+
+    A UDP server can't be probed with a connection, so for both transports readiness is
+    detected by the port becoming impossible to bind.
+    """
+
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('server exited with status ' + str(process.returncode))
+        probe = socket.socket(socket.AF_INET, kind)
+        try:
+            probe.bind(('', port))
+        except socket.error:
+            return
+        finally:
+            probe.close()
+        time.sleep(0.01)
+    raise RuntimeError('server did not bind port ' + str(port))
+
+
+def reap(processes, timeout):
+
+    """
+    Wait for processes to exit, killing those still running after timeout seconds.
+
+    Returns:
+    - list: The CPU time (s) and peak RSS (KB) of each process, in the same order.
+    """
+
+    usage = {}
+    deadline = time.time() + timeout
+    while len(usage) < len(processes):
+        for process in processes:
+            if process.pid in usage:
+                continue
+            if time.time() > deadline:
+                process.kill()
+            pid, status, rusage = os.wait4(process.pid, 0 if time.time() > deadline else os.WNOHANG)
+            if pid:
+                process.returncode = status
+                usage[pid] = {'cpu_s': rusage.ru_utime + rusage.ru_stime, 'max_rss_kb': rusage.ru_maxrss}
+        time.sleep(0.01)
+    return [usage[process.pid] for process in processes]
+
+
+class Session(object):
+
+    """
+    One server process and one interactive client process driven through its stdin.
+    """
+
+    def __init__(self, transport, workdir, impairments):
+
+        self.transport = transport
+        self.serverDir = os.path.join(workdir, 'server')
+        self.clientDir = os.path.join(workdir, 'client')
+        kind = socket.SOCK_STREAM if transport == 'tcp' else socket.SOCK_DGRAM
+
+        # start the server, and the impairment proxy in front of it if needed
+        self.serverPort = free_port(kind)
+        self.server = subprocess.Popen([sys.executable, '-u', os.path.join(ROOT, 'server_' + transport + '.py'),
+                                        str(self.serverPort)], cwd=self.serverDir,
+                                       stdout=open(os.path.join(workdir, 'server.log'), 'ab'),
+                                       stderr=subprocess.STDOUT)
+        wait_for_bind(self.serverPort, kind, self.server)
+
+        self.proxy = None
+        clientPort = self.serverPort
+        if transport == 'udp' and impairments:
+            self.proxy = ImpairmentProxy(0, ('127.0.0.1', self.serverPort), **impairments).start()
+            clientPort = self.proxy.port
+
+        self.client = subprocess.Popen([sys.executable, '-u', os.path.join(ROOT, 'client_' + transport + '.py'),
+                                        '127.0.0.1', str(clientPort)], cwd=self.clientDir,
+                                       stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+        # read the client output in a thread so that operations can time out
+        self.lines = Queue.Queue()
+        reader = threading.Thread(target=self.read_output)
+        reader.daemon = True
+        reader.start()
+
+    def read_output(self):
+        for line in iter(self.client.stdout.readline, ''):
+            self.lines.put(line)
+        self.lines.put(None)
+
+    def run(self, command, marker, timeout):
+
+        """
+        Send one command to the client and wait for the line that marks its success, or one
+        that marks its failure.
+
+        Returns:
+        - tuple: (elapsed seconds or None on failure, output lines)
+        """
+
+        output = []
+        start = time.time()
+        self.client.stdin.write(command + '\n')
+        self.client.stdin.flush()
+        deadline = start + timeout
+        while 1:
+            try:
+                line = self.lines.get(timeout=max(0.0, deadline - time.time()))
+            except Queue.Empty:
+                output.append('timed out after ' + str(timeout) + ' s')
+                return None, output
+            if line is None:
+                return None, output
+            output.append(line.rstrip('\n'))
+            if marker in line:
+                return time.time() - start, output
+            if any(failure in line for failure in FAILURE_MARKERS):
+                return None, output
+
+    def close(self):
+
+        """
+        Quit the client (which also stops the server), or kill both if they are stuck.
+
+        Returns:
+        - dict: CPU time and peak RSS of the server and client processes.
+        """
+
+        try:
+            self.client.stdin.write('quit\n')
+            self.client.stdin.flush()
+        except (IOError, OSError):
+            pass
+
+        serverUsage, clientUsage = reap([self.server, self.client], 5)
+        if self.proxy:
+            self.proxy.stop()
+        return {'server': serverUsage, 'client': clientUsage, 'proxy': self.proxy.stats if self.proxy else None}
+
+
+def downloaded_size(filePath):
+
+    """
+    The size of a downloaded file, not counting the '\\0' that ends a TCP get: the client
+    keeps it when it arrives in the same read as the last data.
+    """
+
+    num_bytes = os.path.getsize(filePath)
+    if num_bytes:
+        with open(filePath, 'rb') as fp:
+            fp.seek(-1, os.SEEK_END)
+            if fp.read(1) == '\0':
+                num_bytes -= 1
+    return num_bytes
+
+
+def bench_size(transport, num_bytes, args, impairments):
+
+    """
+    Run every operation on one generated file over one transport.
+
+    Returns:
+    - dict: Per-operation latency/throughput summaries, failures and process resources.
+    """
+
+    # the TCP put and get detect the end of a file by a short read, so a file whose size is a
+    # multiple of 1024 bytes is a known hang, not a benchmark; every transport uses the same size
+    requested_bytes = num_bytes
+    if num_bytes % 1024 == 0:
+        num_bytes -= 1
+
+    workdir = tempfile.mkdtemp(prefix='anon_bench_')
+    try:
+        os.mkdir(os.path.join(workdir, 'server'))
+        os.mkdir(os.path.join(workdir, 'client'))
+        fileName = 'bench_' + str(num_bytes) + '.txt'
+        generate_file(os.path.join(workdir, 'client', fileName), num_bytes, args.density)
+
+        streams = ' ' + str(args.streams) if args.streams > 1 else ''
+        commands = {
+            'put': 'put ' + fileName + streams,
+            'keyword': 'keyword ' + KEYWORD + ' ' + fileName,
+            'get': 'get ' + fileName[:-4] + '_anon.txt' + streams,
+        }
+
+        # where get writes the anonymized file, which has the size of the original
+        downloadPath = os.path.join(workdir, 'client', fileName[:-4] + '_anon.txt')
+
+        latencies = dict((op, []) for op in args.ops)
+        failures = dict((op, []) for op in args.ops)
+        resources = []
+        session = None
+
+        for iteration in range(args.iterations):
+            for op in args.ops:
+                if session is None:
+                    session = Session(transport, workdir, impairments)
+                if transport == 'udp':
+                    # server_udp.py rebinds its socket between commands
+                    time.sleep(args.udp_gap)
+
+                if op == 'get' and os.path.exists(downloadPath):
+                    os.remove(downloadPath)
+
+                elapsed, output = session.run(commands[op], DONE_MARKERS[op], args.timeout)
+
+                # the TCP client reports a missing or truncated file as downloaded too
+                if elapsed is not None and op == 'get':
+                    received = downloaded_size(downloadPath)
+                    if received != num_bytes:
+                        output.append('downloaded %d of %d bytes' % (received, num_bytes))
+                        elapsed = None
+
+                if elapsed is None:
+                    # the client or server gave up, start a fresh pair for the next operation
+                    failures[op].append(output[-3:])
+                    resources.append(session.close())
+                    session = None
+                else:
+                    latencies[op].append(elapsed)
+
+        if session is not None:
+            resources.append(session.close())
+
+        result = {'transport': transport, 'bytes': num_bytes, 'requested_bytes': requested_bytes,
+                  'streams': args.streams, 'ops': {}}
+        for op in args.ops:
+            summary = summarize(latencies[op], num_bytes)
+            summary['ok'] = len(latencies[op])
+            summary['failed'] = len(failures[op])
+            summary['errors'] = failures[op]
+            result['ops'][op] = summary
+        result['server'] = {'cpu_s': sum(r['server']['cpu_s'] for r in resources),
+                            'max_rss_kb': max(r['server']['max_rss_kb'] for r in resources)}
+        result['client'] = {'cpu_s': sum(r['client']['cpu_s'] for r in resources),
+                            'max_rss_kb': max(r['client']['max_rss_kb'] for r in resources)}
+        if impairments and transport == 'udp':
+            result['proxy'] = dict((key, sum(r['proxy'][key] for r in resources)) for key in resources[0]['proxy'])
+        return result
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main():
+
+    """
+    Benchmark put/keyword/get over the TCP and UDP versions on localhost and print JSON results.
+    """
+
+    parser = argparse.ArgumentParser(description='Transfer and anonymization benchmark for the Anonymizer.')
+    parser.add_argument('--transports', nargs='+', default=['tcp', 'udp'], choices=['tcp', 'udp'])
+    parser.add_argument('--sizes', nargs='+', default=['1K', '64K', '1M', '16M'],
+                        help='file sizes, e.g. 1K 10M 2G')
+    parser.add_argument('--ops', nargs='+', default=['put', 'keyword', 'get'], choices=['put', 'keyword', 'get'])
+    parser.add_argument('--iterations', type=int, default=5)
+    parser.add_argument('--streams', type=int, default=1, help='parallel streams for put/get')
+    parser.add_argument('--density', type=float, default=0.01, help='fraction of words that are the keyword')
+    parser.add_argument('--timeout', type=float, default=60.0,
+                        help='seconds before an operation counts as failed, raise it for large files under loss')
+    parser.add_argument('--udp-gap', type=float, default=0.2, help='pause before each UDP command, in seconds')
+    parser.add_argument('--delay', type=float, default=0.0, help='UDP one-way delay in ms')
+    parser.add_argument('--jitter', type=float, default=0.0, help='UDP extra random delay in ms')
+    parser.add_argument('--loss', type=float, default=0.0, help='UDP drop probability')
+    parser.add_argument('--duplicate', type=float, default=0.0, help='UDP duplication probability')
+    parser.add_argument('--reorder', type=float, default=0.0, help='UDP reordering probability')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the JSON results to this file instead of stdout')
+    args = parser.parse_args()
+
+    impairments = {}
+    if args.delay or args.jitter or args.loss or args.duplicate or args.reorder:
+        impairments = {'delay': args.delay / 1000.0, 'jitter': args.jitter / 1000.0, 'loss': args.loss,
+                       'duplicate': args.duplicate, 'reorder': args.reorder, 'seed': args.seed}
+
+    results = []
+    for transport in args.transports:
+        for size in args.sizes:
+            num_bytes = parse_size(size)
+            sys.stderr.write('%s %s ...\n' % (transport, size))
+            results.append(bench_size(transport, num_bytes, args, impairments))
+
+    report = {
+        'meta': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'timestamp': time.time(),
+            'iterations': args.iterations,
+            'impairments': impairments,
+        },
+        'results': results,
+    }
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(report, fp, indent=2, sort_keys=True)
+    else:
+        print json.dumps(report, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,296 @@
+# asyncio client library for server_tcp.py, for programs that call the anonymizer directly.
+# Unlike the rest of the project it needs Python 3.7 or later; the server can stay on Python 2.
+import asyncio
+import os
+
+
+# size of the reads and writes of file data
+READ_SIZE = 1 << 16
+
+# encoding of file names and keywords on the wire (anonymize.KEYWORD_ENCODING on the server)
+ENCODING = 'utf-8'
+
+
+class AnonymizerError(Exception):
+    """
+    Raised when the server answers a request with an error, e.g. a file that does not exist.
+
+    The connection is still in a known state, so it goes back to the pool.
+    """
+
+
+class Connection(object):
+
+    """
+    One persistent connection to the server, used by one request at a time.
+
+    Requests use the framed commands of the server (fput, fget, fkeyword): every field is
+    null-terminated and file data is preceded by its size, so any number of requests can
+    follow each other on the same connection.
+    """
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        # whether the server has sent any of the reply to the current request
+        self.answered = False
+
+    def send(self, command, *fields):
+
+        """
+        Queue a command and its fields for sending.
+
+        Raises:
+        - ValueError: If a field contains a null byte.
+        """
+
+        parts = [command.encode()]
+        for field in fields:
+            field = field if isinstance(field, bytes) else str(field).encode(ENCODING)
+            if b'\0' in field:
+                raise ValueError('Null byte in ' + repr(field))
+            parts.append(field + b'\0')
+        self.writer.write(b''.join(parts))
+
+    async def recv_field(self):
+
+        """
+        Read a null-terminated field.
+
+        Raises:
+        - ConnectionError: If the server closes the connection first.
+        """
+
+        try:
+            field = await self.reader.readuntil(b'\0')
+        except asyncio.IncompleteReadError as e:
+            self.answered = self.answered or bool(e.partial)
+            raise ConnectionError('Server closed the connection.')
+        self.answered = True
+        return field[:-1]
+
+    async def reply(self):
+
+        """
+        Read the reply to a framed command.
+
+        Returns:
+        - bytes: The value of an 'OK' reply.
+
+        Raises:
+        - AnonymizerError: If the reply is 'ERR', with the server's message.
+        - ConnectionError: If the server closes the connection first.
+        """
+
+        status = await self.recv_field()
+        value = await self.recv_field()
+        if status != b'OK':
+            raise AnonymizerError(value.decode(ENCODING, 'replace'))
+        return value
+
+    def close(self):
+        self.writer.close()
+
+
+class Client(object):
+
+    """
+    A pool of persistent connections to one anonymizer server.
+
+    Up to `connections` requests run at the same time, each on its own connection;
+    further requests wait for a connection to come free. Connections are opened on
+    first use and kept for the next requests, so a request costs no connection setup.
+    A connection that fails or times out in the middle of a request is closed instead
+    of going back to the pool.
+
+    Use it as an async context manager, or call close() when done:
+
+        async with Client('127.0.0.1', 8080) as client:
+            await client.put('report.txt')
+            output = await client.anonymize('secret', 'report.txt')
+            await client.get(output, 'report_anon.txt')
+    """
+
+    def __init__(self, host, port, connections=4, timeout=30.0):
+
+        """
+        Parameters:
+        - host (str): The server IP address or host name.
+        - port (int): The server port.
+        - connections (int): The size of the pool, i.e. the most requests in flight at once.
+        - timeout (float): Seconds a request may take, including the wait for a connection;
+            None for no limit.
+        """
+
+        self.host = host
+        self.port = port
+        self.connections = connections
+        self.timeout = timeout
+        self.idle = []
+        self.slots = None
+        self.closed = False
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def put(self, filePath, fileName=None):
+
+        """
+        Upload a file to the server.
+
+        Parameters:
+        - filePath (str): The path of the local file.
+        - fileName (str): The name to store it under, by default the base name of filePath.
+
+        Returns:
+        - int: The number of bytes uploaded.
+
+        Raises:
+        - OSError: If the local file can't be read.
+        - ConnectionError: If the connection fails.
+        - asyncio.TimeoutError: If the request takes longer than the timeout.
+        """
+
+        return await self.request(self.do_put, filePath, fileName or os.path.basename(filePath))
+
+    async def get(self, fileName, filePath=None):
+
+        """
+        Download a file from the server.
+
+        Parameters:
+        - fileName (str): The name of the file on the server.
+        - filePath (str): Where to write it, by default fileName in the current directory.
+
+        Returns:
+        - int: The number of bytes downloaded.
+
+        Raises:
+        - AnonymizerError: If the file does not exist on the server.
+        - OSError: If the local file can't be written.
+        - ConnectionError: If the connection fails.
+        - asyncio.TimeoutError: If the request takes longer than the timeout.
+        """
+
+        return await self.request(self.do_get, fileName, filePath or os.path.basename(fileName))
+
+    async def anonymize(self, keyword, fileName):
+
+        """
+        Anonymize a file on the server, with the server's engine and settings.
+
+        Parameters:
+        - keyword (str): The keyword to be anonymized.
+        - fileName (str): The name of the file on the server.
+
+        Returns:
+        - str: The name of the anonymized file on the server.
+
+        Raises:
+        - AnonymizerError: If the server can't anonymize the file.
+        - ConnectionError: If the connection fails.
+        - asyncio.TimeoutError: If the request takes longer than the timeout.
+        """
+
+        return await self.request(self.do_anonymize, keyword, fileName)
+
+    async def close(self):
+
+        """
+        Close the idle connections; those in use are closed when their request ends.
+        """
+
+        self.closed = True
+        while self.idle:
+            self.idle.pop().close()
+
+    async def request(self, operation, *args):
+
+        """
+        Run operation(connection, *args) on a pooled connection, within the timeout.
+        """
+
+        if self.closed:
+            raise RuntimeError('Client is closed')
+        return await asyncio.wait_for(self.run(operation, *args), self.timeout)
+
+    async def run(self, operation, *args):
+
+        # created here rather than in __init__, so that it belongs to the running event loop
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.connections)
+
+        async with self.slots:
+            # an idle connection may have been closed by the server since its last use: one
+            # already at EOF is dropped, and a request that fails on a reused connection before
+            # any of the reply has arrived is retried once, on a new connection
+            while self.idle:
+                connection = self.idle.pop()
+                if connection.reader.at_eof():
+                    connection.close()
+                    continue
+                try:
+                    return await self.attempt(connection, operation, *args)
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    if connection.answered:
+                        raise
+                break
+
+            reader, writer = await asyncio.open_connection(self.host, self.port)
+            return await self.attempt(Connection(reader, writer), operation, *args)
+
+    async def attempt(self, connection, operation, *args):
+
+        """
+        Run one request on a connection, and put the connection back in the pool only if
+        the request ended with the connection in a known state.
+        """
+
+        reusable = False
+        connection.answered = False
+        try:
+            result = await operation(connection, *args)
+            reusable = True
+            return result
+        except AnonymizerError:
+            reusable = True
+            raise
+        finally:
+            if reusable and not self.closed:
+                self.idle.append(connection)
+            else:
+                connection.close()
+
+    async def do_put(self, connection, filePath, fileName):
+        with open(filePath, 'rb') as fp:
+            num_bytes = os.fstat(fp.fileno()).st_size
+            connection.send('fput', fileName, num_bytes)
+            remaining = num_bytes
+            while remaining:
+                data = fp.read(min(READ_SIZE, remaining))
+                if not data:
+                    raise OSError('File ' + filePath + ' shrank during the upload')
+                connection.writer.write(data)
+                await connection.writer.drain()
+                remaining -= len(data)
+        return int(await connection.reply())
+
+    async def do_get(self, connection, fileName, filePath):
+        connection.send('fget', fileName)
+        num_bytes = int(await connection.reply())
+        with open(filePath, 'wb') as fp:
+            remaining = num_bytes
+            while remaining:
+                data = await connection.reader.read(min(READ_SIZE, remaining))
+                if not data:
+                    raise ConnectionError('Server closed the connection during the download.')
+                fp.write(data)
+                remaining -= len(data)
+        return num_bytes
+
+    async def do_anonymize(self, connection, keyword, fileName):
+        connection.send('fkeyword', keyword, fileName)
+        return (await connection.reply()).decode(ENCODING)
@@ -2,6 +2,9 @@ import os.path
 import socket
 import sys
 
+from delta import chunk_file, pack_signatures, recv_exact
+from parallel import TransferError, pread, preallocate, recv_field, recv_range, run_streams, send_range, split_ranges
+
 
 def validate_args():
     """
@@ -85,6 +88,212 @@ def receive_file(clientSocket, filePath):
     print 'File', fileName, 'downloaded.'
 
 
+def send_stream(serverIP, serverPort, token, filePath, offset, length):
+
+    """
+    Opens one stream of a parallel upload and sends its byte range.
+
+    Parameters:
+    - serverIP (str): The address of the server.
+    - serverPort (int): The port number of the server.
+    - token (str): The token of the transfer, sent by the server.
+    - filePath (str): The path to the file to be sent.
+    - offset (int): The first byte of the range.
+    - length (int): The number of bytes in the range.
+    """
+
+    streamSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        streamSocket.connect((serverIP, serverPort))
+        streamSocket.sendall(token + ':' + str(offset) + ':' + str(length) + b'\0')
+        send_range(streamSocket, filePath, offset, length)
+    finally:
+        streamSocket.close()
+
+
+def send_file_parallel(clientSocket, serverIP, serverPort, filePath, streams):
+
+    """
+    Sends a file to the server over several parallel TCP connections.
+
+    The file is split into one byte range per stream, and the server writes each
+    range at its offset in a preallocated file.
+
+    Parameters:
+    - clientSocket (socket): The client TCP socket to communicate with the server.
+    - serverIP (str): The address of the server.
+    - serverPort (int): The port number of the server.
+    - filePath (str): The path to the file to be sent.
+    - streams (int): The number of parallel streams to use.
+
+    Raises:
+    - TransferError: If one of the streams fails.
+    """
+
+    try:
+        num_bytes = os.path.getsize(filePath)
+    except OSError as e:
+        print 'Error: Unable to open file', filePath, ':', e
+        sys.exit(1)
+
+    # send file name, size and number of streams, wait for the server to preallocate the file
+    clientSocket.send('pput')
+    clientSocket.send(os.path.basename(filePath).encode())
+    clientSocket.send(b'\0')
+    clientSocket.send(str(num_bytes))
+    clientSocket.send(b'\0')
+    clientSocket.send(str(streams))
+    clientSocket.send(b'\0')
+
+    # "READY:Token", the token goes in the header of every stream
+    fields = recv_field(clientSocket).split(':')
+    if len(fields) != 2 or fields[0] != 'READY':
+        print 'Error: Expected READY message \'READY:Token\', received', ':'.join(fields)
+        sys.exit(1)
+    token = fields[1]
+
+    jobs = [(serverIP, serverPort, token, filePath, offset, length)
+            for offset, length in split_ranges(num_bytes, streams)]
+    try:
+        run_streams(send_stream, jobs)
+    except TransferError as e:
+        print e
+        sys.exit(1)
+
+
+def send_file_delta(clientSocket, filePath):
+
+    """
+    Sends a file to the server, skipping the chunks the server already has.
+
+    The file is split into content-defined chunks and their signatures are sent first.
+    The server answers which chunks it is missing, and only those are sent, so uploading
+    a slightly modified file costs bandwidth proportional to the change.
+
+    Parameters:
+    - clientSocket (socket): The client TCP socket to communicate with the server.
+    - filePath (str): The path to the file to be sent.
+
+    Raises:
+    - IOError: If there is an error opening or reading the file.
+    - TransferError: If the connection closes early.
+    """
+
+    try:
+        chunks = chunk_file(filePath)
+    except IOError as e:
+        print 'Error: Unable to open file', filePath, ':', e
+        sys.exit(1)
+
+    # send file name and chunk signatures
+    clientSocket.send('sput')
+    clientSocket.send(os.path.basename(filePath).encode())
+    clientSocket.send(b'\0')
+    clientSocket.send(str(len(chunks)))
+    clientSocket.send(b'\0')
+    clientSocket.sendall(pack_signatures(chunks))
+
+    # server answers '1' for each chunk it has, '0' for each chunk to send
+    try:
+        have = recv_exact(clientSocket, len(chunks))
+        sent = 0
+        fd = os.open(filePath, os.O_RDONLY)
+        try:
+            for (offset, length, digest), flag in zip(chunks, have):
+                if flag == '0':
+                    clientSocket.sendall(pread(fd, length, offset))
+                    sent += length
+        finally:
+            os.close(fd)
+    except TransferError as e:
+        print e
+        sys.exit(1)
+
+    print 'Sent', sent, 'of', sum(length for offset, length, digest in chunks), 'bytes.'
+
+
+def receive_stream(serverIP, serverPort, token, fileName, offset, length):
+
+    """
+    Opens one stream of a parallel download and receives its byte range.
+
+    Parameters:
+    - serverIP (str): The address of the server.
+    - serverPort (int): The port number of the server.
+    - token (str): The token of the transfer, sent by the server.
+    - fileName (str): The name of the preallocated file.
+    - offset (int): The first byte of the range.
+    - length (int): The number of bytes in the range.
+    """
+
+    streamSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        streamSocket.connect((serverIP, serverPort))
+        streamSocket.sendall(token + ':' + str(offset) + ':' + str(length) + b'\0')
+        recv_range(streamSocket, fileName, offset, length)
+    finally:
+        streamSocket.close()
+
+
+def receive_file_parallel(clientSocket, serverIP, serverPort, filePath, streams):
+
+    """
+    Receives a file from the server over several parallel TCP connections.
+
+    Parameters:
+    - clientSocket (socket): The client TCP socket to communicate with the server.
+    - serverIP (str): The address of the server.
+    - serverPort (int): The port number of the server.
+    - filePath (str): The path to the file on the server.
+    - streams (int): The number of parallel streams to use.
+
+    Raises:
+    - IOError: If there is an error opening or writing to the file.
+    - TransferError: If one of the streams fails.
+    """
+
+    # get file name from file path
+    fileName = os.path.basename(filePath)
+
+    clientSocket.send('pget')
+    clientSocket.send(filePath)
+    clientSocket.send(b'\0')
+    clientSocket.send(str(streams))
+    clientSocket.send(b'\0')
+
+    # server answers with "LEN:Bytes:Token", or "LEN:-1" if it could not find the file
+    fields = recv_field(clientSocket).split(':')
+    if fields == ['LEN', '-1']:
+        print 'Server could not find file', filePath
+        sys.exit(1)
+    try:
+        if len(fields) != 3 or fields[0] != 'LEN':
+            raise ValueError
+        num_bytes = int(fields[1])
+        if num_bytes < 0:
+            raise ValueError
+    except ValueError:
+        print 'Error: Expected LEN message \'LEN:Bytes:Token\', received', ':'.join(fields)
+        sys.exit(1)
+    token = fields[2]
+
+    try:
+        preallocate(fileName, num_bytes)
+    except IOError as e:
+        print 'Error: Unable to open file ', fileName, ': ', e
+        sys.exit(1)
+
+    jobs = [(serverIP, serverPort, token, fileName, offset, length)
+            for offset, length in split_ranges(num_bytes, streams)]
+    try:
+        run_streams(receive_stream, jobs)
+    except TransferError as e:
+        print e
+        sys.exit(1)
+
+    print 'File', fileName, 'downloaded.'
+
+
 def main():
 
     """
@@ -111,60 +320,128 @@ def main():
         if command[0] == "put":
 
             # validate args
-            if len(command) != 2:
-                print 'Usage: put <file>'
+            if len(command) not in (2, 3) or (len(command) == 3 and not command[2].isdigit()):
+                print 'Usage: put <file> [<streams>]'
                 sys.exit(1)
 
             # get raw file path and file name
             filePath = r'' + command[1]
             fileName = os.path.basename(filePath)
 
-            # send info to server, then call send_file()
-            clientSocket.send('put')
-            clientSocket.send(fileName.encode())
-            clientSocket.send(b'\0')
-            send_file(clientSocket, filePath)
+            if len(command) == 3 and int(command[2]) > 1:
+
+                # split the file across parallel connections
+                send_file_parallel(clientSocket, serverIP, serverPort, filePath, int(command[2]))
+
+            else:
+
+                # send info to server, then call send_file()
+                clientSocket.send('put')
+                clientSocket.send(fileName.encode())
+                clientSocket.send(b'\0')
+                send_file(clientSocket, filePath)
 
             # get server response
             print 'Awaiting server response.'
             serverResponse = clientSocket.recv(1024)
             print 'Server response:', serverResponse
 
-        elif command[0] == "get":
+        elif command[0] == "sync":
 
             # validate args
             if len(command) != 2:
-                print 'Usage: get <file>'
+                print 'Usage: sync <file>'
+                sys.exit(1)
+
+            # send only the chunks of the file that the server does not have
+            send_file_delta(clientSocket, r'' + command[1])
+
+            # get server response
+            print 'Awaiting server response.'
+            serverResponse = clientSocket.recv(1024)
+            print 'Server response:', serverResponse
+
+        elif command[0] == "get":
+
+            # validate args
+            if len(command) not in (2, 3) or (len(command) == 3 and not command[2].isdigit()):
+                print 'Usage: get <file> [<streams>]'
                 sys.exit(1)
 
             fileName = command[1]
 
-            # send info to server, then call receive_file()
-            clientSocket.send('get')
-            clientSocket.send(fileName)
-            receive_file(clientSocket, fileName)
+            if len(command) == 3 and int(command[2]) > 1:
+
+                # split the file across parallel connections
+                receive_file_parallel(clientSocket, serverIP, serverPort, fileName, int(command[2]))
+
+            else:
+
+                # send info to server, then call receive_file()
+                clientSocket.send('get')
+                clientSocket.send(fileName)
+                receive_file(clientSocket, fileName)
 
         elif command[0] == "keyword":
 
             # validate args
-            if len(command) != 3:
-                print 'Usage: keyword <word> <file>'
+            if len(command) not in (3, 4, 5) or (len(command) > 3 and command[3] != 'async'):
+                print 'Usage: keyword <word> <file> [async [<priority>]]'
                 sys.exit(1)
 
             keyword = command[1]
             fileName = command[2]
 
-            # send info to server
-            clientSocket.send('keyword')
-            clientSocket.send(keyword)
-            clientSocket.send(b'\0')
-            clientSocket.send(fileName)
+            if len(command) > 3:
+
+                # queue the job on the server, the response is its job ID
+                priority = command[4] if len(command) == 5 else 'normal'
+                clientSocket.send('submit')
+                clientSocket.sendall(keyword + b'\0' + fileName + b'\0' + priority + b'\0')
+
+            else:
+
+                # send info to server
+                clientSocket.send('keyword')
+                clientSocket.send(keyword)
+                clientSocket.send(b'\0')
+                clientSocket.send(fileName)
 
             # get server response
             print 'Awaiting server response.'
             serverResponse = clientSocket.recv(1024)
             print 'Server response:', serverResponse.decode()
 
+        elif command[0] in ("status", "wait"):
+
+            # validate args
+            if len(command) != 2:
+                print 'Usage:', command[0], '<job>'
+                sys.exit(1)
+
+            # ask for the status of a queued keyword job, wait blocks until it has finished
+            clientSocket.send(command[0])
+            clientSocket.sendall(command[1] + b'\0')
+
+            # get server response
+            serverResponse = clientSocket.recv(1024)
+            print 'Server response:', serverResponse
+
+        elif command[0] == "profile":
+
+            # validate args
+            if len(command) != 2:
+                print 'Usage: profile start|stop|dump|status'
+                sys.exit(1)
+
+            # switch profiling of the server on or off, or write what it has recorded so far
+            clientSocket.send('profile')
+            clientSocket.sendall(command[1] + b'\0')
+
+            # get server response
+            serverResponse = clientSocket.recv(1024)
+            print 'Server response:', serverResponse
+
         elif command[0] == "quit":
             print 'Exiting program!'
             clientSocket.send('quit')
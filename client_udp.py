@@ -2,6 +2,10 @@ import os
 import socket
 import sys
 
+from congestion import controller_name, new_controller, transfer_limit
+from parallel import TransferError, preallocate, run_streams, send_range_udp, recv_range_udp, split_ranges
+from window import recv_range_window, send_range_window
+
 
 def validate_args():
     """
@@ -33,6 +37,7 @@ def send_file(clientSocket, serverIP, serverPort, filePath):
     Send a file over a UDP connection to a specified server.
 
     Implements "stop-and-wait" functionality, i.e. after each chunk is sent, client waits for an ACK from the server.
+    When ANON_UDP_CC selects a congestion controller, the file is sent with a sliding window instead.
 
     Parameters:
     - clientSocket (socket.socket): The client UDP socket to communicate with the server.
@@ -44,6 +49,11 @@ def send_file(clientSocket, serverIP, serverPort, filePath):
     - IOError: If the file specified by filePath can't be opened.
     - socket.timeout: If an ACK message is not received within 1 second after sending a chunk.
     """
+
+    controller = new_controller()
+    if controller is not None:
+        send_file_window(clientSocket, serverIP, serverPort, filePath, controller)
+        return
     # try to open the file for reading
     try:
         with open(filePath, 'rb') as fp:
@@ -97,13 +107,49 @@ def send_file(clientSocket, serverIP, serverPort, filePath):
         print 'Error: Expected FIN message, received:', fin_msg
 
 
+def send_file_window(clientSocket, serverIP, serverPort, filePath, controller):
+
+    """
+    Send a file to the server with a sliding window paced by controller (see window.py).
+
+    The length is announced as "WLEN:Bytes" so the server switches to the windowed receiver.
+
+    Raises:
+    - TransferError: If no chunk is acknowledged for window.IDLE_TIMEOUT seconds.
+    """
+
+    num_bytes = os.path.getsize(filePath)
+    clientSocket.sendto('WLEN:' + str(num_bytes), (serverIP, serverPort))
+    if num_bytes == 0:
+        print 'Length of data cannot be 0.'
+        sys.exit(1)
+
+    try:
+        send_range_window(clientSocket, (serverIP, serverPort), filePath, 0, num_bytes, controller,
+                          transfer_limit())
+    except TransferError as e:
+        print e
+        sys.exit(1)
+
+    # get server response, skipping the extra copies of FIN and late ACKs
+    print 'Awaiting server response.'
+    clientSocket.settimeout(None)
+    serverResponse, serverAddress = clientSocket.recvfrom(1024)
+    while serverResponse == 'FIN' or serverResponse.startswith('ACK:'):
+        serverResponse, serverAddress = clientSocket.recvfrom(1024)
+    print 'Server response:', serverResponse
+
+    clientSocket.close()
+
+
 def receive_file(clientSocket, serverIP, filePath):
 
     """
     Receive a file over a UDP connection from a specified server.
 
     Implements "stop-and-wait" functionality, i.e. after each chunk is received,
-    sends ACK to server before receiving next chunk.
+    sends ACK to server before receiving next chunk. A server with congestion control
+    sends 'WLEN:' instead of 'LEN:' and the file is received with a sliding window.
 
     Parameters:
     - clientSocket (socket.socket): The client UDP socket to communicate with the server.
@@ -111,7 +157,7 @@ def receive_file(clientSocket, serverIP, filePath):
     - filePath (str): The path where the received file will be saved.
 
     Raises:
-    - Error: If the length message does not start with 'LEN:'.
+    - Error: If the length message does not start with 'LEN:' or 'WLEN:'.
     - ValueError: If the substring after 'LEN:' cannot be converted to an integer.
     - IOError: If there is an error while writing the received file to the disk.
     - socket.timeout: If no data is received within 1 second after sending LEN message,
@@ -124,9 +170,9 @@ def receive_file(clientSocket, serverIP, filePath):
     # first get length of data to be transferred
     len_msg, serverIP = clientSocket.recvfrom(1024)
 
-    # check length message for string "LEN:Bytes"
-    if len_msg.startswith('LEN:'):
-        str_bytes = len_msg[4:]
+    # check length message for string "LEN:Bytes" or "WLEN:Bytes"
+    if len_msg.startswith('LEN:') or len_msg.startswith('WLEN:'):
+        str_bytes = len_msg.split(':', 1)[1]
         try:
             # convert substring to int
             num_bytes = int(str_bytes)
@@ -141,6 +187,20 @@ def receive_file(clientSocket, serverIP, filePath):
         print 'Error: Expected LEN message \'LEN:Bytes\', received', len
         sys.exit(1)
 
+    if len_msg.startswith('WLEN:'):
+        try:
+            preallocate(fileName, num_bytes)
+            recv_range_window(clientSocket, serverIP, fileName, 0, num_bytes)
+        except TransferError as e:
+            print e
+            sys.exit(1)
+        except (IOError, OSError) as e:
+            print 'Error: Unable to open file ', fileName, ': ', e
+            sys.exit(1)
+
+        print 'File', fileName, 'downloaded.'
+        return
+
     data_chunks = []
     ack_msg = 'ACK'
 
@@ -191,6 +251,175 @@ def receive_file(clientSocket, serverIP, filePath):
     print 'File', fileName, 'downloaded.'
 
 
+def parse_ports(ports_msg):
+
+    """
+    Parses the "PORTS:p1,p2,..." message listing the server port of each flow.
+
+    Returns:
+    - list: The port numbers, in byte range order.
+    """
+
+    if not ports_msg.startswith('PORTS:'):
+        print 'Error: Expected PORTS message \'PORTS:Ports\', received', ports_msg
+        sys.exit(1)
+    if not ports_msg[6:]:
+        return []
+    return [int(port) for port in ports_msg[6:].split(',')]
+
+
+def send_flow(serverIP, flowPort, filePath, offset, length, limit):
+
+    """
+    Opens one UDP flow of a parallel upload and sends its byte range.
+
+    With congestion control enabled the flow is opened with "WRANGE:" and has its own
+    controller, while limit (None without ANON_UDP_RATE) is shared by all the flows.
+    """
+
+    flowSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        controller = new_controller()
+        if controller is not None:
+            flowSocket.sendto('WRANGE:' + str(offset) + ':' + str(length), (serverIP, flowPort))
+            send_range_window(flowSocket, (serverIP, flowPort), filePath, offset, length, controller, limit)
+        else:
+            flowSocket.sendto('RANGE:' + str(offset) + ':' + str(length), (serverIP, flowPort))
+            send_range_udp(flowSocket, (serverIP, flowPort), filePath, offset, length)
+    finally:
+        flowSocket.close()
+
+
+def send_file_parallel(clientSocket, serverIP, serverPort, filePath, streams):
+
+    """
+    Send a file to the server over several parallel UDP flows.
+
+    The file is split into one byte range per flow. Each flow uses "stop-and-wait"
+    reliability and the server writes each range at its offset.
+
+    Parameters:
+    - clientSocket (socket.socket): The client UDP socket to communicate with the server.
+    - serverIP (str): The address of the server.
+    - serverPort (int): The port number of the server.
+    - filePath (str): The path of the file to be sent.
+    - streams (int): The number of parallel flows to use.
+
+    Raises:
+    - TransferError: If one of the flows fails.
+    """
+
+    num_bytes = os.path.getsize(filePath)
+    if num_bytes == 0:
+        print 'Length of data cannot be 0.'
+        sys.exit(1)
+
+    # send file name, size and number of flows, get the port of each flow
+    clientSocket.sendto('pput', (serverIP, serverPort))
+    clientSocket.sendto(os.path.basename(filePath).encode(), (serverIP, serverPort))
+    clientSocket.sendto(str(num_bytes) + ':' + str(streams), (serverIP, serverPort))
+    ports_msg, serverAddress = clientSocket.recvfrom(1024)
+    ports = parse_ports(ports_msg)
+
+    limit = transfer_limit()
+    jobs = [(serverIP, port, filePath, offset, length, limit)
+            for port, (offset, length) in zip(ports, split_ranges(num_bytes, streams))]
+    try:
+        run_streams(send_flow, jobs)
+    except TransferError as e:
+        print e
+        sys.exit(1)
+
+    # get server response
+    print 'Awaiting server response.'
+    serverResponse, serverAddress = clientSocket.recvfrom(1024)
+    print 'Server response:', serverResponse
+
+    clientSocket.close()
+
+
+def receive_flow(serverIP, flowPort, fileName, offset, length, windowed):
+
+    """
+    Opens one UDP flow of a parallel download and receives its byte range.
+    """
+
+    flowSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        flowSocket.sendto('RANGE:' + str(offset) + ':' + str(length), (serverIP, flowPort))
+        if windowed:
+            recv_range_window(flowSocket, (serverIP, flowPort), fileName, offset, length)
+        else:
+            recv_range_udp(flowSocket, (serverIP, flowPort), fileName, offset, length)
+    finally:
+        flowSocket.close()
+
+
+def receive_file_parallel(clientSocket, serverIP, serverPort, filePath, streams):
+
+    """
+    Receive a file from the server over several parallel UDP flows.
+
+    Parameters:
+    - clientSocket (socket.socket): The client UDP socket to communicate with the server.
+    - serverIP (str): The address of the server.
+    - serverPort (int): The port number of the server.
+    - filePath (str): The path of the file on the server.
+    - streams (int): The number of parallel flows to use.
+
+    Raises:
+    - IOError: If there is an error while creating the file.
+    - TransferError: If one of the flows fails.
+    """
+
+    # get file name from file path
+    fileName = os.path.basename(filePath)
+
+    clientSocket.sendto('pget', (serverIP, serverPort))
+    clientSocket.sendto(filePath, (serverIP, serverPort))
+    clientSocket.sendto(str(streams), (serverIP, serverPort))
+
+    # server answers with the file size, -1 if it could not find the file,
+    # as "WLEN:Bytes" if it sends with a sliding window
+    len_msg, serverAddress = clientSocket.recvfrom(1024)
+    if not len_msg.startswith('LEN:') and not len_msg.startswith('WLEN:'):
+        print 'Error: Expected LEN message \'LEN:Bytes\', received', len_msg
+        sys.exit(1)
+    windowed = len_msg.startswith('WLEN:')
+    try:
+        num_bytes = int(len_msg.split(':', 1)[1])
+    except ValueError:
+        print 'Invalid number of bytes:', len_msg.split(':', 1)[1]
+        sys.exit(1)
+    if num_bytes < 0:
+        print 'Server could not find file', filePath
+        sys.exit(1)
+
+    try:
+        preallocate(fileName, num_bytes)
+    except IOError as e:
+        print 'Error: Unable to open file ', fileName, ': ', e
+        sys.exit(1)
+
+    # the server opens no flows for an empty file
+    if num_bytes == 0:
+        print 'File', fileName, 'downloaded.'
+        return
+
+    ports_msg, serverAddress = clientSocket.recvfrom(1024)
+    ports = parse_ports(ports_msg)
+
+    jobs = [(serverIP, port, fileName, offset, length, windowed)
+            for port, (offset, length) in zip(ports, split_ranges(num_bytes, streams))]
+    try:
+        run_streams(receive_flow, jobs)
+    except TransferError as e:
+        print e
+        sys.exit(1)
+
+    print 'File', fileName, 'downloaded.'
+
+
 def main():
 
     """
@@ -200,6 +429,13 @@ def main():
     # validate command line arguments
     serverIP, serverPort = validate_args()
 
+    # fail early on an unknown ANON_UDP_CC
+    try:
+        controller_name()
+    except ValueError as e:
+        print 'Error:', e
+        sys.exit(1)
+
     while 1:
 
         # create socket
@@ -213,8 +449,8 @@ def main():
         if command[0] == "put":
 
             # validate args
-            if len(command) != 2:
-                print 'Usage: put <file>'
+            if len(command) not in (2, 3) or (len(command) == 3 and not command[2].isdigit()):
+                print 'Usage: put <file> [<streams>]'
                 sys.exit(1)
 
             # get raw file path and file name
@@ -225,52 +461,111 @@ def main():
                 print 'File', filePath, 'does not exist.'
                 sys.exit(1)
 
-            # send info to server, then call send_file
-            clientSocket.sendto('put', (serverIP, serverPort))
-            clientSocket.sendto(fileName.encode(), (serverIP, serverPort))
-            send_file(clientSocket, serverIP, serverPort, filePath)
+            if len(command) == 3 and int(command[2]) > 1:
+
+                # split the file across parallel flows
+                send_file_parallel(clientSocket, serverIP, serverPort, filePath, int(command[2]))
+
+            else:
+
+                # send info to server, then call send_file
+                clientSocket.sendto('put', (serverIP, serverPort))
+                clientSocket.sendto(fileName.encode(), (serverIP, serverPort))
+                send_file(clientSocket, serverIP, serverPort, filePath)
 
         elif command[0] == "get":
 
             # validate args
-            if len(command) != 2:
-                print 'Usage: get <file>'
+            if len(command) not in (2, 3) or (len(command) == 3 and not command[2].isdigit()):
+                print 'Usage: get <file> [<streams>]'
                 sys.exit(1)
 
             filePath = command[1]
 
-            # send command and corresponding arguments to the server
-            clientSocket.sendto('get', (serverIP, serverPort))
-            clientSocket.sendto(filePath, (serverIP, serverPort))
+            if len(command) == 3 and int(command[2]) > 1:
+
+                # split the file across parallel flows
+                receive_file_parallel(clientSocket, serverIP, serverPort, filePath, int(command[2]))
 
-            # check to make sure file exists at the server
-            server_file_exists, (serverIP, serverPort) = clientSocket.recvfrom(1024)
-            print 'server file exists:', server_file_exists
-            if server_file_exists == 'True':
-                receive_file(clientSocket, serverIP, filePath)
             else:
-                print 'Server could not find file', filePath
-                sys.exit(1)
+
+                # send command and corresponding arguments to the server
+                clientSocket.sendto('get', (serverIP, serverPort))
+                clientSocket.sendto(filePath, (serverIP, serverPort))
+
+                # check to make sure file exists at the server
+                server_file_exists, (serverIP, serverPort) = clientSocket.recvfrom(1024)
+                print 'server file exists:', server_file_exists
+                if server_file_exists == 'True':
+                    receive_file(clientSocket, serverIP, filePath)
+                else:
+                    print 'Server could not find file', filePath
+                    sys.exit(1)
 
         elif command[0] == "keyword":
 
             # validate args
-            if len(command) != 3:
-                print 'Usage: keyword <word> <file>'
+            if len(command) not in (3, 4, 5) or (len(command) > 3 and command[3] != 'async'):
+                print 'Usage: keyword <word> <file> [async [<priority>]]'
                 sys.exit(1)
 
             keyword = command[1]
             filePath = command[2]
 
-            # send command and corresponding arguments to the server
-            clientSocket.sendto('keyword', (serverIP, serverPort))
-            clientSocket.sendto(keyword, (serverIP, serverPort))
-            clientSocket.sendto(filePath, (serverIP, serverPort))
+            if len(command) > 3:
+
+                # queue the job on the server, the response is its job ID
+                priority = command[4] if len(command) == 5 else 'normal'
+                clientSocket.sendto('submit', (serverIP, serverPort))
+                clientSocket.sendto(keyword, (serverIP, serverPort))
+                clientSocket.sendto(filePath, (serverIP, serverPort))
+                clientSocket.sendto(priority, (serverIP, serverPort))
+
+            else:
+
+                # send command and corresponding arguments to the server
+                clientSocket.sendto('keyword', (serverIP, serverPort))
+                clientSocket.sendto(keyword, (serverIP, serverPort))
+                clientSocket.sendto(filePath, (serverIP, serverPort))
 
             print 'Awaiting server response.'
             serverResponse, (serverIP, serverPort) = clientSocket.recvfrom(1024)
             print 'Server response:', serverResponse
 
+        elif command[0] in ("status", "wait"):
+
+            # validate args
+            if len(command) != 2:
+                print 'Usage:', command[0], '<job>'
+                sys.exit(1)
+
+            # ask for the status of a queued keyword job, wait blocks until it has finished: the
+            # server answers a wait within a second, so it is repeated while the job is unfinished
+            while 1:
+                clientSocket.sendto(command[0], (serverIP, serverPort))
+                clientSocket.sendto(command[1], (serverIP, serverPort))
+
+                serverResponse, (serverIP, serverPort) = clientSocket.recvfrom(1024)
+                status = serverResponse.split(' ')[2:3]
+                if command[0] == 'status' or status not in (['queued,'], ['running']):
+                    break
+
+            print 'Server response:', serverResponse
+
+        elif command[0] == "profile":
+
+            # validate args
+            if len(command) != 2:
+                print 'Usage: profile start|stop|dump|status'
+                sys.exit(1)
+
+            # switch profiling of the server on or off, or write what it has recorded so far
+            clientSocket.sendto('profile', (serverIP, serverPort))
+            clientSocket.sendto(command[1], (serverIP, serverPort))
+
+            serverResponse, (serverIP, serverPort) = clientSocket.recvfrom(1024)
+            print 'Server response:', serverResponse
+
         elif command[0] == "quit":
 
             # exit the program and send quit command to server so the server will also exit
@@ -0,0 +1,244 @@
+import os
+import threading
+import time
+
+
+# RTO bounds in seconds; a transfer still gives up after window.IDLE_TIMEOUT seconds
+# (5 by default) without progress
+MIN_RTO = 0.01
+MAX_RTO = 1.0
+INITIAL_RTO = 0.2
+
+# pacing sends at this multiple of cwnd / srtt, so the window can still grow
+PACING_GAIN = 1.25
+
+# packets that may be sent back to back by the pacer
+PACING_BURST = 10
+
+# bytes that may be sent back to back under a per-transfer rate limit
+LIMIT_BURST = 16384
+
+
+class RttEstimator(object):
+
+    """
+    Smoothed RTT and retransmission timeout, as in RFC 6298.
+    """
+
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = None
+        self.rto = INITIAL_RTO
+
+    def sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(MAX_RTO, max(MIN_RTO, self.srtt + 4 * self.rttvar))
+
+    def backoff(self):
+        self.rto = min(MAX_RTO, self.rto * 2)
+
+
+class NewReno(object):
+
+    """
+    Loss-based AIMD congestion control.
+
+    The window (in packets) doubles every RTT in slow start and grows by one packet per RTT
+    afterwards. A fast retransmit halves it, a timeout resets it to one packet.
+    """
+
+    name = 'newreno'
+
+    def __init__(self, initial_window=4, max_window=4096):
+        self.cwnd = float(initial_window)
+        self.ssthresh = float(max_window)
+        self.max_window = max_window
+
+    def on_ack(self, acked, rtt):
+
+        """
+        Called when acked new packets are acknowledged; rtt is an RTT sample or None.
+        """
+
+        if self.cwnd < self.ssthresh:
+            self.cwnd += acked
+        else:
+            self.cwnd += float(acked) / self.cwnd
+        self.cwnd = min(self.cwnd, self.max_window)
+
+    def on_loss(self):
+
+        """
+        Called on a fast retransmit (three duplicate ACKs).
+        """
+
+        self.ssthresh = max(self.cwnd / 2, 2.0)
+        self.cwnd = self.ssthresh
+
+    def on_timeout(self):
+
+        """
+        Called when the retransmission timer expires.
+        """
+
+        self.ssthresh = max(self.cwnd / 2, 2.0)
+        self.cwnd = 1.0
+
+
+class Vegas(NewReno):
+
+    """
+    Delay-based congestion control in the style of TCP Vegas.
+
+    The number of packets queued in the network is estimated from the difference between
+    the expected (cwnd / base RTT) and the actual (cwnd / RTT) rate. The window grows while
+    fewer than alpha packets are queued, shrinks when more than beta are, and leaves slow
+    start as soon as a queue starts to build. Losses are handled like NewReno.
+    """
+
+    name = 'vegas'
+
+    alpha = 2.0
+    beta = 4.0
+
+    def __init__(self, initial_window=4, max_window=4096):
+        NewReno.__init__(self, initial_window, max_window)
+        self.base_rtt = None
+
+    def on_ack(self, acked, rtt):
+        if rtt is None:
+            NewReno.on_ack(self, acked, rtt)
+            return
+
+        self.base_rtt = rtt if self.base_rtt is None else min(self.base_rtt, rtt)
+        queued = self.cwnd * (1 - self.base_rtt / rtt) if rtt > 0 else 0.0
+
+        if self.cwnd < self.ssthresh:
+            if queued > 1:
+                self.ssthresh = self.cwnd
+            else:
+                self.cwnd += acked
+        elif queued < self.alpha:
+            self.cwnd += float(acked) / self.cwnd
+        elif queued > self.beta:
+            self.cwnd = max(2.0, self.cwnd - float(acked) / self.cwnd)
+        self.cwnd = min(self.cwnd, self.max_window)
+
+
+CONTROLLERS = {
+    'newreno': NewReno,
+    'vegas': Vegas,
+}
+
+
+class TokenBucket(object):
+
+    """
+    Limits a rate in bytes per second, allowing bursts of up to burst bytes.
+
+    Thread-safe, so one bucket can be shared by all the flows of a transfer.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.stamp = time.time()
+        self.lock = threading.Lock()
+
+    def consume(self, amount):
+
+        """
+        Take amount bytes from the bucket, sleeping until they are available.
+        """
+
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+class Pacer(object):
+
+    """
+    Spaces out the packets of one flow.
+
+    Packets leave at PACING_GAIN * cwnd / srtt, and never faster than the optional limit,
+    a TokenBucket that may be shared with the other flows of the same transfer.
+    """
+
+    def __init__(self, packet_size, limit=None):
+        self.packet_size = packet_size
+        self.bucket = None
+        self.limit = limit
+
+    def update(self, cwnd, srtt):
+
+        """
+        Recompute the pacing rate after an RTT sample.
+        """
+
+        if not srtt:
+            return
+        rate = PACING_GAIN * cwnd * self.packet_size / srtt
+        if self.bucket is None:
+            self.bucket = TokenBucket(rate, PACING_BURST * self.packet_size)
+        else:
+            with self.bucket.lock:
+                self.bucket.rate = rate
+
+    def wait(self, amount):
+
+        """
+        Block until amount bytes may be sent.
+        """
+
+        if self.bucket is not None:
+            self.bucket.consume(amount)
+        if self.limit is not None:
+            self.limit.consume(amount)
+
+
+def controller_name():
+
+    """
+    The congestion controller selected with ANON_UDP_CC, or None for stop-and-wait.
+    """
+
+    name = os.environ.get('ANON_UDP_CC', '').lower()
+    if name and name not in CONTROLLERS:
+        raise ValueError('Unknown congestion controller ' + name + ', expected one of ' +
+                         ', '.join(sorted(CONTROLLERS)))
+    return name or None
+
+
+def new_controller():
+
+    """
+    A fresh controller of the kind selected with ANON_UDP_CC, or None for stop-and-wait.
+    """
+
+    name = controller_name()
+    return CONTROLLERS[name]() if name else None
+
+
+def transfer_limit():
+
+    """
+    A TokenBucket for the per-transfer rate limit ANON_UDP_RATE (bytes per second),
+    or None when there is no limit.
+    """
+
+    rate = float(os.environ.get('ANON_UDP_RATE', '0'))
+    if rate <= 0:
+        return None
+    return TokenBucket(rate, LIMIT_BURST)
@@ -0,0 +1,195 @@
+import collections
+import hashlib
+import os
+import struct
+import threading
+
+from parallel import TransferError
+
+
+# content-defined chunk sizes: a boundary is cut where the rolling hash matches
+# BOUNDARY_MASK, which happens on average every AVG_CHUNK bytes
+MIN_CHUNK = 2048
+AVG_CHUNK = 8192
+MAX_CHUNK = 65536
+
+# the top 13 bits of the gear hash, i.e. one boundary every 2^13 = AVG_CHUNK bytes
+BOUNDARY_MASK = 0xFFF80000
+
+# the gear hash only depends on the last 32 bytes, so hashing can start this far before MIN_CHUNK
+WINDOW = 32
+
+# how much of the file is read at a time while chunking
+READ_SIZE = 1 << 20
+
+# one signature on the wire: SHA-1 digest of the chunk, then its length
+SIGNATURE = struct.Struct('!20sI')
+
+# one random 32-bit value per byte value, derived from MD5 so both sides always agree
+GEAR = [struct.unpack('!I', hashlib.md5(struct.pack('B', i)).digest()[:4])[0] for i in range(256)]
+
+# signatures of files already on disk, keyed by path: (mtime, size, chunks), least
+# recently used first; the server is long-running, so only the last few files are kept
+MAX_CACHED_FILES = 64
+_signature_cache = collections.OrderedDict()
+_signature_cache_lock = threading.Lock()
+
+
+def find_boundary(buf, start, end):
+
+    """
+    Find the end of the chunk starting at buf[start], cutting no later than end.
+
+    Uses a gear rolling hash: h = (h << 1) + GEAR[byte], and cuts after the first byte
+    (at least MIN_CHUNK into the chunk) where the top bits of h are all zero. Since the cut
+    depends only on the last WINDOW bytes, an insertion or deletion only moves the
+    boundaries around it and the following chunks keep the same content.
+
+    Parameters:
+    - buf (str): The data being chunked.
+    - start (int): The offset of the chunk in buf.
+    - end (int): The highest possible end of the chunk (start + MAX_CHUNK, or the end of data).
+
+    Returns:
+    - int: The offset in buf where the chunk ends.
+    """
+
+    if end - start <= MIN_CHUNK:
+        return end
+
+    # warm the hash up over the window that precedes the first possible cut
+    first = start + MIN_CHUNK
+    h = 0
+    for byte in bytearray(buf[first - WINDOW:first]):
+        h = ((h << 1) + GEAR[byte]) & 0xFFFFFFFF
+
+    # scan in AVG_CHUNK steps, most chunks end long before MAX_CHUNK
+    i = first
+    while i < end:
+        for byte in bytearray(buf[i:min(end, i + AVG_CHUNK)]):
+            h = ((h << 1) + GEAR[byte]) & 0xFFFFFFFF
+            i += 1
+            if not h & BOUNDARY_MASK:
+                return i
+
+    return end
+
+
+def chunk_file(filePath):
+
+    """
+    Split a file into content-defined chunks.
+
+    Parameters:
+    - filePath (str): The path of the file to chunk.
+
+    Returns:
+    - list: A list of (offset, length, digest) tuples, digest being the SHA-1 of the chunk.
+
+    Raises:
+    - IOError: If the file can't be opened or read.
+    """
+
+    chunks = []
+    offset = 0
+
+    with open(filePath, 'rb') as fp:
+        buf = b''
+        pos = 0
+        eof = False
+        while 1:
+            # keep at least one maximum-size chunk in the buffer
+            if not eof and len(buf) - pos < MAX_CHUNK:
+                data = fp.read(READ_SIZE)
+                if data:
+                    buf = buf[pos:] + data
+                    pos = 0
+                    continue
+                eof = True
+
+            if pos >= len(buf):
+                break
+
+            cut = find_boundary(buf, pos, min(len(buf), pos + MAX_CHUNK))
+            chunks.append((offset, cut - pos, hashlib.sha1(buf[pos:cut]).digest()))
+            offset += cut - pos
+            pos = cut
+
+    return chunks
+
+
+def file_signatures(filePath):
+
+    """
+    Chunk a file on the server, reusing the previous result if the file has not changed.
+
+    Returns:
+    - list: A list of (offset, length, digest) tuples, see chunk_file().
+    """
+
+    stat = os.stat(filePath)
+    with _signature_cache_lock:
+        cached = _signature_cache.pop(filePath, None)
+        if cached and cached[0] == stat.st_mtime and cached[1] == stat.st_size:
+            _signature_cache[filePath] = cached
+            return cached[2]
+
+    chunks = chunk_file(filePath)
+    remember_signatures(filePath, chunks)
+    return chunks
+
+
+def remember_signatures(filePath, chunks):
+
+    """
+    Cache the chunks of a file that was just written, so the next sync does not re-chunk it.
+
+    The least recently used file is dropped once MAX_CACHED_FILES are cached.
+    """
+
+    stat = os.stat(filePath)
+    with _signature_cache_lock:
+        _signature_cache.pop(filePath, None)
+        _signature_cache[filePath] = (stat.st_mtime, stat.st_size, chunks)
+        while len(_signature_cache) > MAX_CACHED_FILES:
+            _signature_cache.popitem(last=False)
+
+
+def pack_signatures(chunks):
+
+    """
+    Encode the (digest, length) of each chunk for the wire.
+    """
+
+    return b''.join(SIGNATURE.pack(digest, length) for offset, length, digest in chunks)
+
+
+def unpack_signatures(data):
+
+    """
+    Decode the output of pack_signatures().
+
+    Returns:
+    - list: A list of (digest, length) tuples.
+    """
+
+    return [SIGNATURE.unpack_from(data, i) for i in range(0, len(data), SIGNATURE.size)]
+
+
+def recv_exact(sock, num_bytes):
+
+    """
+    Receive exactly num_bytes from a TCP socket.
+
+    Raises:
+    - TransferError: If the connection closes first.
+    """
+
+    parts = []
+    while num_bytes > 0:
+        data = sock.recv(min(num_bytes, READ_SIZE))
+        if not data:
+            raise TransferError('Data transmission terminated prematurely.')
+        parts.append(data)
+        num_bytes -= len(data)
+    return b''.join(parts)
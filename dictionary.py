@@ -0,0 +1,274 @@
+import array
+import collections
+import ctypes
+import mmap
+import re
+import struct
+import sys
+
+
+# file header: magic, byte order of the arrays, number of slots, number of keywords, longest keyword
+HEADER = struct.Struct('<8s8sIII')
+MAGIC = b'ANONDA01'
+
+# names of the int32 arrays stored after the header, in file order
+ARRAYS = ('base', 'check', 'fail', 'length', 'link')
+
+# slots added whenever the arrays run out of room during a build
+GROWTH = 1 << 16
+
+# free slots further than this behind the last used one are given up on during a build,
+# which keeps the search for each base short at the cost of a few unused slots
+SEARCH_WINDOW = 1024
+
+
+class Automaton(object):
+
+    """
+    Aho-Corasick automaton over bytes, stored as a double-array trie.
+
+    Every state is a slot in five parallel int32 arrays:
+    - base, check: the transition on byte c from state s goes to t = base[s] + c
+        if check[t] == s (the double-array trie).
+    - fail: the state of the longest proper suffix that is also in the trie.
+    - length: the length of the keyword ending at this state, 0 if none.
+    - link: the nearest state along the fail links where a keyword ends, 0 if none.
+
+    That is 20 bytes per trie node, with no Python object per node or per keyword. A built
+    automaton is saved with save() and mapped with open(), which views the arrays directly
+    in the file mapping: loading is instant, and processes mapping the same file (or
+    forked after mapping it) share one copy of it in the page cache.
+    """
+
+    def __init__(self, arrays, num_keywords, max_len):
+        self.base, self.check, self.fail, self.length, self.link = arrays
+        self.num_keywords = num_keywords
+        self.max_len = max_len
+
+        # the bytes that can start a keyword, so scan() can skip the others at the root
+        labels = [c for c in range(256) if self.check[self.base[0] + c] == 0] if num_keywords else []
+        self.starts = re.compile(b'[' + b''.join(re.escape(chr(c)) for c in labels) + b']' if labels else b'(?!)')
+
+    @classmethod
+    def build(cls, keywords):
+
+        """
+        Build the automaton for a list of keywords.
+
+        The trie is laid out breadth first straight from the sorted keyword list, so the
+        only memory needed beyond the arrays themselves is the list.
+
+        Parameters:
+        - keywords (iterable): The keywords (byte strings), empty ones are ignored.
+
+        Returns:
+        - Automaton: The automaton, held in memory until saved.
+        """
+
+        keywords = sorted(set(keyword for keyword in keywords if keyword))
+        base = array.array('i', [0] * GROWTH)
+        check = array.array('i', [-1] * GROWTH)
+        fail = array.array('i', [0] * GROWTH)
+        length = array.array('i', [0] * GROWTH)
+        link = array.array('i', [0] * GROWTH)
+
+        # slot 0 is the root, no transition can lead to it since every base is at least 1
+        check[0] = 0
+        next_free = 1
+        used = 1
+
+        # (state, depth, range of the sorted keywords that share the state's prefix)
+        queue = collections.deque([(0, 0, 0, len(keywords))])
+        while queue:
+            state, depth, left, right = queue.popleft()
+
+            # the keyword ending here (at most one) sorts first, then the children by byte
+            i = left
+            if i < right and len(keywords[i]) == depth:
+                i += 1
+            labels = []
+            ranges = []
+            while i < right:
+                c = ord(keywords[i][depth])
+                j = i + 1
+                while j < right and ord(keywords[j][depth]) == c:
+                    j += 1
+                labels.append(c)
+                ranges.append((i, j))
+                i = j
+            if not labels:
+                continue
+
+            # find the first base where every child slot is free
+            next_free = max(next_free, used - SEARCH_WINDOW)
+            while check[next_free] != -1:
+                next_free += 1
+            pos = max(next_free, labels[0] + 1)
+            rest = labels[1:]
+            while 1:
+                if pos + 256 > len(check):
+                    for values, fill in ((base, 0), (check, -1), (fail, 0), (length, 0), (link, 0)):
+                        values.extend([fill] * GROWTH)
+                if check[pos] == -1:
+                    b = pos - labels[0]
+                    if all(check[b + c] == -1 for c in rest):
+                        break
+                pos += 1
+            base[state] = b
+
+            for c, (i, j) in zip(labels, ranges):
+                child = b + c
+                check[child] = state
+                used = max(used, child + 1)
+                if len(keywords[i]) == depth + 1:
+                    length[child] = depth + 1
+
+                # fail link: follow the parent's fail links until one has a transition on c;
+                # they are all shallower, so breadth first order has already placed them
+                target = 0
+                if state:
+                    f = fail[state]
+                    while 1:
+                        t = base[f] + c
+                        if check[t] == f:
+                            target = t
+                            break
+                        if not f:
+                            break
+                        f = fail[f]
+                fail[child] = target
+                link[child] = target if length[target] else link[target]
+
+                queue.append((child, depth + 1, i, j))
+
+        # keep room for base + 255 past the last used slot, so lookups never need a bounds check
+        size = used + 256
+        arrays = []
+        for values in (base, check, fail, length, link):
+            del values[size:]
+            values.extend([-1 if values is check else 0] * (size - len(values)))
+            arrays.append(values)
+        return cls(arrays, len(keywords), max(len(keyword) for keyword in keywords) if keywords else 0)
+
+    def save(self, filePath):
+
+        """
+        Write the automaton to filePath, in the format read by open().
+        """
+
+        with open(filePath, 'wb') as fp:
+            fp.write(HEADER.pack(MAGIC, sys.byteorder.encode(), len(self.check), self.num_keywords, self.max_len))
+            for name in ARRAYS:
+                values = getattr(self, name)
+                if not isinstance(values, array.array):
+                    values = array.array('i', values)
+                values.tofile(fp)
+
+    @classmethod
+    def open(cls, filePath):
+
+        """
+        Map an automaton saved by save().
+
+        The mapping is copy-on-write but never written, so its pages stay shared with the
+        page cache and with any other process mapping the same file.
+
+        Raises:
+        - IOError: If the file can't be opened.
+        - ValueError: If the file is not a saved automaton for this machine's byte order.
+        """
+
+        with open(filePath, 'rb') as fp:
+            mapping = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_COPY)
+
+        if len(mapping) < HEADER.size:
+            raise ValueError(filePath + ' is not a dictionary file')
+        magic, byteorder, size, num_keywords, max_len = HEADER.unpack_from(mapping)
+        if magic != MAGIC:
+            raise ValueError(filePath + ' is not a dictionary file')
+        if byteorder.rstrip(b'\0') != sys.byteorder.encode():
+            raise ValueError(filePath + ' was built on a ' + byteorder.rstrip(b'\0') + '-endian machine')
+        if len(mapping) != HEADER.size + len(ARRAYS) * 4 * size:
+            raise ValueError(filePath + ' is truncated')
+
+        arrays = [(ctypes.c_int32 * size).from_buffer(mapping, HEADER.size + index * 4 * size)
+                  for index in range(len(ARRAYS))]
+        automaton = cls(arrays, num_keywords, max_len)
+        automaton.mapping = mapping
+        return automaton
+
+    def scan(self, data, state, offset, found):
+
+        """
+        Run the automaton over data and record every keyword occurrence.
+
+        Parameters:
+        - data (bytes): The next part of the input.
+        - state (int): The state reached at the end of the previous part, 0 at the start.
+        - offset (int): The position of data in the whole input.
+        - found (dict): Updated with {start: end} for the longest keyword starting at each position.
+
+        Returns:
+        - int: The state to pass with the next part.
+        """
+
+        base, check, fail, length, link = self.base, self.check, self.fail, self.length, self.link
+        starts = self.starts
+        values = bytearray(data)
+        i = 0
+        while i < len(values):
+
+            # at the root, jump straight to the next byte that can start a keyword
+            if not state:
+                match = starts.search(data, i)
+                if match is None:
+                    break
+                i = match.start()
+
+            c = values[i]
+            i += 1
+            position = offset + i
+            while 1:
+                t = base[state] + c
+                if check[t] == state:
+                    state = t
+                    break
+                if not state:
+                    break
+                state = fail[state]
+
+            # every keyword that ends here
+            match = state if length[state] else link[state]
+            while match:
+                start = position - length[match]
+                if found.get(start, 0) < position:
+                    found[start] = position
+                match = link[match]
+        return state
+
+
+def main():
+
+    """
+    Build a dictionary file from a list of keywords, one per line.
+    """
+
+    if len(sys.argv) != 3:
+        print 'Usage: dictionary.py <keyword_file> <dictionary_file>'
+        sys.exit(1)
+
+    try:
+        with open(sys.argv[1], 'rb') as fp:
+            keywords = fp.read().splitlines()
+    except IOError as e:
+        print 'Error: Unable to open file', sys.argv[1], ':', e
+        sys.exit(1)
+
+    automaton = Automaton.build(keywords)
+    automaton.save(sys.argv[2])
+
+    print 'Built', sys.argv[2], 'with', automaton.num_keywords, 'keywords and', len(automaton.check), 'slots.'
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,210 @@
+import collections
+import heapq
+import itertools
+import os
+import threading
+import time
+
+import metrics
+
+
+# priority classes a job can be submitted with, lower runs first
+PRIORITIES = {'high': 0, 'normal': 1, 'low': 2}
+
+# number of finished jobs whose status can still be queried
+MAX_FINISHED = 1000
+
+
+class QueueFull(Exception):
+    """
+    Raised by JobQueue.submit() when the queue is full and the policy is to reject.
+
+    The message is the text that should be sent to the client.
+    """
+
+
+class Job(object):
+
+    """
+    One queued call of function(*args), and its outcome.
+    """
+
+    def __init__(self, job_id, function, args, priority, size):
+        self.id = job_id
+        self.function = function
+        self.args = args
+        self.priority = priority
+        self.size = size
+        self.status = 'queued'
+        self.result = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.done = threading.Event()
+
+    def key(self):
+
+        """
+        Ordering of the queue: priority class, then smaller files first, then submission order.
+        """
+
+        return PRIORITIES[self.priority], self.size, self.id
+
+
+class JobQueue(object):
+
+    """
+    A bounded priority queue served by a fixed pool of worker threads.
+
+    Within a priority class, jobs on smaller files run first, so a few multi-GB files
+    can't hold up every small request behind them.
+    """
+
+    def __init__(self, workers=2, capacity=16, block=False):
+
+        """
+        Parameters:
+        - workers (int): The number of worker threads.
+        - capacity (int): The number of jobs that may wait in the queue.
+        - block (bool): When the queue is full, wait for room instead of rejecting the job.
+        """
+
+        self.capacity = capacity
+        self.block = block
+        self.heap = []
+        self.jobs = {}
+        self.finished = collections.deque()
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.not_full = threading.Condition(self.lock)
+
+        for _ in range(workers):
+            thread = threading.Thread(target=self.work)
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, function, args, priority='normal', size=0):
+
+        """
+        Queue function(*args).
+
+        Parameters:
+        - function (function): What the job runs; its return value is the job result.
+        - args (tuple): The arguments of function.
+        - priority (str): One of PRIORITIES.
+        - size (int): The size of the input, smaller jobs of the same priority run first.
+
+        Returns:
+        - Job: The queued job.
+
+        Raises:
+        - QueueFull: If the queue is full and the queue does not block.
+        - ValueError: If the priority is unknown.
+        """
+
+        if priority not in PRIORITIES:
+            raise ValueError('Unknown priority ' + priority + ', expected one of ' + ', '.join(sorted(PRIORITIES)))
+        with self.lock:
+            while len(self.heap) >= self.capacity:
+                if not self.block:
+                    metrics.inc('jobs_rejected_total', priority=priority)
+                    raise QueueFull('Server busy, ' + str(len(self.heap)) + ' jobs queued. Try again later.')
+                self.not_full.wait()
+
+            job = Job(next(self.ids), function, args, priority, size)
+            heapq.heappush(self.heap, (job.key(), job))
+            self.jobs[job.id] = job
+            self.not_empty.notify()
+
+        metrics.inc('jobs_submitted_total', priority=priority)
+        return job
+
+    def get(self, job_id):
+
+        """
+        The job with this ID, or None if it is unknown or too old.
+        """
+
+        return self.jobs.get(job_id)
+
+    def describe(self, job):
+
+        """
+        A one-line status of a job, as sent to the client.
+        """
+
+        prefix = 'Job ' + str(job.id) + ' '
+        if job.status == 'queued':
+            with self.lock:
+                ahead = sum(1 for key, other in self.heap if key < job.key())
+            return prefix + 'queued, ' + str(ahead) + ' jobs ahead.'
+        if job.status == 'running':
+            return prefix + 'running for %.1f s.' % (time.time() - job.started)
+        return prefix + job.status + ' after %.1f s: ' % (job.finished - job.started) + job.result
+
+    def wait(self, job, timeout=None):
+
+        """
+        Block until the job has finished, or for at most timeout seconds, then describe it.
+        """
+
+        job.done.wait(timeout)
+        return self.describe(job)
+
+    def work(self):
+
+        """
+        Worker thread: run the queued jobs one at a time, in key() order.
+        """
+
+        while 1:
+            with self.lock:
+                while not self.heap:
+                    self.not_empty.wait()
+                key, job = heapq.heappop(self.heap)
+                self.not_full.notify()
+                job.status = 'running'
+                job.started = time.time()
+
+            metrics.observe('job_wait_seconds', job.started - job.submitted, priority=job.priority)
+            try:
+                job.result = job.function(*job.args)
+                job.status = 'done'
+            except Exception as e:
+                job.result = str(e)
+                job.status = 'failed'
+            job.finished = time.time()
+            job.done.set()
+            metrics.inc('jobs_total', status=job.status)
+
+            # forget the oldest finished jobs
+            with self.lock:
+                self.finished.append(job.id)
+                while len(self.finished) > MAX_FINISHED:
+                    del self.jobs[self.finished.popleft()]
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def default_queue():
+
+    """
+    The server's job queue, created on first use from the environment.
+
+    - ANON_JOB_WORKERS: number of worker threads (default 2).
+    - ANON_JOB_QUEUE: number of jobs that may wait (default 16).
+    - ANON_JOB_FULL: 'reject' (default) to turn jobs away when the queue is full, or
+        'block' to hold the submitting connection until there is room.
+    """
+
+    global _queue
+
+    with _queue_lock:
+        if _queue is None:
+            _queue = JobQueue(workers=int(os.environ.get('ANON_JOB_WORKERS', '2')),
+                              capacity=int(os.environ.get('ANON_JOB_QUEUE', '16')),
+                              block=os.environ.get('ANON_JOB_FULL', 'reject') == 'block')
+    return _queue
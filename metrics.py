@@ -0,0 +1,290 @@
+import atexit
+import bisect
+import collections
+import json
+import os
+import threading
+import time
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+from output import OutputFile
+
+
+# prefix of every exported metric name
+PREFIX = 'anon_'
+
+# upper bounds of the duration histograms, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+# number of finished spans kept for the JSON dump
+MAX_SPANS = 1000
+
+# set by start(), everything below is a no-op while False
+enabled = False
+
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_spans = collections.deque(maxlen=MAX_SPANS)
+_local = threading.local()
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def inc(name, amount=1, **labels):
+
+    """
+    Add amount to a counter.
+
+    Parameters:
+    - name (str): The counter name, without PREFIX.
+    - amount (int): The increment.
+    - labels: Label values, e.g. transport='udp'.
+    """
+
+    if not enabled:
+        return
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+def observe(name, value, **labels):
+
+    """
+    Record one value (a duration in seconds) in a histogram.
+    """
+
+    if not enabled:
+        return
+    key = _key(name, labels)
+    index = bisect.bisect_left(BUCKETS, value)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            # one count per bucket, one for +Inf, then the sum and the count
+            histogram = _histograms[key] = [0] * (len(BUCKETS) + 1) + [0.0, 0]
+        histogram[index] += 1
+        histogram[-2] += value
+        histogram[-1] += 1
+
+
+class Span(object):
+
+    """
+    Times one operation.
+
+    The duration goes to the <name>_seconds histogram, and the span itself (with its parent
+    span in the same thread and whether it raised) is kept for the JSON dump.
+    """
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+        self.parent = None
+        self.start = None
+
+    def __enter__(self):
+        stack = _local.__dict__.setdefault('stack', [])
+        self.parent = stack[-1].name if stack else None
+        stack.append(self)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        duration = time.time() - self.start
+        _local.stack.pop()
+        observe(self.name + '_seconds', duration, **self.labels)
+
+        # sys.exit(1) is how the servers report errors, so it counts as one
+        status = 'ok' if exc_type is None else 'error'
+        if status == 'error':
+            inc(self.name + '_errors_total', **self.labels)
+        _spans.append({'name': self.name, 'labels': self.labels, 'parent': self.parent, 'start': self.start,
+                       'duration': duration, 'status': status})
+        return False
+
+
+class NullSpan(object):
+
+    """
+    What span() returns while metrics are disabled.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_null_span = NullSpan()
+
+
+def span(name, **labels):
+
+    """
+    Context manager timing the enclosed block, see Span.
+
+    Usage:
+        with metrics.span('command', transport='tcp', command='put'):
+            ...
+    """
+
+    if not enabled:
+        return _null_span
+    return Span(name, labels)
+
+
+def timed(name, **labels):
+
+    """
+    Decorator that runs the whole function in a span.
+    """
+
+    def decorator(function):
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            with Span(name, labels):
+                return function(*args, **kwargs)
+        wrapper.__name__ = function.__name__
+        wrapper.__doc__ = function.__doc__
+        return wrapper
+    return decorator
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for name, value in pairs) + '}'
+
+
+def prometheus_text():
+
+    """
+    All metrics in the Prometheus text exposition format.
+    """
+
+    with _lock:
+        counters = sorted(_counters.items())
+        histograms = sorted((key, list(values)) for key, values in _histograms.items())
+
+    lines = []
+    typed = set()
+    for (name, labels), value in counters:
+        if name not in typed:
+            lines.append('# TYPE %s%s counter' % (PREFIX, name))
+            typed.add(name)
+        lines.append('%s%s%s %s' % (PREFIX, name, _format_labels(labels), value))
+
+    for (name, labels), values in histograms:
+        if name not in typed:
+            lines.append('# TYPE %s%s histogram' % (PREFIX, name))
+            typed.add(name)
+        cumulative = 0
+        for bound, count in zip([str(bound) for bound in BUCKETS] + ['+Inf'], values):
+            cumulative += count
+            lines.append('%s%s_bucket%s %d' % (PREFIX, name, _format_labels(labels, [('le', bound)]), cumulative))
+        lines.append('%s%s_sum%s %r' % (PREFIX, name, _format_labels(labels), values[-2]))
+        lines.append('%s%s_count%s %d' % (PREFIX, name, _format_labels(labels), values[-1]))
+
+    return '\n'.join(lines) + '\n'
+
+
+def snapshot():
+
+    """
+    All metrics and the most recent spans, as a JSON-serializable dict.
+    """
+
+    with _lock:
+        counters = [{'name': PREFIX + name, 'labels': dict(labels), 'value': value}
+                    for (name, labels), value in sorted(_counters.items())]
+        histograms = [{'name': PREFIX + name, 'labels': dict(labels), 'buckets': list(BUCKETS),
+                       'counts': values[:-2], 'sum': values[-2], 'count': values[-1]}
+                      for (name, labels), values in sorted(_histograms.items())]
+        spans = list(_spans)
+    return {'timestamp': time.time(), 'counters': counters, 'histograms': histograms, 'spans': spans}
+
+
+def dump(filePath):
+
+    """
+    Write snapshot() to filePath, through a temporary file so readers never see half of it.
+
+    Every dump gets its own temporary file (see OutputFile), so the periodic dump and the
+    one at exit can't write into each other's.
+    """
+
+    with OutputFile(filePath) as output:
+        output.write(json.dumps(snapshot(), indent=2, sort_keys=True))
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    """
+    Serves /metrics (Prometheus text) and /metrics.json (snapshot()).
+    """
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            body, content_type = prometheus_text(), 'text/plain; version=0.0.4'
+        elif self.path == '/metrics.json':
+            body, content_type = json.dumps(snapshot(), sort_keys=True), 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _dump_periodically(filePath, interval):
+    while 1:
+        time.sleep(interval)
+        dump(filePath)
+
+
+def start():
+
+    """
+    Enable metrics if the environment asks for them.
+
+    - ANON_METRICS_PORT: serve the metrics over HTTP on 127.0.0.1 at this port.
+    - ANON_METRICS_FILE: dump them as JSON to this file every ANON_METRICS_INTERVAL
+        seconds (default 10) and when the server exits.
+
+    With neither variable set, metrics stay disabled and cost one flag check per call.
+    """
+
+    global enabled
+
+    port = os.environ.get('ANON_METRICS_PORT')
+    filePath = os.environ.get('ANON_METRICS_FILE')
+    if not port and not filePath:
+        return
+    enabled = True
+
+    if port:
+        httpd = HTTPServer(('127.0.0.1', int(port)), MetricsHandler)
+        thread = threading.Thread(target=httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    if filePath:
+        interval = float(os.environ.get('ANON_METRICS_INTERVAL', '10'))
+        thread = threading.Thread(target=_dump_periodically, args=(filePath, interval))
+        thread.daemon = True
+        thread.start()
+        atexit.register(dump, filePath)
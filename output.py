@@ -0,0 +1,169 @@
+import os
+import tempfile
+import threading
+
+from parallel import allocate
+
+
+# fsync policies: 'none' leaves writing back to the OS, 'end' syncs a file before it is
+# renamed into place, 'periodic' also syncs it every ANON_FSYNC_BYTES while it is written
+POLICIES = ('none', 'end', 'periodic')
+
+# bytes written between two syncs with the periodic policy
+FSYNC_BYTES = int(os.environ.get('ANON_FSYNC_BYTES', str(8 << 20)))
+
+# permissions open() would give a new file; mkstemp() creates them private
+_umask = os.umask(0)
+os.umask(_umask)
+MODE = 0o666 & ~_umask
+
+
+def fsync_policy():
+
+    """
+    The fsync policy set by ANON_FSYNC, 'none' by default.
+
+    Raises:
+    - ValueError: If the policy is unknown.
+    """
+
+    policy = os.environ.get('ANON_FSYNC', 'none')
+    if policy not in POLICIES:
+        raise ValueError('Unknown fsync policy ' + policy + ', expected one of ' + ', '.join(POLICIES))
+    return policy
+
+
+def sync_directory(directory):
+
+    """
+    Sync a directory, so that a rename into it survives a crash. Not every platform can.
+    """
+
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    except OSError:
+        pass
+
+
+class OutputFile(object):
+
+    """
+    A file written under a temporary name next to its final path, then renamed into place.
+
+    Until the rename, readers of the final path (a get, or a keyword command on an upload
+    in progress) see the previous version of the file, if any, and never a partial one.
+    The temporary file is hidden ('.<name>.<random>.part') and preallocated when the final
+    size is known.
+
+    Used as a context manager, the file is committed when the block ends and discarded if
+    it raises. Data can be written with write(), or to the path attribute by anything that
+    opens the file itself (e.g. the parallel streams, each at its own offset).
+    """
+
+    def __init__(self, filePath, num_bytes=None, policy=None):
+
+        """
+        Parameters:
+        - filePath (str): The final path of the file.
+        - num_bytes (int): The final size of the file if known, to preallocate it.
+        - policy (str): One of POLICIES, by default fsync_policy().
+
+        Raises:
+        - IOError: If the temporary file can't be created.
+        - ValueError: If the policy is unknown.
+        """
+
+        self.policy = policy or fsync_policy()
+        if self.policy not in POLICIES:
+            raise ValueError('Unknown fsync policy ' + self.policy + ', expected one of ' + ', '.join(POLICIES))
+        self.filePath = filePath
+        self.unsynced = 0
+        self.lock = threading.Lock()
+
+        directory, name = os.path.split(filePath)
+        try:
+            self.fd, self.path = tempfile.mkstemp(prefix='.' + name + '.', suffix='.part', dir=directory or '.')
+        except OSError as e:
+            raise IOError(e.errno, e.strerror, filePath)
+        try:
+            os.fchmod(self.fd, MODE)
+            if num_bytes:
+                allocate(self.fd, num_bytes)
+        except OSError as e:
+            self.discard()
+            raise IOError(e.errno, e.strerror, filePath)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.discard()
+
+    def write(self, data):
+
+        """
+        Append data to the file.
+        """
+
+        view = memoryview(data)
+        while len(view):
+            view = view[os.write(self.fd, view):]
+        self.written(len(data))
+
+    def written(self, num_bytes):
+
+        """
+        Count bytes written to the file, and sync it every FSYNC_BYTES with the periodic policy.
+        """
+
+        if self.policy != 'periodic':
+            return
+        with self.lock:
+            self.unsynced += num_bytes
+            if self.unsynced < FSYNC_BYTES:
+                return
+            self.unsynced = 0
+        getattr(os, 'fdatasync', os.fsync)(self.fd)
+
+    def commit(self):
+
+        """
+        Sync the file unless the policy is 'none', then rename it to its final path.
+
+        Raises:
+        - IOError: If the file can't be synced or renamed; it is discarded.
+        """
+
+        try:
+            if self.policy != 'none':
+                os.fsync(self.fd)
+            os.close(self.fd)
+            self.fd = None
+            os.rename(self.path, self.filePath)
+        except OSError as e:
+            self.discard()
+            raise IOError(e.errno, e.strerror, self.filePath)
+
+        if self.policy != 'none':
+            sync_directory(os.path.dirname(self.filePath) or '.')
+
+    def discard(self):
+
+        """
+        Remove the temporary file, leaving the final path as it was.
+        """
+
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
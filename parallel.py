@@ -0,0 +1,378 @@
+import ctypes
+import ctypes.util
+import os
+import socket
+import threading
+
+
+# upper bound on the number of parallel streams for one file
+MAX_STREAMS = 16
+
+# read/write size for each TCP stream
+STREAM_BUFFER = 65536
+
+# UDP payload size, same as the stop-and-wait transfer
+CHUNK_SIZE = 1000
+
+# posix_fallocate() of the C library, for Python 2 which has no os.posix_fallocate
+try:
+    _posix_fallocate = ctypes.CDLL(ctypes.util.find_library('c')).posix_fallocate64
+    _posix_fallocate.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+except (OSError, AttributeError):
+    _posix_fallocate = None
+
+# guards the byte ranges still expected by the flows of a UDP transfer
+_ranges_lock = threading.Lock()
+
+
+class TransferError(Exception):
+    """
+    Raised when one of the parallel streams of a transfer fails.
+
+    The message is the text that should be displayed to the user.
+    """
+
+
+def split_ranges(num_bytes, streams):
+
+    """
+    Split a file into contiguous byte ranges, one per stream.
+
+    Both sides of a transfer call this with the same arguments, so the number of
+    streams to expect never has to be sent over the wire.
+
+    Parameters:
+    - num_bytes (int): The size of the file in bytes.
+    - streams (int): The number of streams requested by the user.
+
+    Returns:
+    - list: A list of (offset, length) tuples covering the whole file.
+    """
+
+    if num_bytes <= 0:
+        return []
+
+    # never use more streams than bytes, or more than MAX_STREAMS
+    streams = max(1, min(streams, MAX_STREAMS, num_bytes))
+    base, extra = divmod(num_bytes, streams)
+
+    ranges = []
+    offset = 0
+    for i in range(streams):
+        length = base + (1 if i < extra else 0)
+        ranges.append((offset, length))
+        offset += length
+
+    return ranges
+
+
+def allocate(fd, num_bytes):
+
+    """
+    Reserve num_bytes of disk space for an open file and set its size to num_bytes.
+
+    The blocks are allocated up front with posix_fallocate(), so writing them (in any
+    order) can't fail for lack of space and the file system can keep them contiguous.
+    Where posix_fallocate() is not available the file is only extended, as a sparse file.
+
+    Parameters:
+    - fd (int): The file descriptor, open for writing.
+    - num_bytes (int): The final size of the file.
+    """
+
+    if num_bytes > 0:
+        try:
+            if hasattr(os, 'posix_fallocate'):
+                os.posix_fallocate(fd, 0, num_bytes)
+            elif _posix_fallocate is not None:
+                _posix_fallocate(fd, 0, num_bytes)
+        except OSError:
+            pass
+    os.ftruncate(fd, num_bytes)
+
+
+def preallocate(filePath, num_bytes):
+
+    """
+    Create (or truncate) a file and reserve num_bytes for it, so that each stream
+    can write its range in place.
+
+    Parameters:
+    - filePath (str): The path of the file to create.
+    - num_bytes (int): The final size of the file.
+
+    Raises:
+    - IOError: If the file can't be created.
+    """
+
+    with open(filePath, 'wb') as fp:
+        allocate(fp.fileno(), num_bytes)
+
+
+def pwrite(fd, data, offset):
+
+    """
+    Write all of data to fd at the given offset.
+
+    Falls back to lseek() + write() where os.pwrite is not available (Python 2), so
+    fd must then be private to the calling thread.
+    """
+
+    view = memoryview(data)
+    while len(view):
+        if hasattr(os, 'pwrite'):
+            written = os.pwrite(fd, view, offset)
+        else:
+            os.lseek(fd, offset, os.SEEK_SET)
+            written = os.write(fd, view)
+        view = view[written:]
+        offset += written
+
+
+def pread(fd, length, offset):
+
+    """
+    Read up to length bytes from fd at the given offset.
+
+    Same fallback rules as pwrite().
+    """
+
+    if hasattr(os, 'pread'):
+        return os.pread(fd, length, offset)
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.read(fd, length)
+
+
+def recv_field(sock):
+
+    """
+    Read a null-terminated field from a TCP socket.
+
+    Returns:
+    - str: The field, without the null byte delimiter.
+    """
+
+    field = b''
+    while 1:
+        data = sock.recv(1)
+        if data == b'\0' or not data:  # check for null byte delimiter
+            break
+        field += data
+    return field
+
+
+def send_range(sock, filePath, offset, length):
+
+    """
+    Send length bytes of a file, starting at offset, over a TCP stream.
+
+    Parameters:
+    - sock (socket.socket): The connected TCP socket of this stream.
+    - filePath (str): The path of the file to be sent.
+    - offset (int): The first byte of the range.
+    - length (int): The number of bytes in the range.
+
+    Raises:
+    - IOError/OSError: If the file can't be opened or read.
+    - TransferError: If the file is shorter than the range.
+    """
+
+    fd = os.open(filePath, os.O_RDONLY)
+    try:
+        while length > 0:
+            data = pread(fd, min(STREAM_BUFFER, length), offset)
+            if not data:
+                raise TransferError('Error: File ' + filePath + ' ended before the requested range.')
+            sock.sendall(data)
+            offset += len(data)
+            length -= len(data)
+    finally:
+        os.close(fd)
+
+
+def recv_range(sock, filePath, offset, length):
+
+    """
+    Receive length bytes over a TCP stream and write them to a preallocated file at offset.
+
+    Parameters:
+    - sock (socket.socket): The connected TCP socket of this stream.
+    - filePath (str): The path of the preallocated file.
+    - offset (int): The first byte of the range.
+    - length (int): The number of bytes in the range.
+
+    Raises:
+    - IOError/OSError: If the file can't be opened or written.
+    - TransferError: If the stream closes before the whole range has arrived.
+    """
+
+    fd = os.open(filePath, os.O_WRONLY)
+    try:
+        while length > 0:
+            data = sock.recv(min(STREAM_BUFFER, length))
+            if not data:
+                raise TransferError('Data transmission terminated prematurely.')
+            pwrite(fd, data, offset)
+            offset += len(data)
+            length -= len(data)
+    finally:
+        os.close(fd)
+
+
+def recv_range_request(sock, ranges):
+
+    """
+    Wait for the "RANGE:offset:length" message that opens a UDP flow.
+
+    A sender with congestion control opens its flows with "WRANGE:offset:length" instead,
+    asking for the sliding window transfer of window.py.
+
+    Parameters:
+    - sock (socket.socket): The UDP socket of this flow.
+    - ranges (list): The byte ranges of the transfer that no flow has requested yet,
+      shared by all its flows; the requested range is removed from it.
+
+    Returns:
+    - tuple: (offset, length, address of the peer, True if the flow is windowed)
+
+    Raises:
+    - TransferError: If no request arrives within 1 second, it is malformed, or it asks
+      for a byte range the transfer does not expect.
+    """
+
+    sock.settimeout(1)
+    try:
+        range_msg, address = sock.recvfrom(1024)
+    except socket.timeout:
+        raise TransferError('Did not receive data. Terminating.')
+
+    windowed = range_msg.startswith('WRANGE:')
+    if not windowed and not range_msg.startswith('RANGE:'):
+        raise TransferError('Error: Expected RANGE message \'RANGE:Offset:Bytes\', received ' + range_msg)
+    fields = range_msg.split(':', 1)[1]
+    try:
+        offset, length = [int(field) for field in fields.split(':')]
+    except ValueError:
+        raise TransferError('Invalid range: ' + fields)
+
+    # only serve the ranges split_ranges() gave this transfer, each one once
+    with _ranges_lock:
+        if (offset, length) not in ranges:
+            raise TransferError('Unexpected range: ' + fields)
+        ranges.remove((offset, length))
+
+    return offset, length, address, windowed
+
+
+def send_range_udp(sock, address, filePath, offset, length):
+
+    """
+    Send one byte range of a file over its own UDP flow.
+
+    Uses the same "stop-and-wait" scheme as send_file(): one 1000 byte chunk at a time,
+    waiting for an ACK after each chunk and for a FIN once the range is complete.
+
+    Raises:
+    - IOError/OSError: If the file can't be opened or read.
+    - TransferError: If an ACK or the FIN is not received within 1 second.
+    """
+
+    sock.settimeout(1)
+    fd = os.open(filePath, os.O_RDONLY)
+    try:
+        while length > 0:
+            data = pread(fd, min(CHUNK_SIZE, length), offset)
+            if not data:
+                raise TransferError('Error: File ' + filePath + ' ended before the requested range.')
+
+            # send one chunk at a time, stop and wait for ACK message after each transmission
+            sock.sendto(data, address)
+            try:
+                ack_msg, address = sock.recvfrom(1024)
+            except socket.timeout:
+                raise TransferError('Did not receive ACK. Terminating.')
+
+            offset += len(data)
+            length -= len(data)
+    finally:
+        os.close(fd)
+
+    # receive FIN message, terminate the flow
+    try:
+        fin_msg, address = sock.recvfrom(1024)
+    except socket.timeout:
+        raise TransferError('Did not receive FIN. Terminating.')
+    if fin_msg != 'FIN':
+        raise TransferError('Error: Expected FIN message, received: ' + fin_msg)
+
+
+def recv_range_udp(sock, address, filePath, offset, length):
+
+    """
+    Receive one byte range over its own UDP flow and write it to a preallocated file at offset.
+
+    Sends an ACK after each chunk and a FIN once the whole range has arrived.
+
+    Raises:
+    - IOError/OSError: If the file can't be opened or written.
+    - TransferError: If no data arrives within 1 second.
+    """
+
+    sock.settimeout(1)
+    fd = os.open(filePath, os.O_WRONLY)
+    try:
+        first = True
+        while length > 0:
+            try:
+                data, address = sock.recvfrom(CHUNK_SIZE)
+            except socket.timeout:
+                if first:
+                    raise TransferError('Did not receive data. Terminating.')
+                raise TransferError('Data transmission terminated prematurely.')
+            first = False
+
+            pwrite(fd, data, offset)
+            offset += len(data)
+            length -= len(data)
+
+            # send ACK message
+            sock.sendto('ACK', address)
+    finally:
+        os.close(fd)
+
+    # send FIN message once the whole range has been received
+    sock.sendto('FIN', address)
+
+
+def run_streams(target, jobs):
+
+    """
+    Run target once per job, each in its own thread, and wait for all of them.
+
+    Parameters:
+    - target (function): The per-stream function.
+    - jobs (list): One tuple of arguments per stream.
+
+    Raises:
+    - TransferError: If any of the streams failed (the first failure is reported).
+    """
+
+    errors = []
+
+    def run(args):
+        try:
+            target(*args)
+        except TransferError as e:
+            errors.append(e)
+        except (IOError, OSError, socket.error) as e:
+            errors.append(TransferError('Error: ' + str(e)))
+
+    threads = [threading.Thread(target=run, args=(args,)) for args in jobs]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0]
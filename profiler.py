@@ -0,0 +1,378 @@
+import atexit
+import collections
+import cProfile
+import os
+import pstats
+import signal
+import sys
+import tempfile
+import threading
+import time
+
+
+# what a profiling session records: 'sample' takes stack samples of the threads running a
+# command, 'cprofile' also runs every command under cProfile (exact, but slows the server)
+MODES = ('sample', 'cprofile')
+
+# seconds between two stack samples
+INTERVAL = float(os.environ.get('ANON_PROFILE_INTERVAL', '0.005'))
+
+# functions listed per handler in the breakdown
+TOP_FUNCTIONS = 15
+
+# set by start(), command() is a no-op while False
+enabled = False
+
+_lock = threading.Lock()
+_session = None
+_sessions = 0
+
+# set by the SIGUSR1 handler, which must not take _lock: the thread it interrupts may
+# hold it; command() switches profiling on or off at the start of the next command
+_toggle_requested = False
+
+
+def profile_mode():
+
+    """
+    The profiling mode set by ANON_PROFILE_MODE, 'sample' by default.
+
+    Raises:
+    - ValueError: If the mode is unknown.
+    """
+
+    mode = os.environ.get('ANON_PROFILE_MODE', 'sample')
+    if mode not in MODES:
+        raise ValueError('Unknown profiling mode ' + mode + ', expected one of ' + ', '.join(MODES))
+    return mode
+
+
+def frame_name(code):
+    return '%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+
+class Session(object):
+
+    """
+    The data of one profiling session, from start() to stop().
+
+    - samples: collapsed stacks ('<transport> <command>;frame;...;frame') and their counts.
+    - handlers: per handler label, the number of runs, their total and longest duration.
+    - stats: per handler label, the merged cProfile statistics (cprofile mode only).
+    - running: the label and entry frame of every thread inside a command.
+    """
+
+    def __init__(self, mode, directory):
+        self.mode = mode
+        self.directory = directory
+        self.started = time.time()
+        self.samples = collections.defaultdict(int)
+        self.handlers = {}
+        self.stats = {}
+        self.running = {}
+        self.stopped = threading.Event()
+        self.sampler = threading.Thread(target=self.sample_periodically)
+        self.sampler.daemon = True
+
+    def sample(self):
+
+        """
+        Record the stack of every thread inside a command, from the frame that entered it.
+        """
+
+        frames = sys._current_frames()
+        with _lock:
+            running = self.running.items()
+        stacks = []
+        for thread_id, (label, entry) in running:
+            frame = frames.get(thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(frame_name(frame.f_code))
+                if frame is entry:
+                    break
+                frame = frame.f_back
+            stack.append(label)
+            stacks.append(';'.join(reversed(stack)))
+
+        # a frame keeps its locals alive, e.g. the socket of a UDP command that has just ended
+        frames = running = frame = entry = None
+        with _lock:
+            for stack in stacks:
+                self.samples[stack] += 1
+
+    def sample_periodically(self):
+        while not self.stopped.wait(INTERVAL):
+            self.sample()
+
+    def record(self, label, duration, profile):
+        with _lock:
+            handler = self.handlers.setdefault(label, [0, 0.0, 0.0])
+            handler[0] += 1
+            handler[1] += duration
+            handler[2] = max(handler[2], duration)
+            if profile is not None:
+                if label in self.stats:
+                    self.stats[label].add(profile)
+                else:
+                    self.stats[label] = pstats.Stats(profile)
+
+    def write(self):
+
+        """
+        Write the session to its directory:
+
+        - stacks.folded: the collapsed stacks, for flamegraph.pl, speedscope or inferno.
+        - handlers.txt: per handler, its runs, total, mean and longest duration, its share of
+            the samples and the functions it spent the most samples in (cProfile statistics,
+            sorted by own time, instead in cprofile mode).
+        - <label>.pstats: per handler, the cProfile statistics (cprofile mode only).
+
+        Returns:
+        - str: The directory.
+        """
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        with _lock:
+            samples = sorted(self.samples.items())
+            handlers = sorted(self.handlers.items(), key=lambda item: -item[1][1])
+            stats = dict(self.stats)
+
+        with open(os.path.join(self.directory, 'stacks.folded'), 'w') as fp:
+            for stack, count in samples:
+                fp.write('%s %d\n' % (stack, count))
+
+        # functions a handler spent samples in, leaf frame first
+        total_samples = sum(count for stack, count in samples) or 1
+        label_samples = collections.defaultdict(int)
+        leaves = collections.defaultdict(lambda: collections.defaultdict(int))
+        for stack, count in samples:
+            frames = stack.split(';')
+            label_samples[frames[0]] += count
+            leaves[frames[0]][frames[-1]] += count
+
+        with open(os.path.join(self.directory, 'handlers.txt'), 'w') as fp:
+            fp.write('Profiled %.1f s in %s mode, %d samples every %g s\n\n'
+                     % (time.time() - self.started, self.mode, sum(label_samples.values()), INTERVAL))
+            fp.write('%-20s %8s %12s %10s %10s %8s\n' % ('handler', 'runs', 'total s', 'mean ms', 'max ms', 'samples'))
+            for label, (runs, total, longest) in handlers:
+                fp.write('%-20s %8d %12.3f %10.3f %10.3f %7.1f%%\n'
+                         % (label, runs, total, 1000 * total / runs, 1000 * longest,
+                            100.0 * label_samples[label] / total_samples))
+
+            for label, handler in handlers:
+                fp.write('\n== %s\n' % label)
+                if label in stats:
+                    stats[label].stream = fp
+                    stats[label].sort_stats('tottime').print_stats(TOP_FUNCTIONS)
+                    stats[label].dump_stats(os.path.join(self.directory, label.replace(' ', '-') + '.pstats'))
+                    continue
+                top = sorted(leaves[label].items(), key=lambda item: -item[1])[:TOP_FUNCTIONS]
+                for name, count in top:
+                    fp.write('%7.1f%%  %s\n' % (100.0 * count / label_samples[label], name))
+
+        return self.directory
+
+
+class Command(object):
+
+    """
+    Runs one command handler under the current session: marks its thread for the sampler,
+    times it, and in cprofile mode profiles it.
+    """
+
+    def __init__(self, session, label):
+        self.session = session
+        self.label = label
+        self.profile = None
+        self.start = None
+
+    def __enter__(self):
+        thread_id = threading.current_thread().ident
+        with _lock:
+            self.session.running[thread_id] = (self.label, sys._getframe(1))
+        if self.session.mode == 'cprofile':
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        duration = time.time() - self.start
+        if self.profile is not None:
+            self.profile.disable()
+        with _lock:
+            self.session.running.pop(threading.current_thread().ident, None)
+        self.session.record(self.label, duration, self.profile)
+        return False
+
+
+class NullCommand(object):
+
+    """
+    What command() returns while profiling is off, or inside another command.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_null_command = NullCommand()
+
+
+def command(transport, name):
+
+    """
+    Context manager around the handler of one command, see Command.
+
+    Usage:
+        with profiler.command('tcp', 'put'):
+            ...
+    """
+
+    if _toggle_requested:
+        apply_toggle()
+
+    session = _session
+    if not enabled or session is None or threading.current_thread().ident in session.running:
+        return _null_command
+    return Command(session, transport + ' ' + name)
+
+
+def start():
+
+    """
+    Start a profiling session, in the mode set by ANON_PROFILE_MODE.
+
+    Returns:
+    - str: A message for the log or the client.
+    """
+
+    global enabled, _session, _sessions
+
+    with _lock:
+        if _session is not None:
+            return 'Profiling already running.'
+        _sessions += 1
+        directory = os.path.join(os.environ.get('ANON_PROFILE_DIR') or tempfile.gettempdir(),
+                                 'anon-profile-%d-%d' % (os.getpid(), _sessions))
+        session = _session = Session(profile_mode(), directory)
+
+    session.sampler.start()
+    enabled = True
+    return 'Profiling started, output will be written to ' + directory + '.'
+
+
+def dump():
+
+    """
+    Write the data of the running session so far, and keep profiling.
+    """
+
+    session = _session
+    if session is None:
+        return 'Profiling not running.'
+    return 'Profile written to ' + session.write() + '.'
+
+
+def stop():
+
+    """
+    Stop the running session and write its data.
+
+    Commands still in progress are left out of the breakdown.
+    """
+
+    global enabled, _session
+
+    with _lock:
+        session = _session
+        _session = None
+    if session is None:
+        return 'Profiling not running.'
+    enabled = False
+    session.stopped.set()
+    session.sampler.join()
+    return 'Profiling stopped, profile written to ' + session.write() + '.'
+
+
+def status():
+    session = _session
+    if session is None:
+        return 'Profiling not running.'
+    return 'Profiling for %.1f s in %s mode, output in %s.' % (time.time() - session.started, session.mode,
+                                                               session.directory)
+
+
+# actions of the profile admin command
+ACTIONS = {'start': start, 'stop': stop, 'dump': dump, 'status': status}
+
+
+def admin(action):
+
+    """
+    Run the profile admin command.
+
+    Parameters:
+    - action (str): One of ACTIONS.
+
+    Returns:
+    - str: The server response.
+    """
+
+    if action not in ACTIONS:
+        return 'Unknown profile action ' + action + ', expected one of ' + ', '.join(sorted(ACTIONS)) + '.'
+    return ACTIONS[action]()
+
+
+def toggle(signum, frame):
+    global _toggle_requested
+    _toggle_requested = True
+
+
+def apply_toggle():
+
+    """
+    Start or stop profiling as requested by SIGUSR1, in the thread that takes the request.
+    """
+
+    global _toggle_requested
+
+    with _lock:
+        requested, _toggle_requested = _toggle_requested, False
+    if requested:
+        print start() if _session is None else stop()
+
+
+def _stop_at_exit():
+    if _session is not None:
+        print stop()
+
+
+def setup():
+
+    """
+    Let profiling be switched on and off while the server runs, and start it right away
+    if ANON_PROFILE is set (so that startup is profiled too).
+
+    - SIGUSR1 toggles profiling. The handler only records the request, which takes effect
+        at the start of the next command, so it never waits for a lock the interrupted
+        thread may hold. System calls in progress are restarted rather than interrupted.
+    - A running session is written when the server exits.
+
+    Raises:
+    - ValueError: If ANON_PROFILE_MODE is unknown.
+    """
+
+    profile_mode()
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, toggle)
+        signal.siginterrupt(signal.SIGUSR1, False)
+    atexit.register(_stop_at_exit)
+    if os.environ.get('ANON_PROFILE'):
+        print start()
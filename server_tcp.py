@@ -1,6 +1,19 @@
+import Queue
+import hashlib
 import os
+import random
 import socket
 import sys
+import threading
+
+import jobs
+import metrics
+import profiler
+from anonymize import anonymize_file, default_engine, load_dictionary
+from delta import SIGNATURE, file_signatures, recv_exact, remember_signatures, unpack_signatures
+from output import OutputFile, fsync_policy
+from parallel import MAX_STREAMS, STREAM_BUFFER, TransferError, recv_field, recv_range, run_streams, send_range, \
+    split_ranges
 
 
 def validate_args():
@@ -27,6 +40,28 @@ def validate_args():
     return port
 
 
+# commands understood by serve_connection(), anything else is labelled 'unknown' in the metrics
+COMMANDS = ('put', 'get', 'keyword', 'pput', 'sput', 'pget', 'submit', 'status', 'wait', 'fput', 'fget', 'fkeyword',
+            'profile', 'quit')
+
+# how long a parallel transfer waits for the client to open its streams
+STREAM_TIMEOUT = 10.0
+
+# the parallel transfers collecting their streams, by token: the queue route_connection()
+# hands their streams to, and the byte ranges still expected
+_transfers = {}
+
+# held while _transfers is read or changed
+_transfers_lock = threading.Lock()
+
+# source of the transfer tokens
+_random = random.SystemRandom()
+
+# set by the quit command before it shuts the listening socket down
+_stopping = threading.Event()
+
+
+@metrics.timed('receive_file', transport='tcp', command='put')
 def receive_file(connectionSocket, fileName):
 
     """
@@ -40,23 +75,28 @@ def receive_file(connectionSocket, fileName):
     - IOError: If there is an error opening or writing to the file.
     """
 
-    # read each line in a loop, create new copy of file
+    # read each line in a loop, create new copy of file (in place of the old one once complete)
+    num_bytes = 0
     try:
-        with open(fileName, 'wb') as fp:
+        with OutputFile(fileName) as output:
             while 1:
                 data = connectionSocket.recv(1024)
-                fp.write(data)
+                output.write(data)
+                num_bytes += len(data)
                 if len(data) < 1024:
                     break
     except IOError as e:
         print 'Error: Unable to open file ', fileName, ': ', e
         sys.exit(1)
 
+    metrics.inc('bytes_received_total', num_bytes, transport='tcp', command='put')
+
     connectionSocket.send('File uploaded.')
 
     print 'Done receiving file.'
 
 
+@metrics.timed('send_file', transport='tcp', command='get')
 def send_file(connectionSocket, fileName):
 
     """
@@ -71,6 +111,7 @@ def send_file(connectionSocket, fileName):
     """
 
     # open the file for reading, send data to client
+    num_bytes = 0
     try:
         with open(fileName, 'rb') as fp:
             while 1:
@@ -79,13 +120,312 @@ def send_file(connectionSocket, fileName):
                     connectionSocket.send('\0')
                     break
                 connectionSocket.send(data)
+                num_bytes += len(data)
+    except IOError as e:
+        print 'Error: Unable to open file ', fileName, ': ', e
+        sys.exit(1)
+
+    metrics.inc('bytes_sent_total', num_bytes, transport='tcp', command='get')
+
+    print 'Done sending file.'
+
+
+def accept_streams(connectionSocket, announcement, ranges):
+
+    """
+    Tells the client to open its streams, then takes them as route_connection() hands them over.
+
+    A token of this transfer is appended to the announcement, and the client sends it back
+    in the header of every stream. Streams therefore reach their own transfer when several
+    run at once, and a stream of a transfer that has given up is dropped instead of being
+    taken by the next one.
+
+    Parameters:
+    - connectionSocket (socket.socket): The server TCP socket connected to the client.
+    - announcement (str): The message the client waits for before opening its streams.
+    - ranges (list): The (offset, length) byte ranges, one per stream.
+
+    Returns:
+    - list: A (stream socket, offset, length) tuple per range, in the order the streams connected.
+
+    Raises:
+    - TransferError: If the client does not open its streams within STREAM_TIMEOUT seconds.
+    """
+
+    token = str(_random.getrandbits(64))
+    streams = Queue.Queue()
+    with _transfers_lock:
+        _transfers[token] = (streams, set(ranges))
+
+    accepted = []
+    try:
+        connectionSocket.sendall(announcement + ':' + token + b'\0')
+        for _ in ranges:
+            accepted.append(streams.get(timeout=STREAM_TIMEOUT))
+    except Queue.Empty:
+        for streamSocket, offset, length in accepted:
+            streamSocket.close()
+        raise TransferError('Error: Client did not open its streams.')
+    finally:
+        with _transfers_lock:
+            del _transfers[token]
+
+        # streams handed over after the timeout
+        while not streams.empty():
+            streams.get()[0].close()
+
+    return accepted
+
+
+def hand_over_stream(streamSocket):
+
+    """
+    Reads the "token:offset:length" header of a stream, and hands the stream to the transfer
+    with that token if it still expects that byte range.
+
+    Returns:
+    - bool: Whether the stream was handed over; if not, the caller closes it.
+    """
+
+    # a stream that never sends its header must not hold its thread forever
+    streamSocket.settimeout(STREAM_TIMEOUT)
+    header = recv_field(streamSocket)
+    streamSocket.settimeout(None)
+
+    try:
+        token, offset, length = header.split(':')
+        offset, length = int(offset), int(length)
+    except ValueError:
+        return False
+
+    with _transfers_lock:
+        transfer = _transfers.get(token)
+        if transfer is None or (offset, length) not in transfer[1]:
+            return False
+        transfer[1].remove((offset, length))
+        transfer[0].put((streamSocket, offset, length))
+    return True
+
+
+def receive_stream(streamSocket, offset, length, fileName):
+
+    """
+    Receives one byte range of a parallel upload and writes it in place.
+
+    Parameters:
+    - streamSocket (socket.socket): The TCP socket of this stream.
+    - offset (int): The first byte of the range.
+    - length (int): The number of bytes in the range.
+    - fileName (str): The name of the preallocated file.
+    """
+
+    try:
+        recv_range(streamSocket, fileName, offset, length)
+    finally:
+        streamSocket.close()
+
+
+@metrics.timed('receive_file', transport='tcp', command='pput')
+def receive_file_parallel(connectionSocket, fileName, num_bytes, streams):
+
+    """
+    Receives a file from the client over several parallel TCP connections.
+
+    The file is preallocated to its final size, then the client opens one extra connection
+    per byte range and each range is written at its offset as it arrives. The file replaces
+    any previous one once all ranges have arrived.
+
+    Parameters:
+    - connectionSocket (socket.socket): The server TCP socket connected to the client.
+    - fileName (str): The name of the file to save the received data.
+    - num_bytes (int): The size of the file.
+    - streams (int): The number of streams requested by the client.
+
+    Raises:
+    - IOError: If there is an error opening or writing to the file.
+    - TransferError: If one of the streams fails.
+    """
+
+    try:
+        output = OutputFile(fileName, num_bytes)
     except IOError as e:
         print 'Error: Unable to open file ', fileName, ': ', e
         sys.exit(1)
 
+    # let the client open its streams, one per byte range
+    ranges = split_ranges(num_bytes, streams)
+
+    try:
+        with output:
+            streams = accept_streams(connectionSocket, 'READY', ranges)
+            run_streams(receive_stream, [stream + (output.path,) for stream in streams])
+    except TransferError as e:
+        metrics.inc('transfer_errors_total', transport='tcp', command='pput')
+        print e
+        sys.exit(1)
+    except IOError as e:
+        print 'Error: Unable to save file ', fileName, ': ', e
+        sys.exit(1)
+
+    metrics.inc('bytes_received_total', num_bytes, transport='tcp', command='pput')
+
+    connectionSocket.send('File uploaded.')
+
+    print 'Done receiving file.'
+
+
+def send_stream(streamSocket, offset, length, fileName):
+
+    """
+    Sends the byte range requested by one stream of a parallel download.
+
+    Parameters:
+    - streamSocket (socket.socket): The TCP socket of this stream.
+    - offset (int): The first byte of the range.
+    - length (int): The number of bytes in the range.
+    - fileName (str): The name of the file to be sent.
+    """
+
+    try:
+        send_range(streamSocket, fileName, offset, length)
+    finally:
+        streamSocket.close()
+
+
+@metrics.timed('send_file', transport='tcp', command='pget')
+def send_file_parallel(connectionSocket, fileName, streams):
+
+    """
+    Sends a file to the client over several parallel TCP connections.
+
+    The file size and the transfer token are sent first as "LEN:Bytes:Token" ("LEN:-1" if
+    the file does not exist), then the client opens one extra connection per byte range.
+
+    Parameters:
+    - connectionSocket (socket.socket): The server TCP socket connected to the client.
+    - fileName (str): The name of the file to be sent.
+    - streams (int): The number of streams requested by the client.
+
+    Raises:
+    - TransferError: If one of the streams fails.
+    """
+
+    if not os.path.isfile(fileName):
+        print 'Error: Unable to open file ', fileName
+        connectionSocket.send('LEN:-1')
+        connectionSocket.send(b'\0')
+        return
+
+    num_bytes = os.path.getsize(fileName)
+    ranges = split_ranges(num_bytes, streams)
+
+    try:
+        streams = accept_streams(connectionSocket, 'LEN:' + str(num_bytes), ranges)
+        run_streams(send_stream, [stream + (fileName,) for stream in streams])
+    except TransferError as e:
+        metrics.inc('transfer_errors_total', transport='tcp', command='pget')
+        print e
+        sys.exit(1)
+
+    metrics.inc('bytes_sent_total', num_bytes, transport='tcp', command='pget')
+
     print 'Done sending file.'
 
 
+@metrics.timed('receive_file', transport='tcp', command='sput')
+def receive_file_delta(connectionSocket, fileName, count):
+
+    """
+    Receives a file from the client, skipping the chunks the server already has.
+
+    The client sends the signature (digest and length) of each content-defined chunk of
+    the file. The server answers with one character per chunk, '1' if it can take the chunk
+    from its current copy of the file (or from earlier in the upload) and '0' if the chunk
+    must be sent, then receives the missing chunks and assembles the new file.
+
+    Parameters:
+    - connectionSocket (socket.socket): The server TCP socket connected to the client.
+    - fileName (str): The name of the file to save the received data.
+    - count (int): The number of chunk signatures the client sends.
+
+    Raises:
+    - IOError: If there is an error opening or writing to the file.
+    - TransferError: If the connection closes early or a chunk does not match its digest.
+    """
+
+    try:
+        signatures = unpack_signatures(recv_exact(connectionSocket, count * SIGNATURE.size))
+    except TransferError as e:
+        metrics.inc('transfer_errors_total', transport='tcp', command='sput')
+        print e
+        sys.exit(1)
+
+    # chunks of the previous version of the file
+    base = {}
+    if os.path.isfile(fileName):
+        for offset, length, digest in file_signatures(fileName):
+            base.setdefault(digest, (offset, length))
+
+    # ask only for the first occurrence of each chunk we don't have
+    have = []
+    uses = {}
+    for digest, length in signatures:
+        have.append('1' if digest in base or digest in uses else '0')
+        uses[digest] = uses.get(digest, 0) + 1
+    connectionSocket.sendall(''.join(have))
+
+    # assemble the new file next to the old one, then replace it
+    chunks = []
+    fresh = {}
+    try:
+        with OutputFile(fileName, sum(length for digest, length in signatures)) as output:
+            base_fp = open(fileName, 'rb') if base else None
+            try:
+                offset = 0
+                for (digest, length), flag in zip(signatures, have):
+                    if flag == '0':
+                        data = recv_exact(connectionSocket, length)
+                        if hashlib.sha1(data).digest() != digest:
+                            raise TransferError('Error: Chunk at offset ' + str(offset) + ' does not match its digest.')
+                    elif digest in base:
+                        base_fp.seek(base[digest][0])
+                        data = base_fp.read(length)
+                    else:
+                        data = fresh[digest]
+
+                    # keep new chunks that appear again later in the file
+                    uses[digest] -= 1
+                    if digest not in base and uses[digest]:
+                        fresh[digest] = data
+                    else:
+                        fresh.pop(digest, None)
+
+                    output.write(data)
+                    chunks.append((offset, length, digest))
+                    offset += length
+            finally:
+                if base_fp:
+                    base_fp.close()
+    except IOError as e:
+        print 'Error: Unable to open file ', fileName, ': ', e
+        sys.exit(1)
+    except TransferError as e:
+        metrics.inc('transfer_errors_total', transport='tcp', command='sput')
+        print e
+        sys.exit(1)
+
+    remember_signatures(fileName, chunks)
+
+    received = sum(length for (digest, length), flag in zip(signatures, have) if flag == '0')
+    metrics.inc('bytes_received_total', received, transport='tcp', command='sput')
+    metrics.inc('delta_bytes_reused_total', offset - received, transport='tcp')
+
+    connectionSocket.send('File uploaded.')
+
+    print 'Done receiving file.'
+
+
+@metrics.timed('anonymize', transport='tcp')
 def anon(connectionSocket, keyword, fileName):
 
     """
@@ -99,28 +439,27 @@ def anon(connectionSocket, keyword, fileName):
 
     Raises:
         IOError: If there is an error opening the file.
+        ValueError: If the file or keyword can't be decoded; reported to the client.
     """
 
-    # open the file for reading, and anonymize the keyword
-    try:
-        with open(fileName, 'rb') as og_fp:
-            og_text = og_fp.read()
-            anon_text = og_text.replace(keyword.encode(), b'X' * len(keyword))
-    except IOError as e:
-        print 'Error: Unable to open file ', fileName, ': ', e
-        sys.exit(1)
-
     # get anonymized file name
     raw_file_name = fileName[:-4]
     anon_file_name = raw_file_name + '_anon.txt'
 
-    # create the anonymized file and write the content
+    # anonymize the keyword into the new file
     try:
-        with open(anon_file_name, 'wb') as anon_fp:
-            anon_fp.write(anon_text)
+        anonymize_file(fileName, anon_file_name, [keyword])
     except IOError as e:
-        print 'Error: Unable to open file ', anon_file_name, ': ', e
+        print 'Error: Unable to open file ', e.filename, ': ', e
         sys.exit(1)
+    except ValueError as e:
+        # the file or keyword is not valid text for the text engine, the server carries on
+        print 'Error: Unable to anonymize file ', fileName, ': ', e
+        serverResponse = 'Error: ' + str(e)
+        connectionSocket.send(serverResponse.encode())
+        return
+
+    metrics.inc('anonymized_bytes_total', os.path.getsize(fileName), transport='tcp')
 
     # send the server response to the client
     serverResponse = 'File ' + fileName + ' anonymized. Output file is ' + anon_file_name
@@ -129,66 +468,424 @@ def anon(connectionSocket, keyword, fileName):
     print 'Done anonymizing file.'
 
 
-def main():
+def anon_job(keyword, fileName):
 
     """
-    Main function to handle server operations for receiving commands from a client over TCP.
+    Anonymizes a file in a worker thread of the job queue.
+
+    Returns:
+        str: The server response, the same one anon() sends.
+
+    Raises:
+        IOError: If there is an error opening the file.
     """
 
-    # create socket, wait for incoming connection request from client
-    serverPort = validate_args()
-    serverSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    serverSocket.bind(('', serverPort))
+    anon_file_name = fileName[:-4] + '_anon.txt'
+    with metrics.span('anonymize', transport='tcp'), profiler.command('tcp', 'job'):
+        anonymize_file(fileName, anon_file_name, [keyword])
+    metrics.inc('anonymized_bytes_total', os.path.getsize(fileName), transport='tcp')
+
+    return 'File ' + fileName + ' anonymized. Output file is ' + anon_file_name
 
-    # server begins listening for incoming TCP requests
-    serverSocket.listen(1)
 
-    # server waits on accept() for incoming request, new socket created on return
-    connectionSocket, addr = serverSocket.accept()
+def submit_job(connectionSocket, keyword, fileName, priority):
+
+    """
+    Queues the anonymization of a file and sends the job ID to the client right away.
+
+    Parameters:
+        connectionSocket (socket.socket): The socket connected to the client.
+        keyword (str): The keyword to be anonymized.
+        fileName (str): The name of the file to be anonymized.
+        priority (str): One of jobs.PRIORITIES.
+    """
+
+    # smaller files are served first within a priority
+    size = os.path.getsize(fileName) if os.path.isfile(fileName) else 0
+
+    try:
+        job = jobs.default_queue().submit(anon_job, (keyword, fileName), priority, size)
+    except (jobs.QueueFull, ValueError) as e:
+        connectionSocket.send(str(e))
+        return
+
+    connectionSocket.send('Job ' + str(job.id) + ' queued.')
+
+    print 'Queued job', job.id
+
+
+def job_status(connectionSocket, job_id, wait):
+
+    """
+    Sends the status of a job to the client, after waiting for the job to finish if wait is set.
+    """
+
+    queue = jobs.default_queue()
+    job = queue.get(int(job_id)) if job_id.isdigit() else None
+    if job is None:
+        serverResponse = 'Unknown job ' + job_id + '.'
+    elif wait:
+        serverResponse = queue.wait(job)
+    else:
+        serverResponse = queue.describe(job)
+
+    connectionSocket.send(serverResponse)
+
+
+def recv_count(connectionSocket):
+
+    """
+    Reads a null-terminated, non-negative integer field of a command header.
+
+    Raises:
+    - ValueError: If the field is not such an integer, or the connection closed before it.
+    """
+
+    field = recv_field(connectionSocket)
+    if not field.isdigit():
+        raise ValueError('Expected a number, received \'' + field + '\'')
+    return int(field)
+
+
+def send_reply(connectionSocket, status, value):
+
+    """
+    Sends the reply to a framed command: 'OK' or 'ERR', then a value, each null-terminated.
+    """
+
+    connectionSocket.sendall(status + b'\0' + str(value) + b'\0')
+
+
+@metrics.timed('receive_file', transport='tcp', command='fput')
+def receive_file_framed(connectionSocket, fileName, num_bytes):
+
+    """
+    Receives a file of known size from the client, for clients that keep their connection open.
+
+    Unlike put, the end of the file is given by its size instead of a short read, so any
+    content works and the next command can follow on the same connection. Errors are sent
+    back as an 'ERR' reply; when the file can't be saved, the rest of its data is still
+    read so that the connection stays usable.
+
+    Parameters:
+    - connectionSocket (socket.socket): The server TCP socket connected to the client.
+    - fileName (str): The name of the file to save the received data.
+    - num_bytes (int): The size of the file.
+
+    Raises:
+    - IOError: If there is an error opening or writing to the file.
+    - TransferError: If the connection closes early.
+    """
+
+    remaining = num_bytes
+    try:
+        with OutputFile(fileName, num_bytes) as output:
+            while remaining:
+                data = connectionSocket.recv(min(STREAM_BUFFER, remaining))
+                if not data:
+                    raise TransferError('Data transmission terminated prematurely.')
+                remaining -= len(data)
+                output.write(data)
+    except IOError as e:
+        print 'Error: Unable to open file ', fileName, ': ', e
+        while remaining:
+            data = connectionSocket.recv(min(STREAM_BUFFER, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+        send_reply(connectionSocket, 'ERR', e)
+        return
+    except TransferError as e:
+        metrics.inc('transfer_errors_total', transport='tcp', command='fput')
+        print e
+        send_reply(connectionSocket, 'ERR', e)
+        return
+
+    metrics.inc('bytes_received_total', num_bytes, transport='tcp', command='fput')
+
+    send_reply(connectionSocket, 'OK', num_bytes)
+
+    print 'Done receiving file.'
+
+
+@metrics.timed('send_file', transport='tcp', command='fget')
+def send_file_framed(connectionSocket, fileName):
+
+    """
+    Sends a file to the client as its size followed by its content.
+
+    Parameters:
+    - connectionSocket (socket.socket): The server TCP socket connected to the client.
+    - fileName (str): The name of the file to be sent.
+
+    Raises:
+    - TransferError: If the file shrinks while it is sent.
+    """
+
+    if not os.path.isfile(fileName):
+        print 'Error: Unable to open file ', fileName
+        send_reply(connectionSocket, 'ERR', 'No such file ' + fileName)
+        return
+
+    num_bytes = os.path.getsize(fileName)
+    send_reply(connectionSocket, 'OK', num_bytes)
+    try:
+        send_range(connectionSocket, fileName, 0, num_bytes)
+    except (IOError, OSError, TransferError) as e:
+        metrics.inc('transfer_errors_total', transport='tcp', command='fget')
+        print 'Error: Unable to send file ', fileName, ': ', e
+        sys.exit(1)
+
+    metrics.inc('bytes_sent_total', num_bytes, transport='tcp', command='fget')
+
+    print 'Done sending file.'
+
+
+def anon_framed(connectionSocket, keyword, fileName):
+
+    """
+    Anonymizes a file and replies with the name of the anonymized file, or the error.
+    """
+
+    try:
+        anon_job(keyword, fileName)
+    except (IOError, ValueError) as e:
+        print 'Error: Unable to anonymize file ', fileName, ': ', e
+        send_reply(connectionSocket, 'ERR', e)
+        return
+
+    send_reply(connectionSocket, 'OK', fileName[:-4] + '_anon.txt')
+
+    print 'Done anonymizing file.'
+
+
+def recv_command(connectionSocket):
+
+    """
+    Reads the next command from a client connection, and nothing past it.
+
+    Clients send the arguments right after the command, so both can arrive in the same
+    segment. The data is peeked at first and only the longest command it starts with is
+    consumed, leaving the arguments to the command handler.
+
+    Returns:
+    - str: The command, or '' if the client closed the connection.
+    """
+
+    data = connectionSocket.recv(1024, socket.MSG_PEEK)
+    known = [command for command in COMMANDS if data.startswith(command)]
+    command = max(known, key=len) if known else data
+    return connectionSocket.recv(len(command)) if command else command
+
+
+def serve_connection(serverSocket, connectionSocket):
+
+    """
+    Handles the commands of one client connection until the client disconnects or quits.
+
+    Parameters:
+    - serverSocket (socket.socket): The listening server socket, shut down by quit.
+    - connectionSocket (socket.socket): The server TCP socket connected to the client.
+    """
 
     while 1:
         # read bytes from socket (but not address like UDP)
-        command = connectionSocket.recv(1024)
+        command = recv_command(connectionSocket)
+        if not command:
+            break
 
-        # command handling
-        if command == 'put':
+        # quit stops the whole server, the exit is not an error
+        if command == 'quit':
+            print 'Exiting program!'
+            _stopping.set()
+            serverSocket.shutdown(socket.SHUT_RDWR)
+            break
 
-            fileNameRaw = b''
-            while 1:
-                data = connectionSocket.recv(1)
-                if data == b'\0':  # check for null byte delimiter
-                    break
-                fileNameRaw += data
+        # profiling is switched on and off between commands, so it is not profiled itself
+        if command == 'profile':
+            connectionSocket.send(profiler.admin(recv_field(connectionSocket)))
+            continue
 
-            fileName = fileNameRaw.decode()
+        # command handling, timed (and profiled while profiling is on) per command
+        label = command if command in COMMANDS else 'unknown'
+        with metrics.span('command', transport='tcp', command=label), profiler.command('tcp', label):
+            # the handlers report their own errors, a ValueError here comes from a malformed
+            # header, after which the rest of the connection can't be parsed
+            try:
+                if command == 'put':
 
-            # receive_file(connectionSocket, fileName)
-            # read each line in a loop, create new copy of file
-            receive_file(connectionSocket, fileName)
+                    fileNameRaw = b''
+                    while 1:
+                        data = connectionSocket.recv(1)
+                        if data == b'\0':  # check for null byte delimiter
+                            break
+                        fileNameRaw += data
 
-        elif command == 'get':
+                    fileName = fileNameRaw.decode()
 
-            fileName = connectionSocket.recv(1024)
-            send_file(connectionSocket, fileName)
+                    # receive_file(connectionSocket, fileName)
+                    # read each line in a loop, create new copy of file
+                    receive_file(connectionSocket, fileName)
 
-        elif command == 'keyword':
+                elif command == 'get':
 
-            keywordRaw = b''
-            while 1:
-                data = connectionSocket.recv(1)
-                if data == b'\0':  # check for null byte delimiter
-                    break
-                keywordRaw += data
+                    fileName = connectionSocket.recv(1024)
+                    send_file(connectionSocket, fileName)
 
-            keyword = keywordRaw.decode()
-            fileName = connectionSocket.recv(1024)  # this could be file path, have to handle to get file name
+                elif command == 'keyword':
 
-            anon(connectionSocket, keyword, fileName)
+                    keywordRaw = b''
+                    while 1:
+                        data = connectionSocket.recv(1)
+                        if data == b'\0':  # check for null byte delimiter
+                            break
+                        keywordRaw += data
 
-        elif command == 'quit':
-            print 'Exiting program!'
+                    keyword = keywordRaw
+                    fileName = connectionSocket.recv(1024)  # this could be file path, have to handle to get file name
+
+                    anon(connectionSocket, keyword, fileName)
+
+                elif command == 'pput':
+
+                    # file name, size and number of streams, each null-terminated
+                    fileName = recv_field(connectionSocket).decode()
+                    num_bytes = recv_count(connectionSocket)
+                    streams = recv_count(connectionSocket)
+
+                    receive_file_parallel(connectionSocket, fileName, num_bytes, streams)
+
+                elif command == 'sput':
+
+                    # file name and number of chunks, each null-terminated, then the signatures
+                    fileName = recv_field(connectionSocket).decode()
+                    count = recv_count(connectionSocket)
+                    receive_file_delta(connectionSocket, fileName, count)
+
+                elif command == 'pget':
+
+                    fileName = recv_field(connectionSocket)
+                    streams = recv_count(connectionSocket)
+
+                    send_file_parallel(connectionSocket, fileName, streams)
+
+                elif command == 'submit':
+
+                    # keyword, file name and priority, each null-terminated
+                    keyword = recv_field(connectionSocket)
+                    fileName = recv_field(connectionSocket)
+                    priority = recv_field(connectionSocket)
+
+                    submit_job(connectionSocket, keyword, fileName, priority)
+
+                elif command in ('status', 'wait'):
+
+                    job_id = recv_field(connectionSocket)
+                    job_status(connectionSocket, job_id, command == 'wait')
+
+                elif command == 'fput':
+
+                    # file name and size, each null-terminated, then the file
+                    fileName = recv_field(connectionSocket)
+                    num_bytes = recv_count(connectionSocket)
+                    receive_file_framed(connectionSocket, fileName, num_bytes)
+
+                elif command == 'fget':
+
+                    fileName = recv_field(connectionSocket)
+                    send_file_framed(connectionSocket, fileName)
+
+                elif command == 'fkeyword':
+
+                    keyword = recv_field(connectionSocket)
+                    fileName = recv_field(connectionSocket)
+                    anon_framed(connectionSocket, keyword, fileName)
+            except ValueError as e:
+                print 'Error: Invalid', command, 'request:', e
+                if command == 'fput':
+                    send_reply(connectionSocket, 'ERR', e)
+                else:
+                    connectionSocket.sendall('Error: ' + str(e) + b'\0')
+                break
+
+
+def route_connection(serverSocket, connectionSocket):
+
+    """
+    Runs in a thread per accepted connection: hands the streams of parallel transfers
+    (which start with their "token:offset:length" header) to accept_streams(), and serves
+    the commands of every other connection.
+
+    A command handler that fails ends its connection only, not the server.
+    """
+
+    handedOver = False
+    try:
+        first = connectionSocket.recv(1, socket.MSG_PEEK)
+        if first.isdigit():
+            handedOver = hand_over_stream(connectionSocket)
+            if not handedOver:
+                print 'Dropped a stream of no transfer in progress.'
+        elif first:
+            serve_connection(serverSocket, connectionSocket)
+    except (socket.error, SystemExit):
+        pass
+    finally:
+        # a stream that was handed over now belongs to its transfer
+        if not handedOver:
+            connectionSocket.close()
+
+
+def main():
+
+    """
+    Main function to handle server operations for receiving commands from clients over TCP.
+    """
+
+    # create socket, wait for incoming connection requests from clients
+    serverPort = validate_args()
+    metrics.start()
+
+    # fail early on an unknown ANON_ENGINE, ANON_FSYNC or ANON_PROFILE_MODE
+    try:
+        default_engine()
+        fsync_policy()
+        profiler.setup()
+    except ValueError as e:
+        print 'Error:', e
+        sys.exit(1)
+
+    # map the redaction dictionary once, before any anonymization worker is forked
+    dictionaryPath = os.environ.get('ANON_DICTIONARY')
+    if dictionaryPath:
+        try:
+            with profiler.command('tcp', 'startup'):
+                load_dictionary(dictionaryPath)
+        except (IOError, ValueError) as e:
+            print 'Error: Unable to load dictionary', dictionaryPath, ':', e
             sys.exit(1)
 
+    serverSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    serverSocket.bind(('', serverPort))
+
+    # server begins listening for incoming TCP requests (extra backlog for parallel streams)
+    serverSocket.listen(MAX_STREAMS)
+
+    # every connection is served in its own thread, so several clients (or the pooled
+    # connections of client_async.py) can have commands in progress at the same time
+    while 1:
+        try:
+            connectionSocket, addr = serverSocket.accept()
+        except socket.error:
+            # quit has shut the listening socket down
+            if _stopping.is_set():
+                sys.exit(1)
+            raise
+
+        thread = threading.Thread(target=route_connection, args=(serverSocket, connectionSocket))
+        thread.daemon = True
+        thread.start()
+
 
 if __name__ == '__main__':
     main()
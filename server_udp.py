@@ -2,6 +2,16 @@ import socket
 import os
 import sys
 
+import jobs
+import metrics
+import profiler
+from anonymize import anonymize_file, default_engine, load_dictionary
+from congestion import controller_name, new_controller, transfer_limit
+from output import OutputFile, fsync_policy
+from parallel import TransferError, recv_range_request, recv_range_udp, run_streams, send_range_udp, \
+    split_ranges
+from window import recv_range_window, send_range_window
+
 
 def validate_args():
     """
@@ -27,20 +37,34 @@ def validate_args():
     return port
 
 
+# commands understood by main(), anything else is labelled 'unknown' in the metrics
+COMMANDS = ('put', 'get', 'keyword', 'pput', 'pget', 'submit', 'status', 'wait', 'profile', 'quit')
+
+# longest a wait command holds the command loop, which serves one command at a time;
+# the status is sent when it runs out, and the client asks again
+WAIT_TIMEOUT = 1.0
+
+# commands made of one request and one reply, which leave no stray datagrams behind: the
+# socket is kept after them, so that commands sent meanwhile by other clients are not lost
+REPLY_COMMANDS = ('submit', 'status', 'wait', 'profile')
+
+
+@metrics.timed('receive_file', transport='udp', command='put')
 def receive_file(serverSocket, fileName):
 
     """
     Receive a file from a client over UDP and save it locally.
 
     Implements "stop-and-wait" functionality, i.e. after each chunk is received,
-    sends ACK to client before receiving next chunk.
+    sends ACK to client before receiving next chunk. A client with congestion control
+    sends 'WLEN:' instead of 'LEN:' and the file is received with a sliding window.
 
     Parameters:
     - serverSocket (socket): The server UDP socket for communicating with the client.
     - fileName (str): The name of the file to be saved.
 
     Raises:
-    - Error: If the length message does not start with 'LEN:'.
+    - Error: If the length message does not start with 'LEN:' or 'WLEN:'.
     - ValueError: If the substring after 'LEN:' cannot be converted to an integer.
     - IOError: If there is an error while writing the received file to the disk.
     - socket.timeout: If no data is received within 1 second after sending LEN message,
@@ -50,9 +74,9 @@ def receive_file(serverSocket, fileName):
     # first get length of data to be transferred
     len_msg, clientAddress = serverSocket.recvfrom(1024)
 
-    # check length message for string "LEN:Bytes"
-    if len_msg.startswith('LEN:'):
-        str_bytes = len_msg[4:]
+    # check length message for string "LEN:Bytes" or "WLEN:Bytes"
+    if len_msg.startswith('LEN:') or len_msg.startswith('WLEN:'):
+        str_bytes = len_msg.split(':', 1)[1]
         try:
             # convert substring to int
             num_bytes = int(str_bytes)
@@ -67,6 +91,10 @@ def receive_file(serverSocket, fileName):
         print 'Error: Expected LEN message \'LEN:Bytes\', received', len_msg
         sys.exit(1)
 
+    if len_msg.startswith('WLEN:'):
+        receive_file_window(serverSocket, clientAddress, fileName, num_bytes)
+        return
+
     data_chunks = []
     ack_msg = 'ACK'
 
@@ -81,6 +109,7 @@ def receive_file(serverSocket, fileName):
         data_chunk, clientAddress = serverSocket.recvfrom(1000)
         data_chunks.append(data_chunk)
     except socket.timeout:
+        metrics.inc('timeouts_total', transport='udp', command='put', stage='len')
         print 'Did not receive data. Terminating.'
         sys.exit(1)
 
@@ -95,6 +124,7 @@ def receive_file(serverSocket, fileName):
             data_chunk, clientAddress = serverSocket.recvfrom(1000)
             data_chunks.append(data_chunk)
         except socket.timeout:
+            metrics.inc('timeouts_total', transport='udp', command='put', stage='data')
             print 'Data transmission terminated prematurely.'
             sys.exit(1)
 
@@ -109,24 +139,58 @@ def receive_file(serverSocket, fileName):
     serverResponse = 'File uploaded.'
     serverSocket.sendto(serverResponse, clientAddress)
 
-    # write each chunk to new file
+    # write each chunk to new file, which replaces the old one once complete
     try:
-        with open(fileName, 'wb') as fp:
+        with OutputFile(fileName, num_bytes) as output:
             for chunk in data_chunks:
-                fp.write(chunk)
+                output.write(chunk)
     except IOError as e:
         print 'Error: Unable to open file ', fileName, ': ', e
         sys.exit(1)
 
+    metrics.inc('bytes_received_total', num_bytes, transport='udp', command='put')
+
     print 'Done receiving file.'
 
 
+def receive_file_window(serverSocket, clientAddress, fileName, num_bytes):
+
+    """
+    Receive an upload sent with a sliding window (see window.py) and save it locally.
+
+    Raises:
+    - IOError: If there is an error while writing the received file to the disk.
+    - TransferError: If no data is received within 1 second.
+    """
+
+    try:
+        with OutputFile(fileName, num_bytes) as output:
+            clientAddress = recv_range_window(serverSocket, clientAddress, output.path, 0, num_bytes)
+    except TransferError as e:
+        metrics.inc('transfer_errors_total', transport='udp', command='put')
+        print e
+        sys.exit(1)
+    except (IOError, OSError) as e:
+        print 'Error: Unable to open file ', fileName, ': ', e
+        sys.exit(1)
+
+    # send response to client
+    serverResponse = 'File uploaded.'
+    serverSocket.sendto(serverResponse, clientAddress)
+
+    metrics.inc('bytes_received_total', num_bytes, transport='udp', command='put')
+
+    print 'Done receiving file.'
+
+
+@metrics.timed('send_file', transport='udp', command='get')
 def send_file(serverSocket, clientAddress, filePath):
 
     """
     Sends a file over a UDP connection to the client.
 
     Implements "stop-and-wait" functionality, i.e. after each chunk is sent, server waits for an ACK from the client.
+    When ANON_UDP_CC selects a congestion controller, the file is sent with a sliding window instead.
 
     Parameters:
     - serverSocket (socket.socket): The server UDP socket to communicate with the client.
@@ -138,6 +202,11 @@ def send_file(serverSocket, clientAddress, filePath):
     - socket.timeout: If an ACK message is not received within 1 second after sending a chunk.
     """
 
+    controller = new_controller()
+    if controller is not None:
+        send_file_window(serverSocket, clientAddress, filePath, controller)
+        return
+
     # read in data from file
     try:
         with open(filePath, 'rb') as fp:
@@ -174,6 +243,7 @@ def send_file(serverSocket, clientAddress, filePath):
         try:
             ack_msg, clientAddress = serverSocket.recvfrom(1024)
         except socket.timeout:
+            metrics.inc('timeouts_total', transport='udp', command='get', stage='ack')
             print 'Did not receive ACK. Terminating.'
             sys.exit(1)
 
@@ -184,9 +254,217 @@ def send_file(serverSocket, clientAddress, filePath):
     else:
         print 'Error: Expected FIN message, received:', fin_msg
 
+    metrics.inc('bytes_sent_total', num_bytes, transport='udp', command='get')
+
+    print 'Done sending file.'
+
+
+def send_file_window(serverSocket, clientAddress, filePath, controller):
+
+    """
+    Sends a file to the client with a sliding window paced by controller (see window.py).
+
+    The length is announced as "WLEN:Bytes" so the client switches to the windowed receiver.
+
+    Raises:
+    - TransferError: If no chunk is acknowledged for window.IDLE_TIMEOUT seconds.
+    """
+
+    if not os.path.isfile(filePath):
+        print 'Error: Unable to open file', filePath
+        sys.exit(1)
+
+    num_bytes = os.path.getsize(filePath)
+    serverSocket.sendto('WLEN:' + str(num_bytes), clientAddress)
+    if num_bytes == 0:
+        print 'Length of data cannot be 0.'
+        sys.exit(1)
+
+    try:
+        send_range_window(serverSocket, clientAddress, filePath, 0, num_bytes, controller, transfer_limit())
+    except TransferError as e:
+        metrics.inc('transfer_errors_total', transport='udp', command='get')
+        print e
+        sys.exit(1)
+    serverSocket.close()
+
+    metrics.inc('bytes_sent_total', num_bytes, transport='udp', command='get')
+
+    print 'Done sending file.'
+
+
+def open_flows(count):
+
+    """
+    Opens one UDP socket on an ephemeral port for each flow of a parallel transfer.
+
+    Returns:
+    - list: The bound sockets.
+    """
+
+    flowSockets = []
+    for _ in range(count):
+        flowSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        flowSocket.bind(('', 0))
+        flowSockets.append(flowSocket)
+    return flowSockets
+
+
+def ports_message(flowSockets):
+
+    """
+    Builds the "PORTS:p1,p2,..." message telling the client where to open its flows.
+    """
+
+    return 'PORTS:' + ','.join(str(flowSocket.getsockname()[1]) for flowSocket in flowSockets)
+
+
+def receive_flow(flowSocket, fileName, ranges):
+
+    """
+    Receives one byte range of a parallel upload over its own UDP flow.
+
+    The flow starts with a "RANGE:offset:length" message from the client, or
+    "WRANGE:offset:length" if the client sends it with a sliding window. The range
+    must be one of the ranges of the transfer that no other flow has taken.
+    """
+
+    try:
+        offset, length, clientAddress, windowed = recv_range_request(flowSocket, ranges)
+        if windowed:
+            recv_range_window(flowSocket, clientAddress, fileName, offset, length)
+        else:
+            recv_range_udp(flowSocket, clientAddress, fileName, offset, length)
+    finally:
+        flowSocket.close()
+
+
+@metrics.timed('receive_file', transport='udp', command='pput')
+def receive_file_parallel(serverSocket, clientAddress, fileName, num_bytes, streams):
+
+    """
+    Receive a file from a client over several parallel UDP flows and save it locally.
+
+    The file is preallocated to its final size and each flow writes its byte range at
+    its offset, using "stop-and-wait" reliability within the flow. The file replaces any
+    previous one once all ranges have arrived.
+
+    Parameters:
+    - serverSocket (socket): The server UDP socket for communicating with the client.
+    - clientAddress (tuple): The address of the client.
+    - fileName (str): The name of the file to be saved.
+    - num_bytes (int): The size of the file.
+    - streams (int): The number of flows requested by the client.
+
+    Raises:
+    - IOError: If there is an error while creating the file.
+    - TransferError: If one of the flows fails.
+    """
+
+    try:
+        output = OutputFile(fileName, num_bytes)
+    except IOError as e:
+        print 'Error: Unable to open file ', fileName, ': ', e
+        sys.exit(1)
+
+    # tell the client which port serves each byte range
+    ranges = split_ranges(num_bytes, streams)
+    flowSockets = open_flows(len(ranges))
+    serverSocket.sendto(ports_message(flowSockets), clientAddress)
+
+    try:
+        with output:
+            run_streams(receive_flow, [(flowSocket, output.path, ranges) for flowSocket in flowSockets])
+    except TransferError as e:
+        metrics.inc('transfer_errors_total', transport='udp', command='pput')
+        print e
+        sys.exit(1)
+    except IOError as e:
+        print 'Error: Unable to save file ', fileName, ': ', e
+        sys.exit(1)
+
+    metrics.inc('bytes_received_total', num_bytes, transport='udp', command='pput')
+
+    # send response to client
+    serverResponse = 'File uploaded.'
+    serverSocket.sendto(serverResponse, clientAddress)
+
+    print 'Done receiving file.'
+
+
+def send_flow(flowSocket, filePath, ranges, limit):
+
+    """
+    Sends the byte range requested by one flow of a parallel download, if it is one of
+    the ranges of the transfer that no other flow has taken.
+
+    With congestion control enabled each flow has its own controller, while limit
+    (None without ANON_UDP_RATE) is shared by all the flows of the transfer.
+    """
+
+    try:
+        offset, length, clientAddress, windowed = recv_range_request(flowSocket, ranges)
+        controller = new_controller()
+        if controller is not None:
+            send_range_window(flowSocket, clientAddress, filePath, offset, length, controller, limit)
+        else:
+            send_range_udp(flowSocket, clientAddress, filePath, offset, length)
+    finally:
+        flowSocket.close()
+
+
+@metrics.timed('send_file', transport='udp', command='pget')
+def send_file_parallel(serverSocket, clientAddress, filePath, streams):
+
+    """
+    Sends a file to the client over several parallel UDP flows.
+
+    The file size is sent first as "LEN:Bytes" (-1 if the file does not exist), followed by
+    the ports of the flows, one per byte range. With congestion control enabled, the size
+    is sent as "WLEN:Bytes" and the flows use a sliding window.
+
+    Parameters:
+    - serverSocket (socket.socket): The server UDP socket to communicate with the client.
+    - clientAddress (tuple): The address of the client.
+    - filePath (str): The path of the file to be sent.
+    - streams (int): The number of flows requested by the client.
+
+    Raises:
+    - TransferError: If one of the flows fails.
+    """
+
+    if not os.path.isfile(filePath):
+        print 'Error: Unable to open file', filePath
+        serverSocket.sendto('LEN:-1', clientAddress)
+        return
+
+    num_bytes = os.path.getsize(filePath)
+    len_msg = 'WLEN:' if new_controller() is not None else 'LEN:'
+    serverSocket.sendto(len_msg + str(num_bytes), clientAddress)
+
+    # an empty file has no byte ranges, the client creates it from the size alone
+    ranges = split_ranges(num_bytes, streams)
+    if not ranges:
+        print 'Done sending file.'
+        return
+
+    flowSockets = open_flows(len(ranges))
+    serverSocket.sendto(ports_message(flowSockets), clientAddress)
+
+    limit = transfer_limit()
+    try:
+        run_streams(send_flow, [(flowSocket, filePath, ranges, limit) for flowSocket in flowSockets])
+    except TransferError as e:
+        metrics.inc('transfer_errors_total', transport='udp', command='pget')
+        print e
+        sys.exit(1)
+
+    metrics.inc('bytes_sent_total', num_bytes, transport='udp', command='pget')
+
     print 'Done sending file.'
 
 
+@metrics.timed('anonymize', transport='udp')
 def anon(serverSocket, clientAddress, keyword, filePath):
 
     """
@@ -202,31 +480,30 @@ def anon(serverSocket, clientAddress, keyword, filePath):
     Raises:
     - IOError: If there is an error opening or reading the file.
     - IOError: If there is an error creating or writing to the anonymized file.
+    - ValueError: If the file or keyword can't be decoded; reported to the client.
     """
 
     # get file name from file path
     fileName = os.path.basename(filePath)
 
-    # open the file for reading, anonymize text
-    try:
-        with open(filePath, 'rb') as og_fp:
-            og_text = og_fp.read()
-            anon_text = og_text.replace(keyword.encode(), b'X' * len(keyword))
-    except IOError as e:
-        print 'Error: Unable to open file ', filePath, ': ', e
-        sys.exit(1)
-
     # get anonymized file name
     raw_file_name = fileName[:-4]
     anon_file_name = raw_file_name + '_anon.txt'
 
-    # create new anonymized file
+    # anonymize the keyword into the new file
     try:
-        with open(anon_file_name, 'wb') as anon_fp:
-            anon_fp.write(anon_text)
+        anonymize_file(filePath, anon_file_name, [keyword])
     except IOError as e:
-        print 'Error: Unable to open file ', anon_file_name, ': ', e
+        print 'Error: Unable to open file ', e.filename, ': ', e
         sys.exit(1)
+    except ValueError as e:
+        # the file or keyword is not valid text for the text engine, the server carries on
+        print 'Error: Unable to anonymize file ', filePath, ': ', e
+        serverResponse = 'Error: ' + str(e)
+        serverSocket.sendto(serverResponse, clientAddress)
+        return
+
+    metrics.inc('anonymized_bytes_total', os.path.getsize(filePath), transport='udp')
 
     # send server response
     serverResponse = 'File ' + fileName + ' anonymized. Output file is ' + anon_file_name
@@ -235,6 +512,74 @@ def anon(serverSocket, clientAddress, keyword, filePath):
     print 'Done anonymizing file.'
 
 
+def anon_job(keyword, filePath):
+
+    """
+    Anonymizes a file in a worker thread of the job queue.
+
+    Returns:
+    - str: The server response, the same one anon() sends.
+
+    Raises:
+    - IOError: If there is an error opening the file.
+    """
+
+    fileName = os.path.basename(filePath)
+    anon_file_name = fileName[:-4] + '_anon.txt'
+    with metrics.span('anonymize', transport='udp'), profiler.command('udp', 'job'):
+        anonymize_file(filePath, anon_file_name, [keyword])
+    metrics.inc('anonymized_bytes_total', os.path.getsize(filePath), transport='udp')
+
+    return 'File ' + fileName + ' anonymized. Output file is ' + anon_file_name
+
+
+def submit_job(serverSocket, clientAddress, keyword, filePath, priority):
+
+    """
+    Queues the anonymization of a file and sends the job ID to the client right away,
+    well within the client's timeouts however large the file is.
+
+    Parameters:
+    - serverSocket (socket.socket): The server UDP socket to communicate with the client.
+    - clientAddress (tuple): The address of the client.
+    - keyword (str): The keyword to be anonymized.
+    - filePath (str): The path to the file to be anonymized.
+    - priority (str): One of jobs.PRIORITIES.
+    """
+
+    # smaller files are served first within a priority
+    size = os.path.getsize(filePath) if os.path.isfile(filePath) else 0
+
+    try:
+        job = jobs.default_queue().submit(anon_job, (keyword, filePath), priority, size)
+    except (jobs.QueueFull, ValueError) as e:
+        serverSocket.sendto(str(e), clientAddress)
+        return
+
+    serverSocket.sendto('Job ' + str(job.id) + ' queued.', clientAddress)
+
+    print 'Queued job', job.id
+
+
+def job_status(serverSocket, clientAddress, job_id, wait):
+
+    """
+    Sends the status of a job to the client, after waiting up to WAIT_TIMEOUT seconds for the
+    job to finish if wait is set.
+    """
+
+    queue = jobs.default_queue()
+    job = queue.get(int(job_id)) if job_id.isdigit() else None
+    if job is None:
+        serverResponse = 'Unknown job ' + job_id + '.'
+    elif wait:
+        serverResponse = queue.wait(job, WAIT_TIMEOUT)
+    else:
+        serverResponse = queue.describe(job)
+
+    serverSocket.sendto(serverResponse, clientAddress)
+
+
 def main():
 
     """
@@ -243,44 +588,107 @@ def main():
 
     # validate command line arguments
     serverPort = validate_args()
+    metrics.start()
+
+    # fail early on an unknown ANON_UDP_CC, ANON_ENGINE, ANON_FSYNC or ANON_PROFILE_MODE
+    try:
+        controller_name()
+        default_engine()
+        fsync_policy()
+        profiler.setup()
+    except ValueError as e:
+        print 'Error:', e
+        sys.exit(1)
+
+    # map the redaction dictionary once, before any anonymization worker is forked
+    dictionaryPath = os.environ.get('ANON_DICTIONARY')
+    if dictionaryPath:
+        try:
+            with profiler.command('udp', 'startup'):
+                load_dictionary(dictionaryPath)
+        except (IOError, ValueError) as e:
+            print 'Error: Unable to load dictionary', dictionaryPath, ':', e
+            sys.exit(1)
 
+    serverSocket = None
+    command = None
     while 1:
 
-        # create socket, reset the timeout
-        serverSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        serverSocket.bind(('', serverPort))
+        # create socket, reset the timeout (profiled on its own, it happens for most commands);
+        # the previous socket is closed first, as something may still hold a reference to it
+        if command not in REPLY_COMMANDS:
+            with profiler.command('udp', 'rebind'):
+                if serverSocket is not None:
+                    serverSocket.close()
+                serverSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                serverSocket.bind(('', serverPort))
         serverSocket.settimeout(None)
 
         # get command from client
         command, clientAddress = serverSocket.recvfrom(1024)
 
-        # command handling
-        if command == 'put':
+        # quit before timing, the exit is not an error
+        if command == 'quit':
+            print 'Exiting program!'
+            sys.exit(1)
+
+        # profiling is switched on and off between commands, so it is not profiled itself
+        if command == 'profile':
+            action, clientAddress = serverSocket.recvfrom(1024)
+            serverSocket.sendto(profiler.admin(action), clientAddress)
+            continue
 
-            fileName, clientAddress = serverSocket.recvfrom(1024)
-            receive_file(serverSocket, fileName)
+        # command handling, timed (and profiled while profiling is on) per command
+        label = command if command in COMMANDS else 'unknown'
+        with metrics.span('command', transport='udp', command=label), profiler.command('udp', label):
+            if command == 'put':
 
-        elif command == 'get':
+                fileName, clientAddress = serverSocket.recvfrom(1024)
+                receive_file(serverSocket, fileName)
 
-            filePath, clientAddress = serverSocket.recvfrom(1024)
+            elif command == 'get':
 
-            # send a message to the client indicating the file exists
-            fileExists = False
-            if os.path.isfile(filePath):
-                fileExists = True
-            serverSocket.sendto(str(fileExists), clientAddress)
+                filePath, clientAddress = serverSocket.recvfrom(1024)
 
-            send_file(serverSocket, clientAddress, filePath)
+                # send a message to the client indicating the file exists
+                fileExists = False
+                if os.path.isfile(filePath):
+                    fileExists = True
+                serverSocket.sendto(str(fileExists), clientAddress)
 
-        elif command == 'keyword':
+                send_file(serverSocket, clientAddress, filePath)
 
-            keyword, clientAddress = serverSocket.recvfrom(1024)
-            filePath, clientAddress = serverSocket.recvfrom(1024)
-            anon(serverSocket, clientAddress, keyword, filePath)
+            elif command == 'keyword':
 
-        elif command == 'quit':
-            print 'Exiting program!'
-            sys.exit(1)
+                keyword, clientAddress = serverSocket.recvfrom(1024)
+                filePath, clientAddress = serverSocket.recvfrom(1024)
+                anon(serverSocket, clientAddress, keyword, filePath)
+
+            elif command == 'pput':
+
+                # file name, then "size:streams"
+                fileName, clientAddress = serverSocket.recvfrom(1024)
+                header, clientAddress = serverSocket.recvfrom(1024)
+                num_bytes, streams = [int(field) for field in header.split(':')]
+                receive_file_parallel(serverSocket, clientAddress, fileName, num_bytes, streams)
+
+            elif command == 'pget':
+
+                filePath, clientAddress = serverSocket.recvfrom(1024)
+                streams, clientAddress = serverSocket.recvfrom(1024)
+                send_file_parallel(serverSocket, clientAddress, filePath, int(streams))
+
+            elif command == 'submit':
+
+                keyword, clientAddress = serverSocket.recvfrom(1024)
+                filePath, clientAddress = serverSocket.recvfrom(1024)
+                priority, clientAddress = serverSocket.recvfrom(1024)
+                submit_job(serverSocket, clientAddress, keyword, filePath, priority)
+
+            elif command in ('status', 'wait'):
+
+                job_id, clientAddress = serverSocket.recvfrom(1024)
+                job_status(serverSocket, clientAddress, job_id, command == 'wait')
 
 
 if __name__ == '__main__':
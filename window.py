@@ -0,0 +1,269 @@
+import os
+import socket
+import struct
+import time
+
+import metrics
+from congestion import MAX_RTO, Pacer, RttEstimator
+from parallel import CHUNK_SIZE, TransferError, pread, pwrite
+
+
+# every data packet starts with the index of its chunk within the range
+HEADER = struct.Struct('!I')
+
+# a transfer gives up after this long without progress; longer than the largest RTO
+# (congestion.MAX_RTO), so that one lost retransmission does not end the transfer
+IDLE_TIMEOUT = 5.0
+
+# duplicate ACKs that trigger a fast retransmit
+DUPACK_THRESHOLD = 3
+
+# after its FIN, the receiver keeps answering retransmissions (like TCP's TIME_WAIT) until
+# the sender confirms with FINACK or sends nothing for LINGER_QUIET seconds; a sender that
+# still waits retransmits at least every MAX_RTO
+LINGER_QUIET = 2 * MAX_RTO
+
+# socket receive buffer asked for by both ends, and the buffer space the kernel charges
+# for one packet; the receiver advertises how many packets fit in its buffer as its window
+RECEIVE_BUFFER = 4 << 20
+PACKET_COST = 3 * CHUNK_SIZE
+
+
+def resolve(address):
+
+    """
+    The numeric form of an (host, port) address, to compare with the source of a datagram.
+    """
+
+    return socket.gethostbyname(address[0]), address[1]
+
+
+def grow_receive_buffer(sock):
+
+    """
+    Ask for a RECEIVE_BUFFER byte receive buffer, so a full window is not dropped by the kernel.
+
+    Returns:
+    - int: The number of packets the buffer granted by the kernel holds.
+    """
+
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER)
+    except socket.error:
+        pass
+    return max(1, sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF) // PACKET_COST)
+
+
+def send_range_window(sock, address, filePath, offset, length, controller, limit=None):
+
+    """
+    Send one byte range of a file with a sliding window instead of "stop-and-wait".
+
+    Each 1000 byte chunk is prefixed with its index (HEADER) and the receiver answers every
+    packet with a cumulative "ACK:<next expected index>:<window>". Up to controller.cwnd
+    chunks are in flight, never more than the window the receiver can buffer, paced out at
+    a rate derived from cwnd and the smoothed RTT. Losses are detected by three duplicate
+    ACKs (fast retransmit, with NewReno partial ACK handling) or by the retransmission
+    timeout, after which the window restarts from the first unacknowledged chunk. The
+    receiver's FIN is confirmed with a FINACK.
+
+    Datagrams from any address other than the receiver's are ignored.
+
+    Parameters:
+    - sock (socket.socket): The UDP socket of the flow.
+    - address (tuple): The address of the receiver.
+    - filePath (str): The path of the file to be sent.
+    - offset (int): The start of the range.
+    - length (int): The number of bytes in the range.
+    - controller (congestion.NewReno): The congestion controller of this flow.
+    - limit (congestion.TokenBucket): Optional rate limit, may be shared by several flows.
+
+    Raises:
+    - IOError/OSError: If the file can't be opened or read.
+    - TransferError: If no chunk is acknowledged for IDLE_TIMEOUT seconds.
+    """
+
+    num_chunks = (length + CHUNK_SIZE - 1) // CHUNK_SIZE
+    rtt = RttEstimator()
+    pacer = Pacer(HEADER.size + CHUNK_SIZE, limit)
+    address = resolve(address)
+
+    # the ACKs of a whole window may arrive while the sender is busy sending
+    grow_receive_buffer(sock)
+
+    # base: first unacknowledged chunk, next_seq: next chunk to send, highest: chunks ever sent
+    base = next_seq = highest = 0
+    # send times of chunks sent only once, the only ones that give RTT samples (Karn)
+    sent = {}
+    # last chunk in flight when fast recovery started, -1 outside of recovery
+    recover = -1
+    # last chunk in flight at the latest timeout; the chunks sent again after it give
+    # duplicate ACKs that must not trigger a fast retransmit (RFC 6582)
+    resent = -1
+    dupacks = 0
+
+    fd = os.open(filePath, os.O_RDONLY)
+
+    def transmit(seq, reason):
+        start = seq * CHUNK_SIZE
+        data = pread(fd, min(CHUNK_SIZE, length - start), offset + start)
+        if not data:
+            raise TransferError('Error: File ' + filePath + ' ended before the requested range.')
+        pacer.wait(HEADER.size + len(data))
+        sock.sendto(HEADER.pack(seq) + data, address)
+        if seq < highest:
+            sent.pop(seq, None)
+            metrics.inc('retransmits_total', transport='udp', reason=reason)
+        else:
+            sent[seq] = time.time()
+
+    try:
+        last_progress = time.time()
+        while base < num_chunks:
+
+            # fill the window
+            while next_seq < num_chunks and next_seq < base + int(controller.cwnd):
+                transmit(next_seq, 'rto')
+                next_seq += 1
+                highest = max(highest, next_seq)
+
+            idle = time.time() - last_progress
+            if idle >= IDLE_TIMEOUT:
+                raise TransferError('Did not receive ACK. Terminating.')
+            sock.settimeout(min(rtt.rto, IDLE_TIMEOUT - idle))
+
+            try:
+                ack_msg, source = sock.recvfrom(1024)
+            except socket.timeout:
+                # retransmission timeout: shrink the window and go back to the first lost chunk
+                metrics.inc('timeouts_total', transport='udp', stage='rto')
+                controller.on_timeout()
+                rtt.backoff()
+                next_seq = base
+                recover = -1
+                resent = highest - 1
+                dupacks = 0
+                continue
+
+            if source != address:
+                continue
+
+            # the receiver has the whole range
+            if ack_msg == 'FIN':
+                break
+            if not ack_msg.startswith('ACK:'):
+                continue
+            ack, window = [int(field) for field in ack_msg[4:].split(':')]
+
+            # never let cwnd grow past what the receiver can buffer
+            if window < controller.max_window:
+                controller.max_window = window
+                controller.cwnd = min(controller.cwnd, window)
+
+            if ack > base:
+                now = time.time()
+                sample = now - sent[ack - 1] if ack - 1 in sent else None
+                if sample is not None:
+                    rtt.sample(sample)
+                for seq in range(base, ack):
+                    sent.pop(seq, None)
+
+                acked = ack - base
+                base = ack
+                next_seq = max(next_seq, base)
+                last_progress = now
+                dupacks = 0
+
+                if base <= recover:
+                    # partial ACK during recovery, the next chunk was lost as well
+                    transmit(base, 'fast')
+                else:
+                    recover = -1
+                    controller.on_ack(acked, sample)
+                pacer.update(controller.cwnd, rtt.srtt)
+
+            elif ack == base and next_seq > base:
+                dupacks += 1
+                if dupacks == DUPACK_THRESHOLD and recover < 0 and base > resent:
+                    controller.on_loss()
+                    recover = next_seq - 1
+                    transmit(base, 'fast')
+    finally:
+        os.close(fd)
+
+    # let the receiver stop lingering
+    sock.sendto('FINACK', address)
+
+
+def recv_range_window(sock, address, filePath, offset, length):
+
+    """
+    Receive one byte range sent by send_range_window() and write it to a preallocated file.
+
+    Chunks arriving out of order are buffered until the gap before them is filled. Every
+    packet is answered with a cumulative ACK carrying the window the socket buffer can hold.
+    Once the range is complete FIN is sent, and retransmissions that show the last ACKs or
+    the FIN were lost are answered again until the sender is done (see LINGER_QUIET).
+
+    Datagrams from any address other than the sender's are ignored.
+
+    Returns:
+    - tuple: The address of the sender.
+
+    Raises:
+    - IOError/OSError: If the file can't be opened or written.
+    - TransferError: If no data arrives for IDLE_TIMEOUT seconds.
+    """
+
+    num_chunks = (length + CHUNK_SIZE - 1) // CHUNK_SIZE
+    expected = 0
+    pending = {}
+    address = resolve(address)
+    window = str(grow_receive_buffer(sock))
+
+    sock.settimeout(IDLE_TIMEOUT)
+    fd = os.open(filePath, os.O_WRONLY)
+    try:
+        while expected < num_chunks:
+            try:
+                packet, source = sock.recvfrom(HEADER.size + CHUNK_SIZE)
+            except socket.timeout:
+                if expected == 0 and not pending:
+                    raise TransferError('Did not receive data. Terminating.')
+                raise TransferError('Data transmission terminated prematurely.')
+
+            if source != address or len(packet) <= HEADER.size:
+                continue
+            seq, = HEADER.unpack_from(packet)
+            if expected <= seq < num_chunks:
+                pending[seq] = packet[HEADER.size:]
+
+            # write everything that is now in order
+            while expected in pending:
+                pwrite(fd, pending.pop(expected), offset + expected * CHUNK_SIZE)
+                expected += 1
+
+            sock.sendto('ACK:' + str(expected) + ':' + window, address)
+    finally:
+        os.close(fd)
+
+    # linger: a retransmission means the sender missed the last ACK or the FIN
+    sock.sendto('FIN', address)
+    deadline = time.time() + IDLE_TIMEOUT
+    while 1:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        sock.settimeout(min(LINGER_QUIET, remaining))
+        try:
+            packet, source = sock.recvfrom(HEADER.size + CHUNK_SIZE)
+        except socket.timeout:
+            break
+        if source != address:
+            continue
+        if packet == 'FINACK':
+            break
+        sock.sendto('ACK:' + str(expected) + ':' + window, address)
+        sock.sendto('FIN', address)
+
+    return address